@@ -3,11 +3,23 @@ from connexion import NoContent
 import json
 import yaml
 import logging
-import logging.config
-from pykafka import KafkaClient
+from pykafka.common import OffsetType
 import os
+import datetime
+from collections import deque
+from threading import Thread
+from flask import Response
+from connexion.datastructures import MediaTypeDict
 from connexion.middleware import MiddlewarePosition
+from connexion.validators import VALIDATOR_MAP, AbstractResponseBodyValidator
 from starlette.middleware.cors import CORSMiddleware
+from cache import ResponseCache, cached_response
+from connector import BackgroundConnector
+from consumer_pool import ConsumerPool
+from event_bus import bus_name, open_topic
+from event_cache import EventCache, SingleFlight
+import log_setup
+from time_index import EVENT_TYPES, TimeIndex
 
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
     print("In Test Environment")
@@ -24,96 +36,273 @@ with open(app_conf_file, 'r') as f:
 # External Logging Configuration
 with open(log_conf_file, 'r') as f:
     log_config = yaml.safe_load(f.read())
-    logging.config.dictConfig(log_config)
+    log_setup.configure(log_config)
 
 logger = logging.getLogger('basicLogger')
 
 logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
-hostname = "%s:%d" % (app_config["events"]["hostname"], app_config["events"]["port"])
+history_cache = ResponseCache("history", app_config["cache"]["ttl_sec"], app_config["cache"]["max_entries"])
+time_index = TimeIndex(app_config["history"]["index_interval"])
+event_cache = EventCache(app_config["history"]["event_cache_bytes"])
+block_reads = SingleFlight()
+consumer_pool = None
+# Messages passed over because they are not event envelopes, counted on every read
+skipped_messages = {"count": 0}
 
-def get_refill_record(index):
-    """ Get refill record in History """
-    try:
-        logger.debug("Attempting to connect to Kafka at %s", hostname)
-        client = KafkaClient(hosts=hostname)
-    except Exception as e:
-        logger.error(f"{e}")
-        return e, 400
-    topic = client.topics[str.encode(app_config["events"]["topic"])]
+
+def connect_kafka():
+    """ Connects to the events topic and sets up the consumer pool. Runs on the connector thread """
+    global consumer_pool
+    topic = open_topic(app_config["events"])
+    consumer_pool = ConsumerPool(topic, app_config["history"]["consumer_pool_size"],
+                                 app_config["history"]["consumer_timeout_ms"])
+    return topic
+
+
+kafka = BackgroundConnector(bus_name(app_config["events"]), connect_kafka,
+                            app_config["events"]["sleep_time"],
+                            app_config["events"]["max_sleep_time"])
+
+
+def build_index():
+    """ Tails the topic from the beginning, adding every message to the time index """
+    topic = kafka.wait()
     consumer = topic.get_simple_consumer(reset_offset_on_start=True,
-    consumer_timeout_ms=1000)
-    logger.info("Retrieving refill at index %d" % index)
+                                         auto_offset_reset=OffsetType.EARLIEST)
+    logger.info("Started building the time index")
+    for msg in consumer:
+        event = decode_event(msg)
+        if event is None:
+            logger.error(f"Could not index malformed message at offset {msg.offset}")
+            continue
+        time_index.add(msg.partition_id, msg.offset, event["datetime"], event["type"])
+
+
+def decode_event(msg):
+    """
+    The event of a message, or None for a message that is not an event envelope.
+    Every reader skips the same messages, so indexed counts match what the reads see
+    """
     try:
-        events = []
+        event = json.loads(msg.value)
+    except ValueError:
+        event = None
+    if (isinstance(event, dict) and isinstance(event.get("type"), str)
+            and isinstance(event.get("datetime"), str) and isinstance(event.get("payload"), dict)):
+        return event
+    skipped_messages["count"] += 1
+    logger.debug(f"Skipping malformed message at offset {msg.offset} of partition {msg.partition_id}")
+    return None
+
+
+def read_messages(partition_id, start_offset, end_offset):
+    """ Yields the messages of one partition from start_offset up to end_offset (exclusive) """
+    if start_offset >= end_offset:
+        return
+    with consumer_pool.consumer(partition_id) as consumer:
+        partition = consumer_pool.topic.partitions[partition_id]
+        # pykafka resets to the last consumed offset; -1 would mean LATEST
+        consumer.reset_offsets([(partition, start_offset - 1 if start_offset > 0 else OffsetType.EARLIEST)])
         for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            if msg['type'] == 'refill':
-                events.append(msg['payload'])
-        return events[index], 200
-    except:
-        logger.error("No more messages found")
-        pass
-    logger.error("Could not find refill at index %d" % index)
-    return { "message": "Not Found"}, 404
+            if msg.offset >= end_offset:
+                break
+            yield msg
+            if msg.offset == end_offset - 1:
+                break
 
 
-def get_dispense_record(index):
-    """ Get dispense record in History """
-    try:
-        logger.debug("Attempting to connect to Kafka at %s", hostname)
-        client = KafkaClient(hosts=hostname)
-    except Exception as e:
-        logger.error(f"{e}")
-        return e, 400
-    topic = client.topics[str.encode(app_config["events"]["topic"])]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True,
-    consumer_timeout_ms=1000)
-    logger.info("Retrieving dispense at index %d" % index)
+def read_partition(topic, partition_id, start_offset, end_offset):
+    """ Yields the decoded events of one partition from start_offset up to end_offset (exclusive), skipping malformed messages """
+    for msg in read_messages(partition_id, start_offset, end_offset):
+        event = decode_event(msg)
+        if event is not None:
+            yield event
+
+
+def latest_offsets(topic):
+    """ Next offset to be written on every partition """
+    return {partition_id: response.offset[0]
+            for partition_id, response in topic.latest_available_offsets().items()}
+
+
+def stream_range(msg_type, start_timestamp, end_timestamp):
+    """ Yields the payloads of msg_type events between the timestamps as JSON lines """
+    topic = kafka.value
+    # Events can be slightly out of order, so keep reading a little past the end of the range
+    stop_after = (datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%S")
+                  + datetime.timedelta(seconds=app_config["history"]["range_slack_sec"])).strftime("%Y-%m-%dT%H:%M:%S")
+    for partition_id, end_offset in latest_offsets(topic).items():
+        start_offset = time_index.seek_time(partition_id, start_timestamp) or 0
+        for event in read_partition(topic, partition_id, start_offset, end_offset):
+            if event["datetime"] > stop_after:
+                break
+            if event["type"] == msg_type and start_timestamp <= event["datetime"] <= end_timestamp:
+                yield json.dumps(event["payload"]) + "\n"
+
+
+def get_range(msg_type, start_timestamp, end_timestamp):
+    """ Streams the events of a type between two timestamps """
+    # The operation declares NDJSON and JSON responses, so errors name their content type
+    json_content = {"Content-Type": "application/json"}
+    if not kafka.ready:
+        return {"message": "Not connected to Kafka yet"}, 503, json_content
     try:
-        events = []
-        for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            if msg['type'] == 'dispense':
-                events.append(msg['payload'])
-        return events[index], 200
-    except:
-        logger.error("No more messages found")
-        pass
-    logger.error("Could not find dispense at index %d" % index)
-    return { "message": "Not Found"}, 404
+        datetime.datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%S")
+        datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%S")
+    except ValueError:
+        return {"message": "Timestamps must be formatted as YYYY-MM-DDTHH:MM:SS"}, 400, json_content
+    logger.info(f"Streaming {msg_type} events between {start_timestamp} and {end_timestamp}")
+    return Response(stream_range(msg_type, start_timestamp, end_timestamp), mimetype="application/x-ndjson")
+
+
+def get_tail(msg_type, count):
+    """ Gets the last count events of a type, oldest first """
+    if not kafka.ready:
+        return {"message": "Not connected to Kafka yet"}, 503
+    topic = kafka.value
+    logger.info(f"Retrieving the last {count} {msg_type} events")
+    events = []
+    for partition_id, end_offset in latest_offsets(topic).items():
+        start_offset = time_index.seek_tail(partition_id, msg_type, count) or 0
+        recent = deque(maxlen=count)
+        for event in read_partition(topic, partition_id, start_offset, end_offset):
+            if event["type"] == msg_type:
+                recent.append(event)
+        events.extend(recent)
+    events.sort(key=lambda event: event["datetime"])
+    return [event["payload"] for event in events[-count:]], 200
+
+
+def get_dispense_range(start_timestamp, end_timestamp):
+    return get_range("dispense", start_timestamp, end_timestamp)
+
+
+def get_refill_range(start_timestamp, end_timestamp):
+    return get_range("refill", start_timestamp, end_timestamp)
+
+
+def get_dispense_tail(count):
+    return get_tail("dispense", count)
+
+
+def get_refill_tail(count):
+    return get_tail("refill", count)
+
+
+def get_refill_record(index):
+    """ Get refill record in History (cached) """
+    return cached_response(history_cache, ("refill", index), lambda: find_record("refill", index))
+
+
+def get_dispense_record(index):
+    """ Get dispense record in History (cached) """
+    return cached_response(history_cache, ("dispense", index), lambda: find_record("dispense", index))
+
 
 def get_event_stats():
+    """ Get stats in History (cached) """
+    return cached_response(history_cache, "stats", find_event_stats)
+
+
+def read_block(partition_id, start_offset, end_offset, before):
+    """
+    Decodes the messages of a partition between two offsets into the event cache.
+    before holds the number of events of each type ahead of start_offset
+    """
+    indices = dict(before)
+    for msg in read_messages(partition_id, start_offset, end_offset):
+        event = decode_event(msg)
+        if event is None:
+            continue
+        msg_type = event["type"]
+        if msg_type in indices:
+            event_cache.put((msg_type, indices[msg_type]), event["payload"], len(msg.value))
+            indices[msg_type] += 1
+    return indices
+
+
+def find_record(msg_type, index):
+    """
+    Get the index-th event of a type in History.
+    Events are counted partition by partition in id order, which is the topic order on a single partition
+    """
+    if not kafka.ready:
+        return {"message": "Not connected to Kafka yet"}, 503
+    payload = event_cache.get((msg_type, index))
+    if payload is not None:
+        return payload, 200
+
+    logger.info("Retrieving %s at index %d", msg_type, index)
+    latest = latest_offsets(kafka.value)
+    # Events of each type in the partitions already walked past
+    base = {event_type: 0 for event_type in EVENT_TYPES}
+    for partition_id in sorted(latest):
+        head, indexed = time_index.position(partition_id)
+        if index - base[msg_type] < indexed[msg_type]:
+            # Read the whole index block holding the event; its neighbours are likely to be asked for next
+            entry_offset, counts, next_offset = time_index.seek_index(partition_id, msg_type, index - base[msg_type])
+            start_offset, end_offset = entry_offset, min(head if next_offset is None else next_offset, head)
+            before = {event_type: base[event_type] + counts[event_type] for event_type in EVENT_TYPES}
+        else:
+            # Events the indexer has not reached yet
+            start_offset, end_offset = head, latest[partition_id]
+            before = {event_type: base[event_type] + indexed[event_type] for event_type in EVENT_TYPES}
+        # Requests for any event of the block wait for one read instead of each reading it
+        after = block_reads.do((partition_id, start_offset, end_offset),
+                               lambda: read_block(partition_id, start_offset, end_offset, before))
+        payload = event_cache.get((msg_type, index))
+        if payload is not None:
+            return payload, 200
+        if start_offset != head:
+            break
+        base = after
+
+    logger.error("Could not find %s at index %d", msg_type, index)
+    return {"message": "Not Found"}, 404
+
+
+def find_event_stats():
     """ Get stats in History """
-    try:
-        logger.debug("Attempting to connect to Kafka at %s", hostname)
-        client = KafkaClient(hosts=hostname)
-    except Exception as e:
-        logger.error(f"{e}")
-        return e, 400
-    topic = client.topics[str.encode(app_config["events"]["topic"])]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True,
-    consumer_timeout_ms=1000)
+    if not kafka.ready:
+        return {"message": "Not connected to Kafka yet"}, 503
     logger.info("Retrieving stats")
-    try:
-        stats = {'dispense': 0, 'refill': 0}
-        for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            stats[msg['type']] += 1
-        return {'num_dispense': stats['dispense'], 'num_refill': stats['refill']}, 200
-    except:
-        logger.error("No stats found")
-        pass
-    logger.error("Could not find stats")
-    return { "message": "Not Found"}, 404
+    stats = {event_type: 0 for event_type in EVENT_TYPES}
+    for partition_id, end_offset in latest_offsets(kafka.value).items():
+        head, indexed = time_index.position(partition_id)
+        for event_type in EVENT_TYPES:
+            stats[event_type] += indexed[event_type]
+        # Only the messages the indexer has not reached yet are read
+        for event in read_partition(kafka.value, partition_id, head, end_offset):
+            if event.get("type") in stats:
+                stats[event["type"]] += 1
+    return {'num_dispense': stats['dispense'], 'num_refill': stats['refill']}, 200
+
+
+def get_history_stats():
+    """ Event cache, request coalescing, consumer pool and skipped message counters """
+    if not kafka.ready:
+        return {"message": "Not connected to Kafka yet"}, 503
+    return {"event_cache": event_cache.stats(),
+            "block_reads": block_reads.stats(),
+            "consumer_pool": consumer_pool.stats(),
+            "skipped_messages": skipped_messages["count"]}, 200
+
+class StreamedResponseValidator(AbstractResponseBodyValidator):
+    """ Passes NDJSON streams through; the JSON validator would buffer the whole stream and fail to parse it """
+
+    def wrap_send(self, send):
+        return send
+
+
+response_validators = MediaTypeDict(VALIDATOR_MAP["response"])
+response_validators["application/x-ndjson"] = StreamedResponseValidator
 
 app = connexion.FlaskApp(__name__, specification_dir='')
 
-app.add_api("openapi.yaml", base_path="/analyzer", strict_validation=True, validate_responses=True)
+app.add_api("openapi.yaml", base_path="/analyzer", strict_validation=True, validate_responses=True,
+            validator_map={"response": response_validators})
 if "TARGET_ENV" not in os.environ or os.environ["TARGET_ENV"] != "test":
     #CORS(app.app)
     #app.app.config['CORS_HEADERS'] = 'Content-Type'
@@ -127,4 +316,6 @@ if "TARGET_ENV" not in os.environ or os.environ["TARGET_ENV"] != "test":
     )
 if __name__ == "__main__":
     logger.info("running on http://localhost:8110/ui")
+    kafka.start()
+    Thread(target=build_index, daemon=True).start()
     app.run(host="0.0.0.0", port=8110)
\ No newline at end of file
@@ -0,0 +1,89 @@
+"""
+History lookup benchmark with 50 concurrent dashboard clients
+
+Writes events to a file-backed event log in a temporary directory, indexes them,
+then has every client ask for dispenses and refills at random indices below 100,
+as the dashboard does, and reports request latency for:
+- replay: a new consumer per request reading the topic from the start (the previous lookup),
+  one request per client
+- cold: the shared consumer pool with an empty event cache, so concurrent misses are coalesced
+- warm: the same requests answered from the event cache
+
+    python3 benchmark_history.py [events] [clients] [requests per client]
+"""
+
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+EVENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+CLIENTS = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+REQUESTS = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+directory = tempfile.mkdtemp()
+os.environ["EVENT_BUS_URL"] = f"file://{os.path.join(directory, 'bus')}"
+
+import app as analyzer  # noqa: E402 (the backend is picked from the environment at import)
+from event_bus import open_topic  # noqa: E402
+
+logging.getLogger("basicLogger").setLevel(logging.WARNING)
+
+
+def replay_record(msg_type, index):
+    """ The lookup before the consumer pool and event cache: a new consumer replaying the whole topic """
+    topic = open_topic(analyzer.app_config["events"])
+    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
+    events = []
+    for msg in consumer:
+        event = json.loads(msg.value)
+        if event["type"] == msg_type:
+            events.append(event["payload"])
+    consumer.stop()
+    return events[index], 200
+
+
+def client(lookup, seed, requests):
+    rng = random.Random(seed)
+    latencies = []
+    for _ in range(requests):
+        msg_type = rng.choice(("dispense", "refill"))
+        started = time.perf_counter()
+        _, status = lookup(msg_type, rng.randrange(100))
+        latencies.append(time.perf_counter() - started)
+        assert status == 200
+    return latencies
+
+
+def run(name, lookup, requests):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(CLIENTS) as pool:
+        latencies = sorted(sum(pool.map(lambda seed: client(lookup, seed, requests), range(CLIENTS)), []))
+    elapsed = time.perf_counter() - started
+    print(f"{name:8} {len(latencies) / elapsed:8.0f} req/s   p50 {statistics.median(latencies) * 1000:9.3f} ms"
+          f"   p99 {latencies[int(len(latencies) * 0.99)] * 1000:9.3f} ms")
+
+
+producer = open_topic(analyzer.app_config["events"]).get_producer()
+for i in range(EVENTS):
+    msg_type = "refill" if i % 2 else "dispense"
+    producer.produce(json.dumps({"type": msg_type, "datetime": "2024-01-01T00:00:00",
+                                 "payload": {"vending_machine_id": str(i)}}).encode())
+
+analyzer.kafka.start()
+topic = analyzer.kafka.wait()
+for msg in topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=100):
+    event = json.loads(msg.value)
+    analyzer.time_index.add(msg.partition_id, msg.offset, event["datetime"], event["type"])
+
+print(f"{EVENTS} events, {CLIENTS} clients x {REQUESTS} requests")
+# A replay takes seconds, so only one request per client
+run("replay", replay_record, 1)
+run("cold", analyzer.find_record, REQUESTS)
+run("warm", analyzer.find_record, REQUESTS)
+print(f"block reads {analyzer.block_reads.stats()}, consumers {analyzer.consumer_pool.stats()}")
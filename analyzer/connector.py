@@ -0,0 +1,64 @@
+"""
+Background connection with exponential backoff
+
+Services start serving immediately and report readiness once the connection
+is up, instead of blocking at import time and exiting when Kafka is down.
+"""
+
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger('basicLogger')
+
+
+class BackgroundConnector:
+    """ Calls connect() on a daemon thread until it succeeds """
+
+    def __init__(self, name, connect, initial_delay, max_delay, on_ready=None):
+        self.name = name
+        self.value = None
+        self._connect = connect
+        self._initial_delay = initial_delay
+        self._max_delay = max_delay
+        self._on_ready = on_ready
+        self._ready = threading.Event()
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def start(self):
+        """ Starts connecting in the background. Safe to call more than once """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"{self.name}-connector", daemon=True)
+            self._thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        """ Blocks until connected, returning the connection (or None on timeout) """
+        self._ready.wait(timeout)
+        return self.value
+
+    def _run(self):
+        delay = self._initial_delay
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                logger.debug(f"Attempting to connect to {self.name} (attempt {attempt})")
+                self.value = self._connect()
+                break
+            except Exception as e:
+                # Jitter keeps restarted replicas from retrying in lockstep
+                sleep = delay * random.uniform(0.5, 1.0)
+                logger.error(f"{self.name} connection failed: {e}. Retrying in {sleep:.1f}s")
+                time.sleep(sleep)
+                delay = min(delay * 2, self._max_delay)
+
+        logger.info(f"Connected to {self.name} after {attempt} attempt(s)")
+        self._ready.set()
+        if self._on_ready is not None:
+            self._on_ready(self.value)
@@ -0,0 +1,56 @@
+"""
+Pool of long-lived single-partition consumers shared by history requests
+
+Creating a consumer costs a metadata round trip and broker connections, so
+consumers are kept per partition once a request is done with them and
+repositioned with reset_offsets by the next request.
+"""
+
+import threading
+from contextlib import contextmanager
+
+
+class ConsumerPool:
+    """ Idle consumers per partition, at most max_idle of each kept """
+
+    def __init__(self, topic, max_idle, consumer_timeout_ms):
+        self.topic = topic
+        self.max_idle = max_idle
+        self.consumer_timeout_ms = consumer_timeout_ms
+        self.created = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def consumer(self, partition_id):
+        """ A consumer of one partition, returned to the pool on exit """
+        with self._lock:
+            idle = self._idle.setdefault(partition_id, [])
+            consumer = idle.pop() if idle else None
+        if consumer is None:
+            consumer = self.topic.get_simple_consumer(partitions=[self.topic.partitions[partition_id]],
+                                                      consumer_timeout_ms=self.consumer_timeout_ms)
+            with self._lock:
+                self.created += 1
+        broken = False
+        try:
+            yield consumer
+        except Exception:
+            broken = True
+            raise
+        finally:
+            self._release(partition_id, consumer, broken)
+
+    def _release(self, partition_id, consumer, broken):
+        # A consumer that failed mid-fetch is not handed to another request;
+        # one abandoned early is fine, the next request repositions it anyway
+        if not broken:
+            with self._lock:
+                if len(self._idle[partition_id]) < self.max_idle:
+                    self._idle[partition_id].append(consumer)
+                    return
+        consumer.stop()
+
+    def stats(self):
+        with self._lock:
+            return {"created": self.created, "idle": sum(len(idle) for idle in self._idle.values())}
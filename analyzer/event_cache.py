@@ -0,0 +1,101 @@
+"""
+Decoded event cache and request coalescing for history lookups
+
+- EventCache keeps decoded events by (type, index) in LRU order within a byte budget,
+  sized by the length of the raw message each event was decoded from
+- SingleFlight runs one call per key at a time; callers arriving while it runs wait
+  for it and share its result instead of reading the topic again
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class EventCache:
+    """ LRU of decoded events evicted by total size """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._events = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._events.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._events.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, event, size):
+        with self._lock:
+            old = self._events.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._events[key] = (event, size)
+            self.size += size
+            while self.size > self.max_bytes and self._events:
+                _, (_, evicted_size) = self._events.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._events.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {"events": len(self._events), "bytes": self.size, "hits": self.hits, "misses": self.misses}
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """ Coalesces concurrent calls with the same key into one """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._in_flight.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = self._in_flight[key] = _Call()
+                self.calls += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._in_flight[key]
+                call.done.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {"fetches": self.calls, "coalesced": self.coalesced}
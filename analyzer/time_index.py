@@ -0,0 +1,122 @@
+"""
+Sparse time -> offset index over the events topic
+
+Built by a thread that tails the topic. Every `interval` messages of a
+partition an entry is recorded with:
+
+- the offset of the message
+- the largest envelope datetime seen strictly before that offset
+- the number of dispense and refill events strictly before that offset
+
+Using the running maximum keeps entries sorted even when events from several
+receiver workers arrive slightly out of order, so everything before an entry
+whose maximum is earlier than T can be skipped when looking for events from T on.
+"""
+
+import bisect
+import threading
+
+EVENT_TYPES = ("dispense", "refill")
+
+
+class PartitionIndex:
+    """ Index entries and running totals of one partition """
+
+    def __init__(self):
+        self.max_datetimes = []
+        self.offsets = []
+        self.counts = {event_type: [] for event_type in EVENT_TYPES}
+        self.totals = {event_type: 0 for event_type in EVENT_TYPES}
+        self.max_datetime = ""
+        self.next_offset = 0
+        self.since_entry = None
+
+
+class TimeIndex:
+    """ Sparse per-partition index from envelope datetime and event count to offset """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._partitions = {}
+        self._lock = threading.Lock()
+
+    def add(self, partition_id, offset, msg_datetime, msg_type):
+        """ Indexes one consumed message. Messages of a partition must be added in offset order """
+        with self._lock:
+            partition = self._partitions.get(partition_id)
+            if partition is None:
+                partition = self._partitions[partition_id] = PartitionIndex()
+
+            if partition.since_entry is None or partition.since_entry >= self.interval:
+                partition.max_datetimes.append(partition.max_datetime)
+                partition.offsets.append(offset)
+                for event_type in EVENT_TYPES:
+                    partition.counts[event_type].append(partition.totals[event_type])
+                partition.since_entry = 0
+
+            partition.since_entry += 1
+            partition.next_offset = offset + 1
+            if msg_datetime > partition.max_datetime:
+                partition.max_datetime = msg_datetime
+            if msg_type in partition.totals:
+                partition.totals[msg_type] += 1
+
+    def partition_ids(self):
+        with self._lock:
+            return list(self._partitions)
+
+    def seek_time(self, partition_id, start):
+        """ Offset from which every event with datetime >= start is found (None if nothing indexed) """
+        with self._lock:
+            partition = self._partitions.get(partition_id)
+            if partition is None:
+                return None
+            # Last entry whose preceding messages are all earlier than start
+            position = bisect.bisect_left(partition.max_datetimes, start) - 1
+            return partition.offsets[max(position, 0)]
+
+    def seek_tail(self, partition_id, msg_type, count):
+        """ Offset from which at least the last count events of msg_type are found (None if nothing indexed) """
+        with self._lock:
+            partition = self._partitions.get(partition_id)
+            if partition is None:
+                return None
+            # Counts are non-decreasing: find the last entry with at least count events of the type after it
+            counts = partition.counts[msg_type]
+            position = bisect.bisect_right(counts, partition.totals[msg_type] - count) - 1
+            return partition.offsets[max(position, 0)]
+
+    def seek_index(self, partition_id, msg_type, index):
+        """
+        Where to start reading for the index-th event of msg_type (0-based) in a partition:
+        (offset of the last entry before it, events of each type before that offset, offset of the next entry or None).
+        None if nothing is indexed.
+        """
+        with self._lock:
+            partition = self._partitions.get(partition_id)
+            if partition is None:
+                return None
+            position = max(bisect.bisect_right(partition.counts[msg_type], index) - 1, 0)
+            counts = {event_type: partition.counts[event_type][position] for event_type in EVENT_TYPES}
+            next_offset = partition.offsets[position + 1] if position + 1 < len(partition.offsets) else None
+            return partition.offsets[position], counts, next_offset
+
+    def position(self, partition_id):
+        """ Next offset the indexer will read on a partition and the number of events of each type before it """
+        with self._lock:
+            partition = self._partitions.get(partition_id)
+            if partition is None:
+                return 0, {event_type: 0 for event_type in EVENT_TYPES}
+            return partition.next_offset, dict(partition.totals)
+
+    def head(self, partition_id):
+        """ Next offset the indexer will read on a partition """
+        with self._lock:
+            partition = self._partitions.get(partition_id)
+            return 0 if partition is None else partition.next_offset
+
+    def totals(self):
+        """ Number of indexed events of each type over all partitions """
+        with self._lock:
+            return {event_type: sum(partition.totals[event_type] for partition in self._partitions.values())
+                    for event_type in EVENT_TYPES}
@@ -8,22 +8,29 @@ Anomaly Detection Service for Processing Kafka Events
 
 import json
 import os
-import sys
 import time
-import uuid
+from threading import Lock, Thread
 from datetime import datetime
 import logging
-import logging.config
 
 import yaml
 import connexion
 from connexion import NoContent
 from connexion.middleware import MiddlewarePosition
-from pykafka import KafkaClient
 from pykafka.common import OffsetType
-from pykafka.exceptions import UnknownTopicOrPartition
 from starlette.middleware.cors import CORSMiddleware
 
+from cache import ResponseCache, cached_response
+from connector import BackgroundConnector
+from detection import ANOMALY_CHECKS, build_anomaly
+from event_bus import bus_name, open_topic
+import log_setup
+from profiler import SamplingProfiler
+from batching import AdaptiveBatcher, ConsumerLag
+from dead_letter import DeadLetterQueue
+from tracing import TraceRecorder, stamp
+from stream import StreamHub, StreamMiddleware
+
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
     print("In Test Environment")
     APP_CONF_FILE = "/config/app_conf.yaml"
@@ -40,35 +47,32 @@ with open(APP_CONF_FILE, 'r', encoding='utf-8') as f:
 # Logging Configuration
 with open(LOG_CONF_FILE, 'r', encoding='utf-8') as f:
     LOG_CONFIG = yaml.safe_load(f.read())
-    logging.config.dictConfig(LOG_CONFIG)
+    log_setup.configure(LOG_CONFIG)
 
 LOGGER = logging.getLogger('basicLogger')
+# Per-event lines, sampled as configured in log_conf.yaml
+EVENT_LOGGER = logging.getLogger('basicLogger.events')
 LOGGER.info(f"App Conf File: {APP_CONF_FILE}")
 LOGGER.info(f"Log Conf File: {LOG_CONF_FILE}")
 
 ### KAFKA CONNECTION ###
-HOSTNAME = f"{APP_CONFIG['events']['hostname']}:{APP_CONFIG['events']['port']}"
-RETRIES = APP_CONFIG["events"]["retries"]
-retry_count = 0
-while retry_count < RETRIES:
-    try:
-        LOGGER.debug(f"Attempting to connect to Kafka at {HOSTNAME}")
-        client = KafkaClient(hosts=HOSTNAME)
-        LOGGER.debug(f"Connected to Kafka at {HOSTNAME}")
-        topic = client.topics[str.encode(APP_CONFIG["events"]["topic"])]
-        consumer = topic.get_simple_consumer(
-            consumer_timeout_ms=1000,
-            reset_offset_on_start=False,
-            auto_offset_reset=OffsetType.LATEST
-        )
-        break
-    except (ConnectionError, TimeoutError, UnknownTopicOrPartition) as e:
-        time.sleep(APP_CONFIG["events"]["sleep_time"])
-        retry_count += 1
-        LOGGER.error(f"{e}. {RETRIES-retry_count} out of {RETRIES} retries remaining.")
-    if retry_count == RETRIES:
-        LOGGER.info("Can't connect to Kafka. Exiting...")
-        sys.exit()
+
+
+def connect_kafka():
+    """
+    Connect the event consumer. Runs on the connector thread.
+    """
+    topic = open_topic(APP_CONFIG["events"])
+    return topic.get_simple_consumer(
+        consumer_timeout_ms=1000,
+        reset_offset_on_start=False,
+        auto_offset_reset=OffsetType.LATEST
+    )
+
+
+KAFKA = BackgroundConnector(bus_name(APP_CONFIG["events"]), connect_kafka,
+                            APP_CONFIG["events"]["sleep_time"],
+                            APP_CONFIG["events"]["max_sleep_time"])
 
 # Read datastore and store it in a global variable.
 # This is so I don't have to re-read the file every time the populate_anomalies function is run.
@@ -78,44 +82,80 @@ else:
     with open(APP_CONFIG['datastore']['filename'], "r", encoding='utf-8') as event_file:
         data = json.load(event_file)
 
+# Every open dashboard polls /anomalies, so responses are served from a short-lived cache
+ANOMALY_CACHE = ResponseCache("anomalies", APP_CONFIG["cache"]["ttl_sec"], APP_CONFIG["cache"]["max_entries"])
 
-# Anomaly Detection Functions
-def check_dispense_anomaly(event):
-    """
-    Check if a dispense event contains an anomaly based on amount paid.
-    """
-    return APP_CONFIG["anomalies"]["amount_paid_threshold"] < event['amount_paid']  # Too High
+# New anomalies are pushed to subscribed dashboards as they are detected
+ANOMALY_HUB = StreamHub(APP_CONFIG["stream"]["queue_size"], APP_CONFIG["stream"]["heartbeat_sec"])
 
-def check_refill_anomaly(event):
-    """
-    Check if a refill event contains an anomaly based on item quantity.
-    """
-    return APP_CONFIG["anomalies"]["item_quantity_threshold"] > event['item_quantity']  # Too Low
+# Stage timestamps of sampled events, for /trace lookups
+TRACES = TraceRecorder(APP_CONFIG["tracing"]["max_traces"])
 
-ANOMALY_CHECKS = {
-    'dispense': check_dispense_anomaly,
-    'refill': check_refill_anomaly
-}
+# Stack sampling for /profile, idle until a capture is requested
+PROFILER = SamplingProfiler(APP_CONFIG["profiler"]["max_seconds"])
+
+# Bigger batches while the consumer is behind, smaller once it has caught up
+BATCHER = AdaptiveBatcher.from_config(APP_CONFIG["batching"])
+CONSUMER_LAG = ConsumerLag(APP_CONFIG["batching"]["lag_interval_sec"])
+
+# Malformed events are set aside here instead of failing the whole batch
+DEAD_LETTERS = DeadLetterQueue(APP_CONFIG["dead_letter"]["filename"])
+
+# The pykafka consumer is not thread-safe
+CONSUMER_LOCK = Lock()
 
 
 # Data Processing Functions
+def detect_message(msg):
+    """
+    Decode one message and return the event if it is anomalous, else None.
+    Raises ValueError, KeyError or TypeError for a malformed message.
+    """
+    event = json.loads(msg.value)
+    if not isinstance(event, dict):
+        raise TypeError(f"Event is a {type(event).__name__}, not an object")
+    trace = event.get("trace")
+    if trace is not None:
+        stamp(trace, "consumed")
+    EVENT_LOGGER.debug("Processing event: %s", event)
+
+    has_anomaly = ANOMALY_CHECKS[event['type']](event['payload'], APP_CONFIG['anomalies'])
+    if trace is not None:
+        stamp(trace, "detected")
+        TRACES.record(event['payload']['trace_id'], trace)
+    if has_anomaly:
+        LOGGER.info("Detected anomaly in %s event", event['type'])
+        return event
+    return None
+
+
 def find_anomalies():
     """
     Consume events from Kafka and detect anomalies.
     """
-    LOGGER.info("Starting anomaly detection process")
+    if not KAFKA.ready:
+        return NoContent, 503
+
+    LOGGER.debug("Starting anomaly detection process")
+    consumer = KAFKA.value
     anomaly_list = []
 
     try:
-        for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            LOGGER.debug("Processing event: %s", msg)
-
-            has_anomaly = ANOMALY_CHECKS[msg['type']](msg['payload'])
-            if has_anomaly:
-                anomaly_list.append(msg)
-                LOGGER.info("Detected anomaly in %s event", msg['type'])
+        with CONSUMER_LOCK:
+            lag = CONSUMER_LAG.update(consumer)
+            if BATCHER.update(lag):
+                LOGGER.info("Consumer lag is %s, batch size now %s with %s ms linger",
+                            lag, BATCHER.size, BATCHER.linger_ms)
+            # A bounded batch, so anomalies are stored and pushed while events keep arriving
+            for msg in BATCHER.collect(consumer):
+                try:
+                    event = detect_message(msg)
+                except (ValueError, KeyError, TypeError) as e:
+                    LOGGER.error("Dead-lettering message at offset %s: %s", msg.offset, e)
+                    DEAD_LETTERS.put(msg, e)
+                    continue
+                if event is not None:
+                    anomaly_list.append(event)
 
         if anomaly_list:
             populate_anomalies(anomaly_list)
@@ -126,35 +166,29 @@ def find_anomalies():
         return NoContent, 404
 
 
+def run_detection():
+    """
+    Detect anomalies continuously so they can be pushed as they arrive.
+    """
+    KAFKA.wait()
+    while True:
+        _, status = find_anomalies()
+        if status != 200:
+            time.sleep(APP_CONFIG["events"]["sleep_time"])
+
+
 def populate_anomalies(anomaly_list):
     """
     Store detected anomalies in the JSON datastore.
     """
     current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     existing_trace_ids = {item['trace_id'] for item in data}
-    new_anomalies = 0
+    new_anomalies = []
 
     for event in anomaly_list:
         try:
-            if event['type'] == 'dispense':
-                anomaly_item = {
-                    "event_id": str(
-                        uuid.uuid4()),
-                    "trace_id": event['payload']['trace_id'],
-                    "event_type": "Dispense",
-                    "anomaly_type": "TooHigh",
-                    "description": f"The value is too high (amount paid of {event['payload']['amount_paid']} is greater than threshold of {APP_CONFIG['anomalies']['amount_paid_threshold']})",
-                    "timestamp": current_time}
-            elif event['type'] == 'refill':
-                anomaly_item = {
-                    "event_id": str(
-                        uuid.uuid4()),
-                    "trace_id": event['payload']['trace_id'],
-                    "event_type": "Refill",
-                    "anomaly_type": "TooLow",
-                    "description": f"The value is too low (item quantity of {event['payload']['item_quantity']} is lower than threshold of {APP_CONFIG['anomalies']['item_quantity_threshold']})",
-                    "timestamp": current_time}
-            else:
+            anomaly_item = build_anomaly(event, APP_CONFIG['anomalies'], current_time)
+            if anomaly_item is None:
                 LOGGER.error("Unknown event type: %s", event['type'])
                 continue
 
@@ -164,7 +198,7 @@ def populate_anomalies(anomaly_list):
                 LOGGER.info("Added new %s anomaly with trace ID %s",
                             anomaly_item['anomaly_type'],
                             anomaly_item['trace_id'])
-                new_anomalies += 1
+                new_anomalies.append(anomaly_item)
             else:
                 LOGGER.info("Skipped duplicate %s anomaly with trace ID %s",
                             anomaly_item['anomaly_type'],
@@ -175,18 +209,47 @@ def populate_anomalies(anomaly_list):
     # Write updated data
     with open(APP_CONFIG['datastore']['filename'], "w", encoding='utf-8') as event_file:
         LOGGER.info("Writing %s new anomalies to %s",
-                    new_anomalies,
+                    len(new_anomalies),
                     APP_CONFIG['datastore']['filename'])
         json.dump(data, event_file)
 
+    if new_anomalies:
+        ANOMALY_CACHE.invalidate()
+    for anomaly_item in new_anomalies:
+        ANOMALY_HUB.publish("anomaly", anomaly_item)
+
+
+# GET Endpoint functions
+def get_live():
+    """
+    Liveness probe.
+    """
+    return NoContent, 200
+
+
+def get_ready():
+    """
+    Readiness probe: ready once the event consumer is connected.
+    """
+    if KAFKA.ready:
+        return NoContent, 200
+    return NoContent, 503
+
 
-# GET Endpoint function
 def get_anomalies(anomaly_type):
+    """
+    Retrieve anomalies of a specific type, served through the response cache.
+    """
+    if not KAFKA.ready:
+        return {"message": "Not connected to Kafka yet"}, 503
+    return cached_response(ANOMALY_CACHE, anomaly_type, lambda: read_anomalies(anomaly_type))
+
+
+def read_anomalies(anomaly_type):
     """
     Retrieve anomalies of a specific type from the datastore.
     """
     LOGGER.info("Processing GET /anomalies request for type: %s", anomaly_type)
-    find_anomalies()
 
     try:
         relevant_anomalies = [
@@ -208,6 +271,62 @@ def get_anomalies(anomaly_type):
         return [], 400
 
 
+def get_trace(trace_id):
+    """
+    Retrieve the stage timestamps of a sampled event.
+    """
+    trace = TRACES.lookup(trace_id)
+    if trace is None:
+        return {"message": f"No trace recorded for {trace_id}"}, 404
+    return trace, 200
+
+
+def get_trace_summary():
+    """
+    Retrieve latency percentiles of every pipeline hop.
+    """
+    return TRACES.summary(), 200
+
+
+def get_stats():
+    """
+    Retrieve the number of stored anomalies and the consumer lag.
+    """
+    return {
+        "num_anomalies": len(data),
+        "consumer": {
+            "lag": CONSUMER_LAG.total,
+            "partitions": {str(partition_id): lag for partition_id, lag in CONSUMER_LAG.partitions.items()},
+            **BATCHER.stats(),
+            **DEAD_LETTERS.stats()
+        }
+    }, 200
+
+
+def get_profile(seconds=10, interval_ms=10):
+    """
+    Sample every thread, including the detection thread, as collapsed stacks.
+    """
+    if not APP_CONFIG["profiler"]["enabled"]:
+        return {"message": "Profiling is disabled"}, 404
+    result = PROFILER.capture(seconds, interval_ms)
+    if result is None:
+        return {"message": "A profile is already being captured"}, 409
+    stacks, samples = result
+    LOGGER.info("Captured a profile of %s samples", samples)
+    return stacks, 200, {"Content-Type": "text/plain"}
+
+
+def anomaly_snapshot():
+    """
+    Latest anomaly of each type, sent to a dashboard when it subscribes.
+    """
+    latest = {}
+    for anomaly in data:
+        latest[anomaly['anomaly_type']] = anomaly
+    return [("anomaly", anomaly) for anomaly in latest.values()]
+
+
 LOGGER.info(f"Dispense amount_paid anomaly threshold: {APP_CONFIG['anomalies']['amount_paid_threshold']}")
 LOGGER.info(f"Refill item_quantity anomaly threshold: {APP_CONFIG['anomalies']['item_quantity_threshold']}")
 
@@ -228,5 +347,15 @@ app.add_api(
     strict_validation=True,
     validate_responses=True
 )
+app.add_middleware(
+    StreamMiddleware,
+    position=MiddlewarePosition.BEFORE_EXCEPTION,
+    path="/anomaly_detector/stream",
+    hub=ANOMALY_HUB,
+    snapshot=anomaly_snapshot
+)
 if __name__ == "__main__":
+    KAFKA.start()
+    detector = Thread(target=run_detection, daemon=True)
+    detector.start()
     app.run(host="0.0.0.0", port=8120)
@@ -0,0 +1,202 @@
+"""
+Rebuild the anomaly datastore by replaying the events topic
+
+Reads the topic in large batches from a start offset or time up to the offsets
+that were current when the backfill started, runs the same detection rules as
+the service across a process pool, and writes the datastore atomically.
+Anomalies already in the datastore are kept and rebuilt ones are added for the
+traces it does not have yet, so a partial replay never drops older entries;
+--replace writes only the rebuilt anomalies. Stop the anomaly_detector service
+while this runs: it keeps the datastore in memory and would overwrite the
+rebuilt file.
+
+    python3 backfill.py                                  # whole topic
+    python3 backfill.py --from-time 2024-10-01T00:00:00
+    python3 backfill.py --from-offset 150000 --workers 8
+    python3 backfill.py --replace                        # rebuild from scratch
+"""
+
+import argparse
+import json
+import logging
+import logging.config
+import os
+import time
+from datetime import datetime
+from multiprocessing import Pool
+
+import yaml
+from pykafka.common import OffsetType
+
+from detection import ANOMALY_CHECKS, build_anomaly
+from event_bus import open_topic
+
+if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
+    APP_CONF_FILE = "/config/app_conf.yaml"
+    LOG_CONF_FILE = "/config/log_conf.yaml"
+else:
+    APP_CONF_FILE = "app_conf.yaml"
+    LOG_CONF_FILE = "log_conf.yaml"
+
+with open(APP_CONF_FILE, 'r', encoding='utf-8') as f:
+    APP_CONFIG = yaml.safe_load(f.read())
+
+with open(LOG_CONF_FILE, 'r', encoding='utf-8') as f:
+    LOG_CONFIG = yaml.safe_load(f.read())
+    logging.config.dictConfig(LOG_CONFIG)
+
+LOGGER = logging.getLogger('basicLogger')
+
+BACKFILL_CONFIG = APP_CONFIG['backfill']
+
+
+def detect_batch(args):
+    """
+    Decode a batch of raw messages and return (messages seen, anomalies, undecodable messages).
+    Runs in the worker processes.
+    """
+    raw_messages, thresholds, since = args
+    anomalies = []
+    errors = 0
+    for raw in raw_messages:
+        try:
+            event = json.loads(raw)
+            if since and event['datetime'] < since:
+                continue
+            if ANOMALY_CHECKS[event['type']](event['payload'], thresholds):
+                # Rebuilt anomalies are dated by when the event was received, not by when the backfill ran
+                timestamp = datetime.strptime(event['datetime'], "%Y-%m-%dT%H:%M:%S").strftime("%Y-%m-%d %H:%M:%S")
+                anomalies.append(build_anomaly(event, thresholds, timestamp))
+        except (ValueError, KeyError, TypeError):
+            errors += 1
+    return len(raw_messages), anomalies, errors
+
+
+def start_offsets(topic, from_offset, from_time):
+    """
+    Offset of the first message to read on every partition.
+    """
+    earliest = {partition_id: response.offset[0]
+                for partition_id, response in topic.earliest_available_offsets().items()}
+    if from_time:
+        millis = int(datetime.strptime(from_time, "%Y-%m-%dT%H:%M:%S").timestamp() * 1000)
+        offsets = {}
+        for partition_id, partition in topic.partitions.items():
+            found = getattr(partition.fetch_offset_limit(millis), "offset", None)
+            # Kafka answers at log segment granularity, and with no offset for a time before the
+            # start of the log; detect_batch drops the events before from_time
+            offsets[partition_id] = max(found[0], earliest[partition_id]) if found else earliest[partition_id]
+        return offsets
+    return {partition_id: max(from_offset, offset) for partition_id, offset in earliest.items()}
+
+
+def read_batches(topic, first_offsets, end_offsets, batch_size):
+    """
+    Yield lists of raw message values until every partition reaches its end offset.
+    """
+    consumer = topic.get_simple_consumer(
+        consumer_timeout_ms=BACKFILL_CONFIG['consumer_timeout_ms'],
+        fetch_message_max_bytes=BACKFILL_CONFIG['fetch_message_max_bytes'],
+        queued_max_messages=BACKFILL_CONFIG['queued_max_messages'],
+        reset_offset_on_start=True,
+        auto_offset_reset=OffsetType.EARLIEST
+    )
+    # pykafka resets to the last consumed offset, so the next message read is the start offset itself
+    consumer.reset_offsets([(topic.partitions[partition_id], offset - 1 if offset > 0 else OffsetType.EARLIEST)
+                            for partition_id, offset in first_offsets.items()])
+    remaining = {partition_id for partition_id, end in end_offsets.items() if end > first_offsets[partition_id]}
+
+    batch = []
+    try:
+        for msg in consumer:
+            if msg.offset < end_offsets[msg.partition_id]:
+                batch.append(msg.value)
+            if msg.offset >= end_offsets[msg.partition_id] - 1:
+                remaining.discard(msg.partition_id)
+            if len(batch) >= batch_size or not remaining:
+                yield batch
+                batch = []
+            if not remaining:
+                break
+    finally:
+        consumer.stop()
+    if batch:
+        yield batch
+
+
+def read_datastore(filename):
+    """
+    Anomalies already in the datastore, keyed by trace id.
+    """
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename, 'r', encoding='utf-8') as event_file:
+        return {anomaly['trace_id']: anomaly for anomaly in json.load(event_file)}
+
+
+def write_datastore(anomalies, filename):
+    """
+    Replace the datastore in one step so readers never see a partial file.
+    """
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w", encoding='utf-8') as event_file:
+        json.dump(anomalies, event_file)
+    os.replace(tmp_filename, filename)
+
+
+def backfill(from_offset, from_time, workers, output, replace=False):
+    """
+    Rebuild the anomaly datastore from the topic, keeping existing anomalies unless replace is set.
+    """
+    topic = open_topic(APP_CONFIG["events"])
+
+    first_offsets = start_offsets(topic, from_offset, from_time)
+    end_offsets = {partition_id: response.offset[0]
+                   for partition_id, response in topic.latest_available_offsets().items()}
+    total = sum(max(end_offsets[partition_id] - offset, 0) for partition_id, offset in first_offsets.items())
+    LOGGER.info("Backfilling %s messages with %s workers, from offsets %s to %s",
+                total, workers, first_offsets, end_offsets)
+
+    thresholds = APP_CONFIG['anomalies']
+    batches = ((batch, thresholds, from_time)
+               for batch in read_batches(topic, first_offsets, end_offsets, BACKFILL_CONFIG['batch_size']))
+
+    anomalies = {} if replace else read_datastore(output)
+    existing = len(anomalies)
+    processed = errors = 0
+    started = last_report = time.monotonic()
+    with Pool(workers) as pool:
+        for count, batch_anomalies, batch_errors in pool.imap(detect_batch, batches):
+            processed += count
+            errors += batch_errors
+            for anomaly in batch_anomalies:
+                # Same de-duplication as the service: the first anomaly of a trace wins,
+                # and one already in the datastore came first
+                anomalies.setdefault(anomaly['trace_id'], anomaly)
+
+            now = time.monotonic()
+            if now - last_report >= BACKFILL_CONFIG['report_sec']:
+                LOGGER.info("Backfill progress: %s/%s messages (%.0f%%), %.0f msg/s, %s anomalies",
+                            processed, total, 100 * processed / max(total, 1),
+                            processed / (now - started), len(anomalies))
+                last_report = now
+
+    write_datastore(list(anomalies.values()), output)
+    elapsed = time.monotonic() - started
+    LOGGER.info("Backfill done: %s messages in %.1fs (%.0f msg/s), %s anomalies (%s kept from the datastore), "
+                "%s undecodable, written to %s",
+                processed, elapsed, processed / max(elapsed, 1e-9), len(anomalies), existing, errors, output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the anomaly datastore from the events topic")
+    start = parser.add_mutually_exclusive_group()
+    start.add_argument("--from-offset", type=int, default=0, help="first offset to read on every partition")
+    start.add_argument("--from-time", help="only replay events received at or after YYYY-MM-DDTHH:MM:SS")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="detection processes")
+    parser.add_argument("--output", default=APP_CONFIG['datastore']['filename'], help="datastore file to write")
+    parser.add_argument("--replace", action="store_true",
+                        help="drop the anomalies already in the datastore instead of keeping them")
+    args = parser.parse_args()
+
+    backfill(args.from_offset, args.from_time, args.workers, args.output, args.replace)
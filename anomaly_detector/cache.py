@@ -0,0 +1,100 @@
+"""
+Read-through response cache for dashboard-facing endpoints
+
+- Each key holds one computed response for ttl_sec seconds
+- At most max_entries keys are kept; the least recently used one is dropped first
+- Only one caller recomputes an expired key; concurrent callers wait for it
+- ETags come from a per-key version counter that only moves when the body changes
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from connexion import NoContent, request
+
+
+class CacheEntry:
+    """ One cached response """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.body = None
+        self.status = None
+        self.digest = None
+        self.version = 0
+        self.expires = 0.0
+
+
+class ResponseCache:
+    """ Per-key TTL cache with stampede protection, bounded to max_entries keys """
+
+    def __init__(self, name, ttl_sec, max_entries=1024):
+        self.name = name
+        self.ttl_sec = ttl_sec
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._entries_lock = threading.Lock()
+
+    def _entry(self, key):
+        with self._entries_lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = CacheEntry()
+                if len(self._entries) > self.max_entries:
+                    # A caller still holding the dropped entry finishes with it; it is just not kept
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(key)
+            return entry
+
+    def get(self, key, compute):
+        """ Returns (body, status, etag), calling compute() at most once per ttl for the key """
+        entry = self._entry(key)
+        if entry.expires > time.monotonic():
+            return entry.body, entry.status, self._etag(entry)
+
+        with entry.lock:
+            # Another caller may have refreshed the entry while we waited for the lock
+            if entry.expires <= time.monotonic():
+                body, status = compute()
+                digest = hashlib.sha1(json.dumps(body, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+                if digest != entry.digest or status != entry.status:
+                    entry.version += 1
+                    entry.digest = digest
+                entry.body = body
+                entry.status = status
+                entry.expires = time.monotonic() + self.ttl_sec
+            return entry.body, entry.status, self._etag(entry)
+
+    def invalidate(self, key=None):
+        """ Forces the next get for key (or every key) to recompute """
+        with self._entries_lock:
+            entries = list(self._entries.values()) if key is None else [self._entries.get(key)]
+        for entry in entries:
+            if entry is not None:
+                entry.expires = 0.0
+
+    def _etag(self, entry):
+        # The digest prefix keeps tags unique across restarts, when version counters start over
+        return f'"{self.name}-{entry.digest[:12]}-{entry.version}"'
+
+
+def etag_matches(etag, if_none_match):
+    """ True if an If-None-Match header lists the tag, weakly compared, or is * """
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def cached_response(cache, key, compute):
+    """ Serves compute() through the cache, answering If-None-Match with 304 Not Modified """
+    body, status, etag = cache.get(key, compute)
+    headers = {"ETag": etag, "Cache-Control": f"max-age={cache.ttl_sec}"}
+    if status == 200 and etag_matches(etag, request.headers.get("If-None-Match", "")):
+        return NoContent, 304, headers
+    return body, status, headers
@@ -0,0 +1,46 @@
+"""
+Dead-letter file for event messages that cannot be processed
+
+Each rejected message is appended as one JSON line with its partition, offset,
+raw value and the error, so it can be inspected, fixed and replayed later
+while the consumer carries on with the next message.
+"""
+
+import datetime
+import json
+import os
+import threading
+
+
+class DeadLetterQueue:
+    """ Append-only JSON lines file of rejected messages, with counts per error type """
+
+    def __init__(self, filename):
+        self.filename = filename
+        # Opened on the first rejected message
+        self._file = None
+        self._lock = threading.Lock()
+        self.count = 0
+        self.errors = {}
+
+    def put(self, msg, error):
+        """ Records a message with the exception that rejected it """
+        record = {
+            "partition_id": msg.partition_id,
+            "offset": msg.offset,
+            "value": msg.value.decode("utf-8", errors="replace"),
+            "error": f"{type(error).__name__}: {error}",
+            "failed_at": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        }
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+                self._file = open(self.filename, "a", encoding="utf-8")
+            self._file.write(line)
+            self._file.flush()
+            self.count += 1
+            self.errors[type(error).__name__] = self.errors.get(type(error).__name__, 0) + 1
+
+    def stats(self):
+        return {"dead_lettered": self.count, "errors": dict(self.errors)}
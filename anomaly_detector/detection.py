@@ -0,0 +1,48 @@
+"""
+Anomaly detection rules shared by the service and the backfill tool
+"""
+
+import uuid
+
+
+def check_dispense_anomaly(event, thresholds):
+    """
+    Check if a dispense event contains an anomaly based on amount paid.
+    """
+    return thresholds["amount_paid_threshold"] < event['amount_paid']  # Too High
+
+
+def check_refill_anomaly(event, thresholds):
+    """
+    Check if a refill event contains an anomaly based on item quantity.
+    """
+    return thresholds["item_quantity_threshold"] > event['item_quantity']  # Too Low
+
+
+ANOMALY_CHECKS = {
+    'dispense': check_dispense_anomaly,
+    'refill': check_refill_anomaly
+}
+
+
+def build_anomaly(event, thresholds, timestamp):
+    """
+    Build the datastore record for an anomalous event, or None for an unknown event type.
+    """
+    if event['type'] == 'dispense':
+        return {
+            "event_id": str(uuid.uuid4()),
+            "trace_id": event['payload']['trace_id'],
+            "event_type": "Dispense",
+            "anomaly_type": "TooHigh",
+            "description": f"The value is too high (amount paid of {event['payload']['amount_paid']} is greater than threshold of {thresholds['amount_paid_threshold']})",
+            "timestamp": timestamp}
+    if event['type'] == 'refill':
+        return {
+            "event_id": str(uuid.uuid4()),
+            "trace_id": event['payload']['trace_id'],
+            "event_type": "Refill",
+            "anomaly_type": "TooLow",
+            "description": f"The value is too low (item quantity of {event['payload']['item_quantity']} is lower than threshold of {thresholds['item_quantity_threshold']})",
+            "timestamp": timestamp}
+    return None
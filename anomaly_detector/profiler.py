@@ -0,0 +1,60 @@
+"""
+Statistical profiler for the running process
+
+- Samples the stack of every thread (request handlers, the consumer thread, scheduler jobs)
+  with sys._current_frames() at a fixed interval for a bounded time
+- Folds the samples into collapsed stacks, "thread;outer;...;inner count" per line,
+  the input format of flamegraph.pl and speedscope
+
+Sampling runs on the requesting thread only while a capture is in progress, so an
+idle profiler costs nothing. Samples are wall-clock: threads blocked on I/O show up too.
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _collapse(thread_name, frame):
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    names.append(thread_name.replace(";", ":").replace(" ", "_"))
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """ One capture at a time; capture() returns None while another is running """
+
+    def __init__(self, max_seconds):
+        self.max_seconds = max_seconds
+        self._busy = threading.Lock()
+
+    def capture(self, seconds, interval_ms):
+        """ Samples every other thread for up to max_seconds and returns (collapsed stacks, samples taken) """
+        if not self._busy.acquire(blocking=False):
+            return None
+        try:
+            me = threading.get_ident()
+            stacks = Counter()
+            samples = 0
+            interval = interval_ms / 1000
+            deadline = time.monotonic() + min(seconds, self.max_seconds)
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id != me:
+                        stacks[_collapse(names.get(thread_id, str(thread_id)), frame)] += 1
+                samples += 1
+                time.sleep(interval)
+            return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common()), samples
+        finally:
+            self._busy.release()
@@ -0,0 +1,129 @@
+"""
+Pipeline tracing using the event's trace_id
+
+- The receiver samples events and adds a "trace" dict of stage timestamps to the envelope
+- Each hop stamps its stage (time.time_ns()) as the event passes through it
+- Storage and anomaly_detector consume the topic independently, so each records its own partial trace
+  (the receiver's stamps plus its consumed and persisted or detected stamps) for /trace/{trace_id}
+  lookups and per-hop latency histograms; check's /check/trace/{trace_id} joins the two by trace_id
+
+Unsampled events carry no "trace" key, so hops pay a single dict lookup for them.
+"""
+
+import random
+import threading
+import time
+from collections import OrderedDict
+
+STAGES = ["received", "produced", "consumed", "persisted", "detected"]
+
+BUCKET_COUNT = 256
+
+
+def sampled(rate):
+    """ Sampling decision for a new event """
+    return rate >= 1 or (rate > 0 and random.random() < rate)
+
+
+def stamp(trace, stage):
+    """ Records the time an event reached a stage """
+    trace[stage] = time.time_ns()
+
+
+def _bucket(micros):
+    """ Log-linear bucket index: four sub-buckets per power of two (~20% resolution) """
+    if micros < 4:
+        return micros
+    bits = micros.bit_length()
+    return (bits - 2) * 4 + ((micros >> (bits - 3)) & 3)
+
+
+def _bucket_floor(index):
+    """ Smallest value (in microseconds) that lands in the bucket """
+    if index < 4:
+        return index
+    bits = index // 4 + 2
+    return (4 | (index % 4)) << (bits - 3)
+
+
+class LatencyHistogram:
+    """ Fixed-size latency histogram in microseconds """
+
+    def __init__(self):
+        self.buckets = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, micros):
+        self.buckets[_bucket(micros)] += 1
+        self.count += 1
+        self.total += micros
+        self.max = max(self.max, micros)
+
+    def percentile(self, fraction):
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= target:
+                # Midpoint of the bucket, but never beyond the largest value seen
+                return min((_bucket_floor(index) + _bucket_floor(index + 1)) // 2, self.max)
+        return 0
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count / 1000, 3) if self.count else 0,
+            "p50_ms": self.percentile(0.50) / 1000,
+            "p95_ms": self.percentile(0.95) / 1000,
+            "p99_ms": self.percentile(0.99) / 1000,
+            "max_ms": self.max / 1000
+        }
+
+
+class TraceRecorder:
+    """ Keeps the most recent traces and latency histograms for every hop """
+
+    def __init__(self, max_traces):
+        self.max_traces = max_traces
+        self._traces = OrderedDict()
+        self._hops = {}
+        self._lock = threading.Lock()
+
+    def record(self, trace_id, trace):
+        """ Stores a completed trace and adds its hop latencies to the histograms """
+        stages = [stage for stage in STAGES if stage in trace]
+        hops = [(f"{start}->{end}", trace[end] - trace[start]) for start, end in zip(stages, stages[1:])]
+        if len(stages) > 2:
+            hops.append(("end_to_end", trace[stages[-1]] - trace[stages[0]]))
+
+        with self._lock:
+            self._traces[trace_id] = trace
+            if len(self._traces) > self.max_traces:
+                self._traces.popitem(last=False)
+            for hop, nanos in hops:
+                histogram = self._hops.get(hop)
+                if histogram is None:
+                    histogram = self._hops[hop] = LatencyHistogram()
+                # Hosts' clocks can disagree slightly; never record negative latencies
+                histogram.add(max(nanos, 0) // 1000)
+
+    def lookup(self, trace_id):
+        """ Stage timestamps and hop latencies of one trace, or None """
+        with self._lock:
+            trace = self._traces.get(trace_id)
+        if trace is None:
+            return None
+        stages = [stage for stage in STAGES if stage in trace]
+        return {
+            "trace_id": trace_id,
+            "stages": {stage: trace[stage] for stage in stages},
+            "hops_ms": {f"{start}->{end}": (trace[end] - trace[start]) / 1e6
+                        for start, end in zip(stages, stages[1:])}
+        }
+
+    def summary(self):
+        """ Latency distribution of every hop seen so far """
+        with self._lock:
+            return {hop: histogram.to_dict() for hop, histogram in self._hops.items()}
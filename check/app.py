@@ -2,10 +2,11 @@
 Final exam service
 """
 
+import datetime
 import json
 import os
 import logging
-import logging.config
+import time
 
 import requests
 from requests.exceptions import Timeout, ConnectionError
@@ -16,6 +17,9 @@ from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 from apscheduler.schedulers.background import BackgroundScheduler
 
+import log_setup
+from history import ERROR, HEALTHY, STATUS_NAMES, UNAVAILABLE, ProbeHistory
+
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
     print("In Test Environment")
     APP_CONF_FILE = "/config/app_conf.yaml"
@@ -32,7 +36,7 @@ with open(APP_CONF_FILE, 'r', encoding='utf-8') as f:
 # Logging Configuration
 with open(LOG_CONF_FILE, 'r', encoding='utf-8') as f:
     LOG_CONFIG = yaml.safe_load(f.read())
-    logging.config.dictConfig(LOG_CONFIG)
+    log_setup.configure(LOG_CONFIG)
 
 LOGGER = logging.getLogger('basicLogger')
 LOGGER.info(f"App Conf File: {APP_CONF_FILE}")
@@ -43,57 +47,73 @@ RECEIVER_URL = APP_CONFIG['url']['receiver']
 STORAGE_URL = APP_CONFIG['url']['storage']
 PROCESSING_URL = APP_CONFIG['url']['processing']
 ANALYZER_URL = APP_CONFIG['url']['analyzer']
+TRACE_URLS = APP_CONFIG['trace_url']
 TIMEOUT = APP_CONFIG['timeout']
 
+# Pipeline stages in order; every consumer's copy of a trace carries the receiver's stages
+TRACE_STAGES = ["received", "produced", "consumed", "persisted", "detected"]
+UPSTREAM_STAGES = ["received", "produced"]
+
+HISTORY = ProbeHistory(APP_CONFIG['history']['filename'], APP_CONFIG['history']['capacity'],
+                       ("receiver", "storage", "processing", "analyzer"))
+
+
+def probe(name, url):
+    """ GETs a service's check URL: (status, latency in ms, response) with response None unless healthy """
+    started = time.monotonic()
+    try:
+        response = requests.get(url, timeout=TIMEOUT)
+    except (Timeout, ConnectionError):
+        LOGGER.info("%s is Not Available", name)
+        return UNAVAILABLE, (time.monotonic() - started) * 1000, None
+    latency_ms = (time.monotonic() - started) * 1000
+    if response.status_code != 200:
+        LOGGER.info("%s returning non-200 response", name)
+        return ERROR, latency_ms, None
+    LOGGER.info("%s is Healthy", name)
+    return HEALTHY, latency_ms, response
+
+
 # Processing functions
 def check_services():
     """ Called periodically """
+    now = time.time()
+    probes = []
+
     receiver_status = "Unavailable"
-    try:
-        response = requests.get(RECEIVER_URL, timeout=TIMEOUT)
-        if response.status_code == 200:
-            receiver_status = "Healthy"
-            LOGGER.info("Receiver is Healthly")
-        else:
-            LOGGER.info("Receiver returning non-200 response")
-    except (Timeout, ConnectionError):
-        LOGGER.info("Receiver is Not Available")
+    status, latency_ms, response = probe("Receiver", RECEIVER_URL)
+    if response is not None:
+        receiver_status = "Healthy"
+    probes.append((now, "receiver", status, latency_ms, 0, 0))
 
     storage_status = "Unavailable"
-    try:
-        response = requests.get(STORAGE_URL, timeout=TIMEOUT)
-        if response.status_code == 200:
-            response = response.json()
-            storage_status = f"Storage has {response['num_dispense']} Dispenses and {response['num_refill']} Refill events"
-            LOGGER.info("Storage is Healthy")
-        else:
-            LOGGER.info("Storage returning non-200 response")
-    except (Timeout, ConnectionError):
-        LOGGER.info("Storage is Not Available")
+    status, latency_ms, response = probe("Storage", STORAGE_URL)
+    counts = (0, 0)
+    if response is not None:
+        response = response.json()
+        counts = (response['num_dispense'], response['num_refill'])
+        storage_status = f"Storage has {response['num_dispense']} Dispenses and {response['num_refill']} Refill events"
+    probes.append((now, "storage", status, latency_ms, *counts))
 
     analyzer_status = "Unavailable"
-    try:
-        response = requests.get(ANALYZER_URL, timeout=TIMEOUT)
-        if response.status_code == 200:
-            response = response.json()
-            analyzer_status = f"Analyzer has {response['num_dispense']} Dispenses and {response['num_refill']} Refill events"
-            LOGGER.info("Analyzer is Healthy")
-        else:
-            LOGGER.info("Analyzer returning non-200 response")
-    except (Timeout, ConnectionError):
-        LOGGER.info("Analyzer is Not Available")
+    status, latency_ms, response = probe("Analyzer", ANALYZER_URL)
+    counts = (0, 0)
+    if response is not None:
+        response = response.json()
+        counts = (response['num_dispense'], response['num_refill'])
+        analyzer_status = f"Analyzer has {response['num_dispense']} Dispenses and {response['num_refill']} Refill events"
+    probes.append((now, "analyzer", status, latency_ms, *counts))
 
     processing_status = "Unavailable"
-    try:
-        response = requests.get(PROCESSING_URL, timeout=TIMEOUT)
-        if response.status_code == 200:
-            response = response.json()
-            processing_status = f"Processing has {response['num_dispense_records']} Dispenses and {response['num_refill_records']} Refill events"
-            LOGGER.info("Processing is Healthy")
-        else:
-            LOGGER.info("Processing returning non-200 response")
-    except (Timeout, ConnectionError):
-        LOGGER.info("Processing is Not Available")
+    status, latency_ms, response = probe("Processing", PROCESSING_URL)
+    counts = (0, 0)
+    if response is not None:
+        response = response.json()
+        counts = (response['num_dispense_records'], response['num_refill_records'])
+        processing_status = f"Processing has {response['num_dispense_records']} Dispenses and {response['num_refill_records']} Refill events"
+    probes.append((now, "processing", status, latency_ms, *counts))
+
+    HISTORY.append(probes)
 
     data = {
         'receiver': receiver_status,
@@ -117,6 +137,70 @@ def get_checks():
         return "File not found", 404
 
 
+def get_history(limit=100, service=None):
+    """ Latest probe results, newest first """
+    if service is not None and service not in HISTORY.services:
+        return {"message": f"Unknown service {service}"}, 400
+    return [{
+        "service": name,
+        "timestamp": datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "status": STATUS_NAMES[status],
+        "latency_ms": round(latency_ms, 3),
+        "num_dispense": dispenses,
+        "num_refill": refills
+    } for timestamp, name, status, latency_ms, dispenses, refills in HISTORY.recent(limit, service)], 200
+
+
+def get_uptime(window_sec=None):
+    """ Uptime and latency percentiles of every service over the last window_sec seconds """
+    window_sec = window_sec or APP_CONFIG['history']['default_window_sec']
+    return {"window_sec": window_sec, "services": HISTORY.summary(time.time() - window_sec)}, 200
+
+
+def hops_ms(stages):
+    """ Milliseconds between consecutive stages, given (stage, epoch ns) pairs in pipeline order """
+    return {f"{start}->{end}": (end_ns - start_ns) / 1e6
+            for (start, start_ns), (end, end_ns) in zip(stages, stages[1:])}
+
+
+def get_trace(trace_id):
+    """ A sampled event's stages joined across the services that each recorded part of its trace """
+    upstream = {}
+    branches = {}
+    unavailable = []
+    for name, url in TRACE_URLS.items():
+        try:
+            response = requests.get(f"{url}/{trace_id}", timeout=TIMEOUT)
+        except (Timeout, ConnectionError):
+            unavailable.append(name)
+            continue
+        if response.status_code == 404:
+            continue
+        if response.status_code != 200:
+            unavailable.append(name)
+            continue
+        stages = response.json()['stages']
+        for stage in UPSTREAM_STAGES:
+            if stage in stages:
+                upstream[stage] = stages.pop(stage)
+        branches[name] = stages
+
+    if not branches:
+        return {"message": f"No trace recorded for {trace_id}", "unavailable": unavailable}, 404
+
+    upstream_stages = [(stage, upstream[stage]) for stage in TRACE_STAGES if stage in upstream]
+    joined = {"trace_id": trace_id, "stages": upstream, "hops_ms": hops_ms(upstream_stages),
+              "branches": {}, "unavailable": unavailable}
+    for name, stages in branches.items():
+        # Consumers read the topic independently, so each branch continues from the last upstream stage
+        branch_stages = upstream_stages[-1:] + [(stage, stages[stage]) for stage in TRACE_STAGES if stage in stages]
+        branch = {"stages": stages, "hops_ms": hops_ms(branch_stages)}
+        if upstream_stages and stages:
+            branch["end_to_end_ms"] = (branch_stages[-1][1] - upstream_stages[0][1]) / 1e6
+        joined["branches"][name] = branch
+    return joined, 200
+
+
 # Application Setup
 def init_scheduler():
     sched = BackgroundScheduler(daemon=True)
@@ -0,0 +1,122 @@
+"""
+Probe history of the checked services in a fixed-size memory-mapped ring
+
+- The file is a header (magic, capacity, records written) and capacity fixed-size records,
+  so its size is set when it is created and never grows; the oldest records are overwritten
+- Each record holds one probe: time, service, status, latency and the event counts reported
+- Records are appended in time order, so a window is found by binary search over the ring
+  and only the records inside it are read
+"""
+
+import mmap
+import os
+import struct
+import threading
+
+HEADER = struct.Struct("<4sIQ")
+MAGIC = b"CHK1"
+# time (unix seconds), service index, status, latency (ms), dispenses, refills
+RECORD = struct.Struct("<dBBxxfII")
+
+UNAVAILABLE = 0
+HEALTHY = 1
+ERROR = 2
+STATUS_NAMES = {UNAVAILABLE: "Unavailable", HEALTHY: "Healthy", ERROR: "Error"}
+
+
+def percentile(values, q):
+    """ Nearest-rank percentile of sorted values, None when empty """
+    if not values:
+        return None
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+class ProbeHistory:
+    """ Ring of probe records in a memory-mapped file """
+
+    def __init__(self, filename, capacity, services):
+        self.services = list(services)
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        size = HEADER.size + capacity * RECORD.size
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            existing = os.fstat(fd).st_size
+            header = os.pread(fd, HEADER.size, 0) if existing >= HEADER.size else b""
+            # A file of another capacity (or not a history file) is started over
+            if existing != size or HEADER.unpack(header)[:2] != (MAGIC, capacity):
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, HEADER.pack(MAGIC, capacity, 0), 0)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.written = HEADER.unpack_from(self._map, 0)[2]
+
+    def append(self, probes):
+        """ Appends (time, service, status, latency_ms, dispenses, refills) tuples and syncs the file """
+        with self._lock:
+            for timestamp, service, status, latency_ms, dispenses, refills in probes:
+                offset = HEADER.size + (self.written % self.capacity) * RECORD.size
+                RECORD.pack_into(self._map, offset, timestamp, self.services.index(service), status,
+                                 latency_ms, dispenses, refills)
+                self.written += 1
+            # The count is updated after the records, so a crash never exposes a half-written one
+            HEADER.pack_into(self._map, 0, MAGIC, self.capacity, self.written)
+            self._map.flush()
+
+    def _record(self, sequence):
+        timestamp, service, status, latency_ms, dispenses, refills = RECORD.unpack_from(
+            self._map, HEADER.size + (sequence % self.capacity) * RECORD.size)
+        return timestamp, self.services[service], status, latency_ms, dispenses, refills
+
+    def _first_after(self, since):
+        """ Sequence number of the oldest record at or after since """
+        low, high = max(self.written - self.capacity, 0), self.written
+        while low < high:
+            middle = (low + high) // 2
+            if self._record(middle)[0] < since:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def recent(self, limit, service=None):
+        """ Up to limit records, newest first, optionally of one service """
+        records = []
+        with self._lock:
+            sequence = self.written - 1
+            oldest = max(self.written - self.capacity, 0)
+            while sequence >= oldest and len(records) < limit:
+                record = self._record(sequence)
+                if service is None or record[1] == service:
+                    records.append(record)
+                sequence -= 1
+        return records
+
+    def window(self, since):
+        """ Records from since on, oldest first """
+        with self._lock:
+            return [self._record(sequence) for sequence in range(self._first_after(since), self.written)]
+
+    def summary(self, since):
+        """ Probes, uptime and latency percentiles of successful probes per service from since on """
+        probes = {service: 0 for service in self.services}
+        up = {service: 0 for service in self.services}
+        latencies = {service: [] for service in self.services}
+        for _, service, status, latency_ms, _, _ in self.window(since):
+            probes[service] += 1
+            if status == HEALTHY:
+                up[service] += 1
+                latencies[service].append(latency_ms)
+        summary = {}
+        for service in self.services:
+            values = sorted(latencies[service])
+            summary[service] = {
+                "probes": probes[service],
+                "uptime": up[service] / probes[service] if probes[service] else None,
+                "latency_ms": {"p50": percentile(values, 0.5), "p95": percentile(values, 0.95),
+                               "p99": percentile(values, 0.99)}
+            }
+        return summary
@@ -8,39 +8,28 @@ export default function AnomalyDetector() {
     const [error, setError] = useState(null)
     const dnsName = process.env.REACT_APP_HOSTNAME; // environment variable
 
-    const getTooHighStats = () => {
-        fetch(`http://${dnsName}/anomaly_detector/anomalies?anomaly_type=TooHigh`)
-            .then(res => res.json())
-            .then((result)=>{
-                console.log("Received Anomalies")
-                setTooHighStats(result);
-                setIsLoaded(true);
-            },(error) =>{
-                setError(error)
-                setIsLoaded(true);
-            })
-    }
     useEffect(() => {
-        const interval = setInterval(() => getTooHighStats(), 5000); // Update every 5 seconds
-        return() => clearInterval(interval);
-    }, [getTooHighStats]);
-
-	const getTooLowStats = () => {
-        fetch(`http://${dnsName}/anomaly_detector/anomalies?anomaly_type=TooLow`)
-            .then(res => res.json())
-            .then((result)=>{
-                console.log("Received Anomalies")
-                setTooLowStats(result);
-                setIsLoaded(true);
-            },(error) =>{
+        // The anomaly detector pushes the latest anomaly of each type on connect, then each new one
+        const source = new EventSource(`http://${dnsName}/anomaly_detector/stream`);
+        source.addEventListener("anomaly", (event) => {
+            console.log("Received Anomalies")
+            const anomaly = JSON.parse(event.data);
+            if (anomaly.anomaly_type === "TooHigh") {
+                setTooHighStats(prev => [anomaly, ...(Array.isArray(prev) ? prev : [])].slice(0, 10));
+            } else if (anomaly.anomaly_type === "TooLow") {
+                setTooLowStats(prev => [anomaly, ...(Array.isArray(prev) ? prev : [])].slice(0, 10));
+            }
+        });
+        source.onopen = () => setIsLoaded(true);
+        source.onerror = (error) => {
+            // EventSource reconnects on its own unless the stream was closed for good
+            if (source.readyState === EventSource.CLOSED) {
                 setError(error)
                 setIsLoaded(true);
-            })
-    }
-    useEffect(() => {
-        const interval = setInterval(() => getTooLowStats(), 5000); // Update every 5 seconds
-        return() => clearInterval(interval);
-    }, [getTooLowStats]);
+            }
+        }
+        return () => source.close();
+    }, [dnsName]);
 
     if (error) {
         return (<div className={"error"}>Error found when fetching from API</div>);
@@ -7,23 +7,24 @@ export default function AppStats() {
     const [error, setError] = useState(null)
     const dnsName = process.env.REACT_APP_HOSTNAME;
 
-	const getStats = () => {
-
-        fetch(`http://${dnsName}/processing/stats`)
-            .then(res => res.json())
-            .then((result)=>{
-				console.log("Received Stats")
-                setStats(result);
-                setIsLoaded(true);
-            },(error) =>{
+    useEffect(() => {
+        // Processing pushes the full stats on connect, then only the fields that changed
+        const source = new EventSource(`http://${dnsName}/processing/stream`);
+        source.addEventListener("stats", (event) => {
+            console.log("Received Stats")
+            const delta = JSON.parse(event.data);
+            setStats(prev => ({...prev, ...delta}));
+            setIsLoaded(true);
+        });
+        source.onerror = (error) => {
+            // EventSource reconnects on its own unless the stream was closed for good
+            if (source.readyState === EventSource.CLOSED) {
                 setError(error)
                 setIsLoaded(true);
-            })
-    }
-    useEffect(() => {
-		const interval = setInterval(() => getStats(), 5000); // Update every 5 seconds
-		return() => clearInterval(interval);
-    }, [getStats]);
+            }
+        }
+        return () => source.close();
+    }, [dnsName]);
 
     if (error){
         return (<div className={"error"}>Error found when fetching from API</div>)
@@ -1,34 +1,43 @@
 import React, { useEffect, useState } from 'react'
 import '../App.css';
 
+const SERVICES = ["receiver", "storage", "processing", "analyzer"];
+const WINDOWS = [["1h", 3600], ["24h", 86400], ["7d", 604800]];
+const TIMELINE_PROBES = 30;
+
+const formatUptime = (summary) => summary && summary.uptime !== null ? `${(summary.uptime * 100).toFixed(2)}%` : "-";
+const formatLatency = (value) => value !== null && value !== undefined ? `${value.toFixed(0)} ms` : "-";
+
 export default function Final() {
     const [isLoaded, setIsLoaded] = useState(false);
-    const [data, setData] = useState(null);
+    const [status, setStatus] = useState({});
+    const [uptime, setUptime] = useState({});
+    const [history, setHistory] = useState([]);
     const [error, setError] = useState(null)
     const dnsName = process.env.REACT_APP_HOSTNAME;
 
-    const getAnalyzer = () => {
-        setData("Final exam sample")
-        setIsLoaded(true)
-        // fetch(`http://${dnsName}/final`)
-        //     .then(res => res.json())
-        //     .then((result)=>{
-		// 		console.log("Received Final Stats")
-        //         setData(result);
-        //         setIsLoaded(true);
-        //     },(error) =>{
-        //         setError(error)
-        //         setIsLoaded(true);
-        //     })
-    }
-
-
-
-
-	useEffect(() => {
-		const interval = setInterval(() => getAnalyzer(), 5000); // Update every 5 seconds
-		return() => clearInterval(interval);
-    }, [getAnalyzer]);
+    useEffect(() => {
+        const getHealth = () => {
+            const getJson = (path) => fetch(`http://${dnsName}/check${path}`).then(res => res.json());
+            Promise.all([
+                getJson(""),
+                getJson(`/history?limit=${TIMELINE_PROBES * SERVICES.length}`),
+                ...WINDOWS.map(([, seconds]) => getJson(`/uptime?window_sec=${seconds}`))
+            ]).then(([current, probes, ...windows]) => {
+                console.log("Received Service Health")
+                setStatus(current);
+                setHistory(probes);
+                setUptime(Object.fromEntries(WINDOWS.map(([label], i) => [label, windows[i].services])));
+                setIsLoaded(true);
+            }, (error) => {
+                setError(error)
+                setIsLoaded(true);
+            })
+        }
+        getHealth();
+        const interval = setInterval(getHealth, 10000); // Probes run every 10 seconds
+        return () => clearInterval(interval);
+    }, [dnsName]);
 
     if (error){
         return (<div className={"error"}>Error found when fetching from API</div>)
@@ -38,8 +47,41 @@ export default function Final() {
 
         return (
             <div>
-                {/* {JSON.stringify(data)} */}
-                {data}
+                <table className={"StatsTable"}>
+                    <tbody>
+                        <tr>
+                            <th>Service</th>
+                            <th>Status</th>
+                            {WINDOWS.map(([label]) => <th key={label}>Uptime {label}</th>)}
+                            <th>Latency p50 / p99 (1h)</th>
+                            <th>Last {TIMELINE_PROBES} probes</th>
+                        </tr>
+                        {SERVICES.map((service) => {
+                            const hour = uptime["1h"] ? uptime["1h"][service] : null;
+                            // History is newest first; show the timeline oldest to newest
+                            const probes = history.filter(probe => probe.service === service).reverse();
+                            return (
+                                <tr key={service}>
+                                    <td>{service}</td>
+                                    <td>{status[service]}</td>
+                                    {WINDOWS.map(([label]) => (
+                                        <td key={label}>{formatUptime(uptime[label] ? uptime[label][service] : null)}</td>
+                                    ))}
+                                    <td>{hour ? `${formatLatency(hour.latency_ms.p50)} / ${formatLatency(hour.latency_ms.p99)}` : "-"}</td>
+                                    <td>
+                                        {probes.map(probe => (
+                                            <span key={probe.timestamp}
+                                                  title={`${probe.timestamp} ${probe.status} ${probe.latency_ms} ms`}
+                                                  style={{color: probe.status === "Healthy" ? "green" : "red"}}>
+                                                &#9632;
+                                            </span>
+                                        ))}
+                                    </td>
+                                </tr>
+                            )
+                        })}
+                    </tbody>
+                </table>
             </div>
         )
     }
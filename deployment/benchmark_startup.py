@@ -0,0 +1,57 @@
+"""
+Time-to-first-serve benchmark for a service
+
+Starts the service the way its Dockerfile does (python3 app.py in the service
+directory) and reports how long it takes for /health/live and /health/ready
+to answer 200. Stop Kafka first to see the difference lazy connection makes.
+
+    python3 benchmark_startup.py receiver 8080
+    python3 benchmark_startup.py storage 8090
+    python3 benchmark_startup.py anomaly_detector 8120
+"""
+
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+SERVICE = sys.argv[1]
+PORT = int(sys.argv[2])
+TIMEOUT_SEC = float(sys.argv[3]) if len(sys.argv) > 3 else 120.0
+
+SERVICE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", SERVICE)
+BASE_URL = f"http://localhost:{PORT}/{SERVICE}"
+
+
+def is_ok(url):
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status == 200
+    except (urllib.error.URLError, ConnectionError, TimeoutError):
+        return False
+
+
+process = subprocess.Popen([sys.executable, "app.py"], cwd=SERVICE_DIR,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+started = time.monotonic()
+results = {}
+try:
+    while len(results) < 2 and time.monotonic() - started < TIMEOUT_SEC:
+        if process.poll() is not None:
+            print(f"{SERVICE} exited with code {process.returncode} before becoming ready")
+            break
+        for probe in ("live", "ready"):
+            if probe not in results and is_ok(f"{BASE_URL}/health/{probe}"):
+                results[probe] = time.monotonic() - started
+        time.sleep(0.01)
+finally:
+    process.terminate()
+    process.wait()
+
+for probe in ("live", "ready"):
+    if probe in results:
+        print(f"{SERVICE} /health/{probe}: {results[probe] * 1000:.0f} ms after start")
+    else:
+        print(f"{SERVICE} /health/{probe}: not reached within {TIMEOUT_SEC:.0f}s")
@@ -0,0 +1,174 @@
+"""
+Run receiver, storage, processing and anomaly_detector in one process
+
+- Events go through a file-backed event log instead of Kafka and storage uses SQLite,
+  both under --dir, so no EC2 host is needed
+- Every service is served by uvicorn on localhost on its usual port, each in its own thread
+- With --events N, posts N generated events to the receiver and reports how long it took
+  until storage held all of them
+
+A single process makes the whole flow visible to one profiler, and a fresh --dir
+gives the same starting state on every run.
+
+    python3 local_pipeline.py
+    python3 local_pipeline.py --dir /tmp/pipeline --events 10000
+"""
+
+import argparse
+import datetime
+import importlib
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import uvicorn
+
+RUNNER_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(RUNNER_DIR)
+
+# (service, port), in start order: consumers are positioned before the receiver takes events
+SERVICES = [("storage", 8090), ("anomaly_detector", 8120), ("processing", 8100), ("receiver", 8080)]
+
+
+def load_service(name):
+    """ Imports a service's app.py as it would be imported when started from its own directory """
+    directory = os.path.join(ROOT, name)
+    # Services share module names (app, cache, connector, ...); drop the previous service's copies.
+    # This runner and its directory stay: purging __main__ breaks extension modules such as duckdb
+    for module_name, module in list(sys.modules.items()):
+        if module_name == "__main__" or not getattr(module, "__file__", None):
+            continue
+        module_dir = os.path.dirname(os.path.abspath(module.__file__))
+        if module_dir.startswith(ROOT + os.sep) and module_dir != RUNNER_DIR:
+            del sys.modules[module_name]
+    sys.path.insert(0, directory)
+    os.chdir(directory)  # app_conf.yaml, log_conf.yaml and openapi.yaml are read from the working directory
+    try:
+        return importlib.import_module("app")
+    finally:
+        sys.path.remove(directory)
+
+
+def serve(name, module, port):
+    """ Serves a service and waits until it has started """
+    server = uvicorn.Server(uvicorn.Config(module.app, host="127.0.0.1", port=port,
+                                           lifespan="on", log_level="warning"))
+    threading.Thread(target=server.run, name=name, daemon=True).start()
+    # connexion resolves operationIds like app.get_stats when the app first starts,
+    # so the next service may only be imported as "app" once this one is up
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def start_pipeline(directory):
+    os.environ["EVENT_BUS_URL"] = f"file://{os.path.join(directory, 'bus')}"
+    os.environ["DATASTORE_URL"] = f"sqlite:///{os.path.join(directory, 'events.db')}"
+
+    services = {}
+    for name, port in SERVICES:
+        module = load_service(name)
+        if name == "storage":
+            module.dead_letters.filename = os.path.join(directory, "dead_letter.jsonl")
+        elif name == "processing":
+            module.app_config["datastore"]["filename"] = os.path.join(directory, "data.json")
+            module.app_config["eventstore"]["url"] = "http://127.0.0.1:8090/storage"
+        elif name == "anomaly_detector":
+            module.APP_CONFIG["datastore"]["filename"] = os.path.join(directory, "anomalies.json")
+            module.DEAD_LETTERS.filename = os.path.join(directory, "anomaly_dead_letter.jsonl")
+        serve(name, module, port)
+
+        # The background work each service starts in its __main__ block
+        if name == "storage":
+            module.kafka.start()
+            threading.Thread(target=module.process_messages, daemon=True).start()
+            module.kafka.wait()
+        elif name == "anomaly_detector":
+            module.KAFKA.start()
+            threading.Thread(target=module.run_detection, daemon=True).start()
+            module.KAFKA.wait()
+        elif name == "processing":
+            module.init_scheduler()
+        elif name == "receiver":
+            module.kafka.wait()
+        services[name] = module
+        print(f"{name} listening on http://127.0.0.1:{port}")
+    return services
+
+
+def generate_event(index):
+    """ A dispense or refill event for one of 100 machines """
+    machine_id = str(uuid.UUID(int=index % 100))
+    now = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    if index % 2:
+        return "refills", {"vending_machine_id": machine_id, "staff_name": "Local Pipeline", "refill_time": now,
+                           "item_id": 1000 + index % 50, "item_quantity": random.randint(1, 20)}
+    return "dispenses", {"vending_machine_id": machine_id, "amount_paid": random.randint(100, 500),
+                         "payment_method": "cash", "transaction_time": now, "item_id": 1000 + index % 50}
+
+
+def post_event(index):
+    path, body = generate_event(index)
+    request = urllib.request.Request(f"http://127.0.0.1:8080/receiver/{path}", data=json.dumps(body).encode(),
+                                     headers={"Content-Type": "application/json"}, method="POST")
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return response.status
+
+
+def stored_events():
+    with urllib.request.urlopen("http://127.0.0.1:8090/storage/stats", timeout=10) as response:
+        stats = json.load(response)
+    return stats["num_dispense"] + stats["num_refill"]
+
+
+def run_load(count, concurrency):
+    random.seed(0)
+    before = stored_events()
+    started = time.monotonic()
+    with ThreadPoolExecutor(concurrency) as pool:
+        statuses = list(pool.map(post_event, range(count)))
+    posted = time.monotonic() - started
+    print(f"posted {count} events in {posted:.1f}s ({count / posted:.0f}/s), "
+          f"{sum(status == 201 for status in statuses)} sent straight to the event log")
+
+    while stored_events() - before < count:
+        time.sleep(0.1)
+    elapsed = time.monotonic() - started
+    print(f"all {count} events stored after {elapsed:.1f}s ({count / elapsed:.0f}/s end to end)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the event pipeline in one process")
+    parser.add_argument("--dir", default="/tmp/pipeline", help="event log, database and datastores")
+    parser.add_argument("--fresh", action="store_true", help="delete the contents of --dir first")
+    parser.add_argument("--events", type=int, default=0, help="events to post once everything is up")
+    parser.add_argument("--concurrency", type=int, default=16, help="parallel posting threads")
+    parser.add_argument("--log-level", default="WARNING", help="level of the services' basicLogger")
+    args = parser.parse_args()
+
+    if args.fresh:
+        shutil.rmtree(args.dir, ignore_errors=True)
+    os.makedirs(args.dir, exist_ok=True)
+    args.dir = os.path.abspath(args.dir)
+
+    start_pipeline(args.dir)
+    # Every service configures the same basicLogger; the last one loaded wins, so set one level for all
+    logging.getLogger("basicLogger").setLevel(args.log_level)
+
+    if args.events:
+        run_load(args.events, args.concurrency)
+    else:
+        print("Pipeline running, Ctrl+C to stop")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,202 @@
+"""
+Inventory Service for Tracking Stock Levels
+
+- Folds refill and dispense events from Kafka into per-machine stock levels
+- Snapshots the stock levels with the consumed offsets for fast recovery
+- Serves stock and low-stock queries
+"""
+
+import json
+import os
+import time
+from threading import Thread
+import logging
+
+import yaml
+import connexion
+from connexion import NoContent
+from connexion.middleware import MiddlewarePosition
+from pykafka.common import OffsetType
+from starlette.middleware.cors import CORSMiddleware
+
+from connector import BackgroundConnector
+from event_bus import bus_name, open_topic
+import log_setup
+from store import InventoryStore
+
+if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
+    print("In Test Environment")
+    APP_CONF_FILE = "/config/app_conf.yaml"
+    LOG_CONF_FILE = "/config/log_conf.yaml"
+else:
+    print("In Dev Environment")
+    APP_CONF_FILE = "app_conf.yaml"
+    LOG_CONF_FILE = "log_conf.yaml"
+
+# App Configuration
+with open(APP_CONF_FILE, 'r', encoding='utf-8') as f:
+    APP_CONFIG = yaml.safe_load(f.read())
+
+# Logging Configuration
+with open(LOG_CONF_FILE, 'r', encoding='utf-8') as f:
+    LOG_CONFIG = yaml.safe_load(f.read())
+    log_setup.configure(LOG_CONFIG)
+
+LOGGER = logging.getLogger('basicLogger')
+LOGGER.info(f"App Conf File: {APP_CONF_FILE}")
+LOGGER.info(f"Log Conf File: {LOG_CONF_FILE}")
+
+SNAPSHOT_FILE = APP_CONFIG['datastore']['filename']
+
+### KAFKA CONNECTION ###
+
+
+def connect_kafka():
+    """
+    Connect to the events topic. Runs on the connector thread.
+    """
+    return open_topic(APP_CONFIG["events"])
+
+
+KAFKA = BackgroundConnector(bus_name(APP_CONFIG["events"]), connect_kafka,
+                            APP_CONFIG["events"]["sleep_time"],
+                            APP_CONFIG["events"]["max_sleep_time"])
+
+# Restore the last snapshot so only events after its offsets are replayed
+if os.path.isfile(SNAPSHOT_FILE):
+    STORE = InventoryStore.load(SNAPSHOT_FILE)
+    LOGGER.info(f"Loaded inventory snapshot with {len(STORE.machines)} machines and offsets {STORE.offsets}")
+else:
+    STORE = InventoryStore()
+
+# Malformed events passed over since the service started
+COUNTERS = {"skipped": 0}
+
+
+# Event Processing Functions
+def open_consumer(topic):
+    """
+    Open a consumer positioned right after the snapshot's offsets.
+    """
+    consumer = topic.get_simple_consumer(
+        reset_offset_on_start=True,
+        auto_offset_reset=OffsetType.EARLIEST
+    )
+    checkpoints = [(topic.partitions[partition_id], offset - 1)
+                   for partition_id, offset in STORE.offsets.items() if offset > 0]
+    if checkpoints:
+        # pykafka resets to the last consumed offset, so the next message read is the checkpoint itself
+        consumer.reset_offsets(checkpoints)
+    return consumer
+
+
+def save_snapshot():
+    """
+    Write the stock levels and consumed offsets to the datastore.
+    """
+    start = time.monotonic()
+    STORE.save(SNAPSHOT_FILE)
+    LOGGER.info("Saved inventory snapshot (%s events applied) in %.0f ms",
+                STORE.events_applied, (time.monotonic() - start) * 1000)
+
+
+def process_messages():
+    """
+    Consume events from Kafka and fold them into the stock levels.
+    """
+    consumer = open_consumer(KAFKA.wait())
+    snapshot_sec = APP_CONFIG['datastore']['snapshot_sec']
+    next_snapshot = time.monotonic() + snapshot_sec
+
+    for msg in consumer:
+        try:
+            event = json.loads(msg.value)
+            if not isinstance(event, dict):
+                raise TypeError(f"Event is a {type(event).__name__}, not an object")
+            STORE.apply(event['type'], event['payload'])
+        except (ValueError, KeyError, TypeError) as e:
+            COUNTERS["skipped"] += 1
+            LOGGER.error("Skipping message at offset %s: %s", msg.offset, e)
+        except Exception:
+            # Anything else is also limited to this message, so the consumer thread keeps running
+            COUNTERS["skipped"] += 1
+            LOGGER.exception("Skipping message at offset %s after an unexpected error", msg.offset)
+        STORE.set_offset(msg.partition_id, msg.offset + 1)
+
+        # Snapshots are taken on this thread so they always match the offsets
+        if time.monotonic() >= next_snapshot:
+            save_snapshot()
+            next_snapshot = time.monotonic() + snapshot_sec
+
+
+# GET Endpoint functions
+def get_live():
+    """
+    Liveness probe.
+    """
+    return NoContent, 200
+
+
+def get_ready():
+    """
+    Readiness probe: ready once the event consumer is connected and while its thread runs.
+    """
+    if KAFKA.ready and CONSUMER_THREAD.is_alive():
+        return NoContent, 200
+    return NoContent, 503
+
+
+def get_machine_stock(vending_machine_id):
+    """
+    Retrieve the stock of every item in one vending machine.
+    """
+    items = STORE.machine_stock(vending_machine_id)
+    if items is None:
+        return {"message": f"No events seen for vending machine {vending_machine_id}"}, 404
+    return {"vending_machine_id": vending_machine_id, "items": items}, 200
+
+
+def get_low_stock(threshold=None, limit=None):
+    """
+    Retrieve the (machine, item) pairs below the stock threshold, emptiest first.
+    """
+    threshold = APP_CONFIG['inventory']['low_stock_threshold'] if threshold is None else threshold
+    limit = APP_CONFIG['inventory']['low_stock_limit'] if limit is None else limit
+    low = STORE.low_stock(threshold, limit)
+    LOGGER.info("GET /low_stock response: %s items below %s", len(low), threshold)
+    return low, 200
+
+
+def get_stats():
+    """
+    Retrieve the size of the inventory state.
+    """
+    return {
+        "num_machines": len(STORE.machines),
+        "num_items": len(STORE.items),
+        "events_applied": STORE.events_applied,
+        "events_skipped": COUNTERS["skipped"]
+    }, 200
+
+
+# Application Setup
+app = connexion.FlaskApp(__name__, specification_dir='')
+app.add_middleware(
+    CORSMiddleware,
+    position=MiddlewarePosition.BEFORE_EXCEPTION,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+app.add_api(
+    "openapi.yaml",
+    base_path="/inventory",
+    strict_validation=True,
+    validate_responses=True
+)
+CONSUMER_THREAD = Thread(target=process_messages, daemon=True)
+if __name__ == "__main__":
+    KAFKA.start()
+    CONSUMER_THREAD.start()
+    app.run(host="0.0.0.0", port=8140)
@@ -0,0 +1,68 @@
+"""
+Benchmark of the inventory store at 100k machines x 50 items
+
+Reports memory used by the state, the cost of folding one event, the time of
+a low-stock query and of saving/loading a snapshot.
+
+    python3 benchmark_inventory.py [machines] [items] [events]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+from store import InventoryStore
+
+MACHINES = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+ITEMS = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+EVENTS = int(sys.argv[3]) if len(sys.argv) > 3 else 2000000
+
+machine_ids = [str(uuid.uuid4()) for _ in range(MACHINES)]
+item_ids = random.sample(range(1000, 10000), ITEMS)
+
+tracemalloc.start()
+store = InventoryStore()
+
+# Stock every item of every machine once (timed with allocation tracing on)
+start = time.perf_counter()
+for machine_id in machine_ids:
+    for item_id in item_ids:
+        store.apply('refill', {'vending_machine_id': machine_id, 'item_id': item_id, 'item_quantity': 20})
+elapsed = time.perf_counter() - start
+cells = MACHINES * ITEMS
+print(f"initial fill: {cells} refills in {elapsed:.1f}s ({elapsed / cells * 1e6:.2f} us/event)")
+
+current, peak = tracemalloc.get_traced_memory()
+print(f"memory: {current / 2**20:.1f} MB total, "
+      f"{(store.stock.nbytes + store.known.nbytes) / 2**20:.1f} MB of it in the stock matrix")
+# Tracing allocations slows everything down; time the steady state without it
+tracemalloc.stop()
+
+# Mixed traffic on existing cells
+events = [('dispense' if random.random() < 0.9 else 'refill',
+           {'vending_machine_id': random.choice(machine_ids),
+            'item_id': random.choice(item_ids),
+            'item_quantity': 10}) for _ in range(EVENTS)]
+start = time.perf_counter()
+for msg_type, payload in events:
+    store.apply(msg_type, payload)
+elapsed = time.perf_counter() - start
+print(f"steady state: {EVENTS} events in {elapsed:.1f}s ({elapsed / EVENTS * 1e6:.2f} us/event)")
+
+start = time.perf_counter()
+low = store.low_stock(threshold=20, limit=100)
+print(f"low stock query: {(time.perf_counter() - start) * 1000:.1f} ms ({len(low)} returned)")
+
+with tempfile.TemporaryDirectory() as directory:
+    filename = os.path.join(directory, "inventory.npz")
+    start = time.perf_counter()
+    store.save(filename)
+    print(f"snapshot save: {(time.perf_counter() - start) * 1000:.0f} ms, "
+          f"{os.path.getsize(filename) / 2**20:.1f} MB on disk")
+    start = time.perf_counter()
+    InventoryStore.load(filename)
+    print(f"snapshot load: {(time.perf_counter() - start) * 1000:.0f} ms")
@@ -0,0 +1,149 @@
+"""
+Array-backed stock levels per (vending machine, item)
+
+- Machines and items are interned to dense row and column numbers
+- Stock lives in one int32 matrix plus a one-byte seen flag, 5 bytes per (machine, item) cell
+- Snapshots store the matrix with the offsets consumed so far for fast recovery
+- The consumer thread updates the store while request threads read it, and a resize swaps
+  the arrays, so updates, queries and snapshot copies all hold the store lock
+"""
+
+import json
+import os
+import threading
+
+import numpy as np
+
+
+class InventoryStore:
+    """ Stock matrix with machine rows and item columns """
+
+    def __init__(self, machine_capacity=1024, item_capacity=64):
+        self.machine_rows = {}
+        self.item_columns = {}
+        self.machines = []
+        self.items = []
+        self.stock = np.zeros((machine_capacity, item_capacity), dtype=np.int32)
+        # Cells that have seen an event; untouched cells are not reported as low stock
+        self.known = np.zeros((machine_capacity, item_capacity), dtype=bool)
+        self._update_views()
+        self.offsets = {}
+        self.events_applied = 0
+        self._lock = threading.Lock()
+
+    def _resize(self, rows, columns):
+        stock = np.zeros((rows, columns), dtype=np.int32)
+        known = np.zeros((rows, columns), dtype=bool)
+        used_rows, used_columns = len(self.machines), len(self.items)
+        stock[:used_rows, :used_columns] = self.stock[:used_rows, :used_columns]
+        known[:used_rows, :used_columns] = self.known[:used_rows, :used_columns]
+        self.stock, self.known = stock, known
+        self._update_views()
+
+    def _update_views(self):
+        # Flat memoryviews make single-cell updates several times cheaper than numpy scalar indexing
+        self._stock_cells = memoryview(self.stock).cast('B').cast('i')
+        self._known_cells = memoryview(self.known).cast('B')
+        self._stride = self.stock.shape[1]
+
+    def _row(self, machine_id):
+        row = self.machine_rows.get(machine_id)
+        if row is None:
+            row = len(self.machines)
+            if row == self.stock.shape[0]:
+                self._resize(row * 2, self.stock.shape[1])
+            self.machine_rows[machine_id] = row
+            self.machines.append(machine_id)
+        return row
+
+    def _column(self, item_id):
+        column = self.item_columns.get(item_id)
+        if column is None:
+            column = len(self.items)
+            if column == self.stock.shape[1]:
+                self._resize(self.stock.shape[0], column * 2)
+            self.item_columns[item_id] = column
+            self.items.append(item_id)
+        return column
+
+    def apply(self, msg_type, payload):
+        """ Folds one event into the stock levels; raises ValueError, KeyError or TypeError if malformed """
+        if msg_type == 'refill':
+            change = int(payload['item_quantity'])
+        elif msg_type == 'dispense':
+            change = -1
+        else:
+            return
+        # Everything is parsed before the state changes, so a malformed event leaves no trace
+        machine_id = payload['vending_machine_id']
+        item_id = int(payload['item_id'])
+        if not isinstance(machine_id, str):
+            raise TypeError(f"vending_machine_id is a {type(machine_id).__name__}, not a string")
+        with self._lock:
+            cell = self._row(machine_id) * self._stride + self._column(item_id)
+            self._stock_cells[cell] += change
+            self._known_cells[cell] = 1
+            self.events_applied += 1
+
+    def set_offset(self, partition_id, offset):
+        """ Records the next offset to consume on a partition """
+        with self._lock:
+            self.offsets[partition_id] = offset
+
+    def machine_stock(self, machine_id):
+        """ Stock of every item seen for one machine, or None for an unknown machine """
+        with self._lock:
+            row = self.machine_rows.get(machine_id)
+            if row is None:
+                return None
+            columns = np.nonzero(self.known[row, :len(self.items)])[0]
+            stock = self.stock[row, columns]
+        return [{"item_id": self.items[column], "stock": int(value)} for column, value in zip(columns, stock)]
+
+    def low_stock(self, threshold, limit):
+        """ Up to limit (machine, item) cells below threshold, emptiest first """
+        with self._lock:
+            rows, columns = len(self.machines), len(self.items)
+            mask = self.known[:rows, :columns] & (self.stock[:rows, :columns] < threshold)
+            low_rows, low_columns = np.nonzero(mask)
+            # Fancy indexing copies, so the values stay consistent after the lock is released
+            values = self.stock[low_rows, low_columns]
+        order = np.argsort(values, kind='stable')[:limit]
+        return [{"vending_machine_id": self.machines[low_rows[i]],
+                 "item_id": self.items[low_columns[i]],
+                 "stock": int(values[i])} for i in order]
+
+    def save(self, filename):
+        """ Writes a snapshot atomically; only copying the state holds the lock, not the write """
+        with self._lock:
+            rows, columns = len(self.machines), len(self.items)
+            stock = self.stock[:rows, :columns].copy()
+            known = self.known[:rows, :columns].copy()
+            machines = np.array(self.machines, dtype=str)
+            items = np.array(self.items, dtype=np.int64)
+            state = json.dumps({"offsets": self.offsets, "events_applied": self.events_applied})
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "wb") as snapshot_file:
+            np.savez(snapshot_file, stock=stock, known=known, machines=machines, items=items,
+                     state=np.array(state))
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """ Restores a snapshot written by save """
+        with np.load(filename) as snapshot:
+            machines = [str(machine_id) for machine_id in snapshot["machines"]]
+            items = [int(item_id) for item_id in snapshot["items"]]
+            store = cls(max(len(machines), 1024), max(len(items), 64))
+            store.stock[:len(machines), :len(items)] = snapshot["stock"]
+            store.known[:len(machines), :len(items)] = snapshot["known"]
+            state = json.loads(str(snapshot["state"]))
+
+        store.machines = machines
+        store.items = items
+        store.machine_rows = {machine_id: row for row, machine_id in enumerate(machines)}
+        store.item_columns = {item_id: column for column, item_id in enumerate(items)}
+        # JSON turns the partition ids into strings
+        store.offsets = {int(partition_id): offset for partition_id, offset in state["offsets"].items()}
+        store.events_applied = state["events_applied"]
+        return store
@@ -4,11 +4,15 @@ import json
 import yaml
 import os
 import logging
-import logging.config
 import datetime
 from apscheduler.schedulers.background import BackgroundScheduler
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
+from cache import ResponseCache, cached_response
+from stream import StreamHub, StreamMiddleware
+from stats import STATS_FIELDS, combined_sketch, empty_stats, update_stats
+from profiler import SamplingProfiler
+import log_setup
 
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
     print("In Test Environment")
@@ -25,26 +29,27 @@ with open(app_conf_file, 'r') as f:
 # External Logging Configuration
 with open(log_conf_file, 'r') as f:
     log_config = yaml.safe_load(f.read())
-    logging.config.dictConfig(log_config)
+    log_setup.configure(log_config)
 
 logger = logging.getLogger('basicLogger')
 
 logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
+stats_cache = ResponseCache("stats", app_config['cache']['ttl_sec'], app_config['cache']['max_entries'])
+stats_hub = StreamHub(app_config['stream']['queue_size'], app_config['stream']['heartbeat_sec'])
+profiler = SamplingProfiler(app_config['profiler']['max_seconds'])
+
 def populate_stats():
     logger.info("Start Periodic Processing")
 
     if not os.path.isfile(app_config['datastore']['filename']):
-        data = {"num_dispense_records": 0,
-                "max_dispense_amount_paid": 0,
-                "num_refill_records": 0,
-                "max_refill_quantity": 0,
-                "last_updated": "2023-10-10T03:30:20"}
+        data = empty_stats()
     else:
         with open(app_config['datastore']['filename'], "r") as events:
             data = json.load(events)
 
+    previous = {key: data[key] for key in STATS_FIELDS}
     current_time = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
 
     dispense_url = f"{app_config['eventstore']['url']}/dispenses?end_timestamp={current_time}&start_timestamp={data['last_updated']}"
@@ -78,12 +83,7 @@ def populate_stats():
     refill_items = refill_event.json()
 
     try:
-        data['num_dispense_records'] += len(dispense_items)
-        if len(dispense_items):
-            data['max_dispense_amount_paid'] = max(data['max_dispense_amount_paid'], *[x['amount_paid'] for x in dispense_items])
-        data['num_refill_records'] += len(refill_items)
-        if len(refill_items):
-            data['max_refill_quantity'] = max(data['max_refill_quantity'], *[y['item_quantity'] for y in refill_items])
+        update_stats(data, dispense_items, refill_items, app_config['sketches'])
         data['last_updated'] = current_time
     except Exception as e:
         logger.error(f"{e}")
@@ -92,10 +92,22 @@ def populate_stats():
     with open(app_config['datastore']['filename'], "w") as events:
         json.dump(data, events)
 
+    stats_cache.invalidate()
+
+    # Push only the fields that changed to subscribed dashboards; last_updated moves on every
+    # run, so a run that saw no new events sends nothing
+    delta = {key: data[key] for key in STATS_FIELDS if data[key] != previous[key]}
+    if delta.keys() - {'last_updated'}:
+        stats_hub.publish("stats", delta)
+
     logger.info("Ended Periodic Processing")
 
 
 def get_stats():
+    return cached_response(stats_cache, "stats", read_stats)
+
+
+def read_stats():
     logger.info("get_stats request started")
 
     if not os.path.isfile(app_config['datastore']['filename']):
@@ -112,6 +124,11 @@ def get_stats():
         'max_refill_quantity': data['max_refill_quantity'],
         'last_updated': data['last_updated']
     }
+    global_sketches = data.get('sketches', {}).get('global', {})
+    for field in ('amount_paid', 'item_quantity'):
+        sketch = combined_sketch([global_sketches], field)
+        if sketch is not None:
+            response[f'{field}_percentiles'] = sketch.percentiles()
 
     logger.debug(f"Contents: {response}")
 
@@ -120,6 +137,63 @@ def get_stats():
     return response, 200
 
 
+def get_distribution(vending_machine_id=None, start_date=None, end_date=None, buckets=10):
+    key = ("distribution", vending_machine_id, start_date, end_date, buckets)
+    return cached_response(stats_cache, key, lambda: read_distribution(vending_machine_id, start_date, end_date, buckets))
+
+
+def read_distribution(vending_machine_id, start_date, end_date, buckets):
+    """ Percentiles and histograms of amount_paid and item_quantity for a machine or a range of days """
+    if vending_machine_id is not None and (start_date is not None or end_date is not None):
+        return {"message": "Per-machine distributions cover all time; filter by machine or by dates, not both"}, 400
+
+    if not os.path.isfile(app_config['datastore']['filename']):
+        logger.error(f"Statistics do not exist.")
+        return {"message": "Statistics do not exist."}, 404
+
+    with open(app_config['datastore']['filename'], "r") as events:
+        sketches = json.load(events).get('sketches', {})
+
+    if vending_machine_id is not None:
+        if vending_machine_id not in sketches.get('machines', {}):
+            return {"message": f"No events for vending machine {vending_machine_id}"}, 404
+        states = [sketches['machines'][vending_machine_id]]
+    elif start_date is not None or end_date is not None:
+        # Daily buckets are keyed by YYYY-MM-DD, which sorts like the dates
+        states = [day_states for day, day_states in sketches.get('daily', {}).items()
+                  if (start_date is None or day >= str(start_date)) and (end_date is None or day <= str(end_date))]
+    else:
+        states = [sketches.get('global', {})]
+
+    response = {}
+    for field in ('amount_paid', 'item_quantity'):
+        sketch = combined_sketch(states, field)
+        if sketch is not None:
+            response[field] = {'count': sketch.count,
+                               'mean': sketch.sum / sketch.count,
+                               **sketch.percentiles(),
+                               'histogram': sketch.histogram(buckets)}
+    return response, 200
+
+
+def get_profile(seconds=10, interval_ms=10):
+    """ Samples every thread, including the scheduler's populate_stats runs, as collapsed stacks """
+    if not app_config['profiler']['enabled']:
+        return {"message": "Profiling is disabled"}, 404
+    result = profiler.capture(seconds, interval_ms)
+    if result is None:
+        return {"message": "A profile is already being captured"}, 409
+    stacks, samples = result
+    logger.info(f"Captured a profile of {samples} samples")
+    return stacks, 200, {"Content-Type": "text/plain"}
+
+
+def stats_snapshot():
+    """ Full stats sent to a dashboard when it subscribes to the stream """
+    response, status = read_stats()
+    return [("stats", response)] if status == 200 else []
+
+
 def init_scheduler():
     sched = BackgroundScheduler(daemon=True)
     sched.add_job(populate_stats,'interval',seconds=app_config['scheduler']['period_sec'])
@@ -129,6 +203,13 @@ def init_scheduler():
 app = connexion.FlaskApp(__name__, specification_dir='')
 
 app.add_api("openapi.yaml", base_path="/processing", strict_validation=True, validate_responses=True)
+app.add_middleware(
+    StreamMiddleware,
+    position=MiddlewarePosition.BEFORE_EXCEPTION,
+    path="/processing/stream",
+    hub=stats_hub,
+    snapshot=stats_snapshot,
+)
 if "TARGET_ENV" not in os.environ or os.environ["TARGET_ENV"] != "test":
     #CORS(app.app)
     #app.app.config['CORS_HEADERS'] = 'Content-Type'
@@ -0,0 +1,202 @@
+"""
+Rebuild the processing statistics from the storage service
+
+Fetches dispense and refill records from storage in time chunks on a few
+threads and shards each chunk by vending machine across worker processes, one
+per shard, that fold every chunk of their shard into its stats. The parent merges
+the per-shard stats and replaces the datastore atomically. last_updated is set
+to the end of the backfilled range, so the scheduler carries on from there.
+Stop the processing service while this runs so a scheduled run does not
+overwrite the rebuilt file.
+
+    python3 backfill.py --from-time 2024-10-01T00:00:00
+    python3 backfill.py --from-time 2024-10-01T00:00:00 --to-time 2024-11-01T00:00:00 --workers 8
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import logging.config
+import os
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process, Queue
+from queue import Empty, Full
+
+import requests
+import yaml
+
+from stats import add_to_sketches, empty_sketches, empty_stats, merge_sketch_objects, store_sketches, update_counts
+
+if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
+    app_conf_file = "/config/app_conf.yaml"
+    log_conf_file = "/config/log_conf.yaml"
+else:
+    app_conf_file = "app_conf.yaml"
+    log_conf_file = "log_conf.yaml"
+
+with open(app_conf_file, 'r') as f:
+    app_config = yaml.safe_load(f.read())
+
+with open(log_conf_file, 'r') as f:
+    log_config = yaml.safe_load(f.read())
+    logging.config.dictConfig(log_config)
+
+logger = logging.getLogger('basicLogger')
+
+backfill_config = app_config['backfill']
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def time_chunks(start, end, hours):
+    """ Consecutive [start, end) windows covering the range """
+    step = datetime.timedelta(hours=hours)
+    while start < end:
+        yield start, min(start + step, end)
+        start += step
+
+
+def fetch_chunk(window):
+    """ Dispense and refill records created in one window """
+    start, end = (moment.strftime(TIME_FORMAT) for moment in window)
+    records = []
+    for event_type in ("dispenses", "refills"):
+        response = requests.get(f"{app_config['eventstore']['url']}/{event_type}",
+                                params={"start_timestamp": start, "end_timestamp": end},
+                                timeout=backfill_config['request_timeout_sec'])
+        response.raise_for_status()
+        records.append(response.json())
+    return records
+
+
+def shard_worker(tasks, results, sketch_config):
+    """
+    Folds every chunk of one shard into its stats. Runs in a worker process.
+    A machine belongs to one shard, so its sketches are finished here and encoded once;
+    only the global and daily sketches go back to the parent as objects to be merged
+    """
+    data = empty_stats("")
+    sketches = empty_sketches()
+    for dispense_items, refill_items in iter(tasks.get, None):
+        update_counts(data, dispense_items, refill_items)
+        add_to_sketches(sketches, dispense_items, refill_items, sketch_config)
+    machines = {machine_id: {field: sketch.to_dict() for field, sketch in fields.items()}
+                for machine_id, fields in sketches["machines"].items()}
+    results.put((data, {"global": sketches["global"], "machines": {}, "daily": sketches["daily"]}, machines))
+
+
+def shard_of(item, shards):
+    # crc32 rather than hash() so a machine maps to the same shard in every process
+    return zlib.crc32(item['vending_machine_id'].encode()) % shards
+
+
+def put_task(queue, task, process):
+    """ Queues a task for a worker, raising if the worker died instead of taking it """
+    while True:
+        try:
+            queue.put(task, timeout=1)
+            return
+        except Full:
+            if process.exitcode is not None:
+                raise RuntimeError(f"A backfill worker exited with code {process.exitcode}")
+
+
+def dispatch(chunks, queues, processes, progress):
+    """ Splits every fetched chunk into per-machine shards and hands each to its worker """
+    shards = len(queues)
+    for dispense_items, refill_items in chunks:
+        tasks = [([], []) for _ in range(shards)]
+        for item in dispense_items:
+            tasks[shard_of(item, shards)][0].append(item)
+        for item in refill_items:
+            tasks[shard_of(item, shards)][1].append(item)
+        for queue, process, task in zip(queues, processes, tasks):
+            if task[0] or task[1]:
+                put_task(queue, task, process)
+        progress['records'] += len(dispense_items) + len(refill_items)
+        progress['chunks'] += 1
+        yield
+
+
+def next_result(results, processes):
+    """ The next worker result, raising if a worker died without one """
+    while True:
+        try:
+            return results.get(timeout=1)
+        except Empty:
+            failed = [process.exitcode for process in processes if process.exitcode not in (None, 0)]
+            if failed:
+                raise RuntimeError(f"A backfill worker exited with code {failed[0]}")
+
+
+def write_datastore(data, filename):
+    """ Replace the datastore in one step so readers never see a partial file """
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as events:
+        json.dump(data, events)
+    os.replace(tmp_filename, filename)
+
+
+def backfill(from_time, to_time, workers, output):
+    windows = list(time_chunks(from_time, to_time, backfill_config['chunk_hours']))
+    logger.info(f"Backfilling {from_time} to {to_time} in {len(windows)} chunks with {workers} workers")
+
+    data = empty_stats(from_time.strftime(TIME_FORMAT))
+    progress = {'records': 0, 'chunks': 0}
+    # A couple of chunks queued per worker keeps them busy without holding the whole range in memory
+    queues = [Queue(maxsize=2) for _ in range(workers)]
+    results = Queue()
+    processes = [Process(target=shard_worker, args=(queue, results, app_config['sketches']), daemon=True)
+                 for queue in queues]
+    for process in processes:
+        process.start()
+
+    started = last_report = time.monotonic()
+    with ThreadPoolExecutor(backfill_config['fetch_threads']) as fetcher:
+        for _ in dispatch(fetcher.map(fetch_chunk, windows), queues, processes, progress):
+            now = time.monotonic()
+            if now - last_report >= backfill_config['report_sec']:
+                logger.info(f"Backfill progress: {progress['chunks']}/{len(windows)} chunks, "
+                            f"{progress['records']} records, {progress['records'] / (now - started):.0f} records/s")
+                last_report = now
+    for queue, process in zip(queues, processes):
+        put_task(queue, None, process)
+
+    sketches = empty_sketches()
+    machines = {}
+    # Results are read before joining, so no worker blocks on a full pipe
+    for _ in processes:
+        counts, shard_sketches, shard_machines = next_result(results, processes)
+        for field in ('num_dispense_records', 'num_refill_records'):
+            data[field] += counts[field]
+        for field in ('max_dispense_amount_paid', 'max_refill_quantity'):
+            data[field] = max(data[field], counts[field])
+        merge_sketch_objects(sketches, shard_sketches)
+        machines.update(shard_machines)
+    for process in processes:
+        process.join()
+
+    store_sketches(data['sketches'], sketches, app_config['sketches'])
+    data['sketches']['machines'] = machines
+    data['last_updated'] = to_time.strftime(TIME_FORMAT)
+    write_datastore(data, output)
+    elapsed = time.monotonic() - started
+    logger.info(f"Backfill done: {progress['records']} records in {elapsed:.1f}s "
+                f"({progress['records'] / max(elapsed, 1e-9):.0f} records/s), written to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the processing statistics from storage")
+    parser.add_argument("--from-time", required=True, type=lambda value: datetime.datetime.strptime(value, TIME_FORMAT),
+                        help="first record to include, YYYY-MM-DDTHH:MM:SS")
+    parser.add_argument("--to-time", type=lambda value: datetime.datetime.strptime(value, TIME_FORMAT),
+                        default=datetime.datetime.now().replace(microsecond=0),
+                        help="end of the range, exclusive (defaults to now)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="statistics processes")
+    parser.add_argument("--output", default=app_config['datastore']['filename'], help="datastore file to replace")
+    args = parser.parse_args()
+
+    backfill(args.from_time, args.to_time, args.workers, args.output)
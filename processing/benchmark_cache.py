@@ -0,0 +1,71 @@
+"""
+Benchmark of the response cache with many dashboards polling /stats
+
+Simulates POLLERS browsers that each poll every PERIOD_SEC seconds with
+If-None-Match, against a stats computation that costs COMPUTE_MS and can only
+run one at a time (like reading and parsing the datastore on one worker).
+
+    python3 benchmark_cache.py [pollers] [duration_sec]
+"""
+
+import sys
+import threading
+import time
+
+from cache import ResponseCache
+
+POLLERS = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+DURATION_SEC = float(sys.argv[2]) if len(sys.argv) > 2 else 10.0
+PERIOD_SEC = 1.0
+COMPUTE_MS = 5.0
+
+worker = threading.Lock()
+
+
+def compute_stats():
+    """ Stand-in for reading the stats datastore """
+    with worker:
+        time.sleep(COMPUTE_MS / 1000)
+        compute_stats.calls += 1
+    return {"num_dispense_records": int(time.time()) // 3}, 200
+
+
+def poller(get, latencies, not_modified, deadline):
+    etag = None
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        body, status, new_etag = get()
+        latencies.append(time.perf_counter() - start)
+        if new_etag is not None and new_etag == etag:
+            not_modified.append(1)
+        etag = new_etag
+        time.sleep(PERIOD_SEC)
+
+
+def run(label, get):
+    compute_stats.calls = 0
+    latencies, not_modified = [], []
+    deadline = time.monotonic() + DURATION_SEC
+    threads = [threading.Thread(target=poller, args=(get, latencies, not_modified, deadline))
+               for _ in range(POLLERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    print(f"{label:>10}: {len(latencies)} polls, {compute_stats.calls} computations, "
+          f"{len(not_modified)} answered 304, "
+          f"p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms")
+
+
+def uncached():
+    body, status = compute_stats()
+    return body, status, None
+
+
+cache = ResponseCache("stats", ttl_sec=5)
+
+run("no cache", uncached)
+run("cached", lambda: cache.get("stats", compute_stats))
@@ -0,0 +1,118 @@
+"""
+Mergeable quantile sketch (DDSketch) for amount_paid and item_quantity
+
+- A value v is counted in bucket ceil(log(v) / log(gamma)), gamma = (1 + accuracy) / (1 - accuracy),
+  so any quantile is returned within the relative accuracy of the true value
+- Only bucket counts are kept, never the values, and the number of buckets is capped:
+  past max_buckets the lowest buckets are folded together, which only blurs the low quantiles
+- Two sketches with the same accuracy merge by adding bucket counts, so sketches of
+  machines, days or backfill shards combine into the sketch of their union
+"""
+
+import math
+
+
+class DDSketch:
+    """ Quantile sketch with relative accuracy and at most max_buckets buckets """
+
+    def __init__(self, accuracy=0.01, max_buckets=2048):
+        self.accuracy = accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zeros = 0
+        self.count = 0
+        self.sum = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _key(self, value):
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _value(self, key):
+        # Midpoint of the bucket in relative terms
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value, count=1):
+        if value <= 0:
+            self.zeros += count
+        else:
+            key = self._key(value)
+            self.bins[key] = self.bins.get(key, 0) + count
+            if len(self.bins) > self.max_buckets:
+                self._collapse()
+        self.count += count
+        self.sum += value * count
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def _collapse(self):
+        keys = sorted(self.bins)
+        excess = len(keys) - self.max_buckets
+        folded = sum(self.bins.pop(key) for key in keys[:excess])
+        self.bins[keys[excess]] += folded
+
+    def merge(self, other):
+        """ Adds the counts of another sketch with the same accuracy """
+        if other.accuracy != self.accuracy:
+            raise ValueError(f"Cannot merge sketches of accuracy {self.accuracy} and {other.accuracy}")
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        if len(self.bins) > self.max_buckets:
+            self._collapse()
+        self.zeros += other.zeros
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, q):
+        """ Value at quantile q (0 to 1), or None for an empty sketch """
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zeros:
+            return 0
+        seen = self.zeros
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                return min(max(self._value(key), self.min), self.max)
+        return self.max
+
+    def percentiles(self):
+        return {"p50": self.quantile(0.5), "p95": self.quantile(0.95), "p99": self.quantile(0.99)}
+
+    def histogram(self, buckets):
+        """ Counts in equal-width buckets between min and max, from the bucket midpoints """
+        if self.count == 0:
+            return []
+        width = (self.max - self.min) / buckets or 1
+        counts = [0] * buckets
+        counts[0] += self.zeros
+        for key, count in self.bins.items():
+            value = min(max(self._value(key), self.min), self.max)
+            counts[min(int((value - self.min) / width), buckets - 1)] += count
+        return [{"lower": self.min + i * width, "upper": self.min + (i + 1) * width, "count": count}
+                for i, count in enumerate(counts)]
+
+    def to_dict(self):
+        return {"accuracy": self.accuracy, "max_buckets": self.max_buckets,
+                "zeros": self.zeros, "count": self.count, "sum": self.sum,
+                "min": self.min if self.count else None, "max": self.max if self.count else None,
+                # JSON object keys are strings
+                "bins": {str(key): count for key, count in self.bins.items()}}
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state["accuracy"], state["max_buckets"])
+        sketch.bins = {int(key): count for key, count in state["bins"].items()}
+        sketch.zeros = state["zeros"]
+        sketch.count = state["count"]
+        sketch.sum = state["sum"]
+        if sketch.count:
+            sketch.min = state["min"]
+            sketch.max = state["max"]
+        return sketch
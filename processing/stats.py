@@ -0,0 +1,138 @@
+"""
+Statistics over dispense and refill events, shared by the service and the backfill tool
+
+Every field is a count, a maximum or a mergeable sketch, so stats computed over
+disjoint sets of events (time windows, machine shards) merge into the stats of their union.
+
+Sketches of amount_paid and item_quantity are kept globally, per machine and per day
+(by the event's own time), serialized in the datastore under "sketches".
+"""
+
+from sketch import DDSketch
+
+# Sketched field -> the record's time field, which decides its daily bucket
+SKETCH_FIELDS = {"amount_paid": "transaction_time", "item_quantity": "refill_time"}
+
+STATS_FIELDS = ['num_dispense_records', 'max_dispense_amount_paid', 'num_refill_records', 'max_refill_quantity', 'last_updated']
+
+
+def empty_stats(last_updated="2023-10-10T03:30:20"):
+    """ Stats before any event was seen """
+    return {"num_dispense_records": 0,
+            "max_dispense_amount_paid": 0,
+            "num_refill_records": 0,
+            "max_refill_quantity": 0,
+            "last_updated": last_updated,
+            "sketches": empty_sketches()}
+
+
+def empty_sketches():
+    return {"global": {}, "machines": {}, "daily": {}}
+
+
+def update_counts(data, dispense_items, refill_items):
+    """ Folds the record counts and maxima into data, in place """
+    data['num_dispense_records'] += len(dispense_items)
+    if len(dispense_items):
+        data['max_dispense_amount_paid'] = max(data['max_dispense_amount_paid'], *[x['amount_paid'] for x in dispense_items])
+    data['num_refill_records'] += len(refill_items)
+    if len(refill_items):
+        data['max_refill_quantity'] = max(data['max_refill_quantity'], *[y['item_quantity'] for y in refill_items])
+    return data
+
+
+def update_stats(data, dispense_items, refill_items, sketch_config):
+    """ Folds dispense and refill records from storage into data, in place """
+    update_counts(data, dispense_items, refill_items)
+    update_sketches(data.setdefault('sketches', empty_sketches()), dispense_items, refill_items, sketch_config)
+    return data
+
+
+def _load(states, field, accuracy, max_buckets):
+    state = states.get(field)
+    return DDSketch.from_dict(state) if state else DDSketch(accuracy, max_buckets)
+
+
+def add_to_sketches(sketches, dispense_items, refill_items, sketch_config, states=None):
+    """
+    Adds the values to sketches of DDSketch objects ({field: sketch} globally, per machine and per day), in place.
+    A sketch not in sketches yet starts from its state in states, if given
+    """
+    states = states or empty_sketches()
+    for field, items in (("amount_paid", dispense_items), ("item_quantity", refill_items)):
+        if not items:
+            continue
+        time_field = SKETCH_FIELDS[field]
+        if field not in sketches["global"]:
+            sketches["global"][field] = _load(states["global"], field, sketch_config["accuracy"], sketch_config["max_buckets"])
+        global_sketch = sketches["global"][field]
+        machines = {}
+        days = {}
+        for item in items:
+            value = item[field]
+            global_sketch.add(value)
+
+            machine_id = item['vending_machine_id']
+            if machine_id not in machines:
+                machine = sketches["machines"].setdefault(machine_id, {})
+                if field not in machine:
+                    machine[field] = _load(states["machines"].get(machine_id, {}), field,
+                                           sketch_config["machine_accuracy"], sketch_config["machine_max_buckets"])
+                machines[machine_id] = machine[field]
+            machines[machine_id].add(value)
+
+            day = str(item[time_field])[:10]
+            if day not in days:
+                daily = sketches["daily"].setdefault(day, {})
+                if field not in daily:
+                    daily[field] = _load(states["daily"].get(day, {}), field,
+                                         sketch_config["accuracy"], sketch_config["max_buckets"])
+                days[day] = daily[field]
+            days[day].add(value)
+    return sketches
+
+
+def update_sketches(sketches, dispense_items, refill_items, sketch_config):
+    """ Adds the new values to the global, per-machine and daily sketch states; only touched sketches are decoded """
+    touched = add_to_sketches(empty_sketches(), dispense_items, refill_items, sketch_config, states=sketches)
+    store_sketches(sketches, touched, sketch_config)
+
+
+def store_sketches(states, sketches, sketch_config):
+    """ Writes sketches of DDSketch objects into states, then drops the daily states past the retention """
+    for field, sketch in sketches["global"].items():
+        states["global"][field] = sketch.to_dict()
+    for scope in ("machines", "daily"):
+        for key, fields in sketches[scope].items():
+            scope_states = states[scope].setdefault(key, {})
+            for field, sketch in fields.items():
+                scope_states[field] = sketch.to_dict()
+
+    # Dates sort as strings; drop the oldest days past the retention
+    for day in sorted(states["daily"])[:-sketch_config["daily_retention_days"]]:
+        del states["daily"][day]
+    return states
+
+
+def merge_sketch_objects(into, other):
+    """ Merges sketches of DDSketch objects (as built by add_to_sketches) into into, in place """
+    targets = [(into["global"], other["global"])]
+    for scope in ("machines", "daily"):
+        targets.extend((into[scope].setdefault(key, {}), fields) for key, fields in other[scope].items())
+    for target, fields in targets:
+        for field, sketch in fields.items():
+            if field in target:
+                target[field].merge(sketch)
+            else:
+                target[field] = sketch
+    return into
+
+
+def combined_sketch(states_list, field):
+    """ One sketch of a field over several {field: sketch state} dicts, or None if none has it """
+    sketch = None
+    for states in states_list:
+        if field in states:
+            part = DDSketch.from_dict(states[field])
+            sketch = part if sketch is None else sketch.merge(part)
+    return sketch
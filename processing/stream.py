@@ -0,0 +1,107 @@
+"""
+Server-Sent Events fan-out for pushing updates to dashboards
+
+- publish() can be called from any thread (scheduler jobs, consumer threads)
+- Each update is serialized once and the same bytes are queued for every subscriber
+- Slow subscribers drop their oldest queued frames instead of holding up the rest
+- A client is subscribed before its snapshot is taken, so no update falls between the two;
+  an update made during the snapshot may arrive in both
+"""
+
+import asyncio
+import json
+
+HEARTBEAT = b": keepalive\n\n"
+
+
+def encode_event(event, payload):
+    """ Formats one SSE frame """
+    return f"event: {event}\ndata: {json.dumps(payload, default=str)}\n\n".encode('utf-8')
+
+
+class StreamHub:
+    """ Holds the subscriber queues of one event stream """
+
+    def __init__(self, queue_size=100, heartbeat_sec=15):
+        self.queue_size = queue_size
+        self.heartbeat_sec = heartbeat_sec
+        self._subscribers = set()
+        self._loop = None
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def publish(self, event, payload):
+        """ Queues an update for every subscriber. Thread-safe, no-op until someone subscribes """
+        loop = self._loop
+        if loop is None or not self._subscribers:
+            return
+        loop.call_soon_threadsafe(self._fan_out, encode_event(event, payload))
+
+    def _fan_out(self, frame):
+        for queue in self._subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(frame)
+
+    async def serve(self, receive, send, snapshot=None):
+        """ Streams the snapshot's (event, payload) updates, then every published frame, until the client disconnects """
+        self._loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(self.queue_size)
+        self._subscribers.add(queue)
+        try:
+            initial_frames = []
+            if snapshot is not None:
+                # New subscribers start from the current state, then receive updates
+                events = await asyncio.to_thread(snapshot)
+                initial_frames = [encode_event(event, payload) for event, payload in events]
+            await self._stream(queue, receive, send, initial_frames)
+        finally:
+            self._subscribers.discard(queue)
+
+    async def _stream(self, queue, receive, send, initial_frames):
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                (b"access-control-allow-origin", b"*"),
+                # Stops nginx from buffering the stream
+                (b"x-accel-buffering", b"no"),
+            ],
+        })
+        for frame in initial_frames:
+            await send({"type": "http.response.body", "body": frame, "more_body": True})
+
+        writer = asyncio.ensure_future(self._write(queue, send))
+        try:
+            while (await receive())["type"] != "http.disconnect":
+                pass
+        finally:
+            writer.cancel()
+
+    async def _write(self, queue, send):
+        while True:
+            try:
+                frame = await asyncio.wait_for(queue.get(), self.heartbeat_sec)
+            except asyncio.TimeoutError:
+                frame = HEARTBEAT
+            await send({"type": "http.response.body", "body": frame, "more_body": True})
+
+
+class StreamMiddleware:
+    """ ASGI middleware answering GET requests on path with the hub's event stream """
+
+    def __init__(self, app, path, hub, snapshot=None):
+        self.app = app
+        self.path = path
+        self.hub = hub
+        self.snapshot = snapshot
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+        await self.hub.serve(receive, send, self.snapshot)
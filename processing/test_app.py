@@ -0,0 +1,40 @@
+import json
+import os
+
+import pytest
+
+# app.py reads app_conf.yaml, log_conf.yaml and openapi.yaml from the working directory
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import app  # noqa: E402
+from stats import empty_stats  # noqa: E402
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setitem(app.app_config['datastore'], 'filename', str(tmp_path / "data.json"))
+    app.stats_cache.invalidate()
+    with app.app.test_client() as test_client:
+        yield test_client
+
+
+def test_distribution_without_stats_is_404_message(client):
+    response = client.get("/processing/stats/distribution")
+    assert response.status_code == 404
+    assert response.json() == {"message": "Statistics do not exist."}
+
+
+@pytest.mark.parametrize("if_none_match, expected", [
+    ('{etag}', 304),
+    ('W/{etag}', 304),
+    ('"other", {etag}', 304),
+    ('*', 304),
+    ('"other"', 200),
+    ('{etag}-2', 200),
+])
+def test_stats_if_none_match(client, if_none_match, expected):
+    with open(app.app_config['datastore']['filename'], "w") as events:
+        json.dump(empty_stats(), events)
+    etag = client.get("/processing/stats").headers["ETag"]
+    response = client.get("/processing/stats", headers={"If-None-Match": if_none_match.format(etag=etag)})
+    assert response.status_code == expected
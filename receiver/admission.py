@@ -0,0 +1,121 @@
+"""
+Admission control for the event endpoints
+
+- MachineBuckets is a token bucket per vending machine: rate events per second, bursts
+  up to burst. Buckets live in two float arrays indexed by a slot per machine, so a
+  tracked machine costs a dict entry and 16 bytes
+- A bucket untouched for burst / rate seconds is full again, the same as no bucket, so
+  such buckets are evicted without changing any decision. Sweeps run at most once per
+  that interval, when a new machine needs a slot
+- Once max_machines machines are tracked and none is idle, new machines are admitted
+  without a bucket and counted as untracked
+- InFlightLimit is ASGI middleware answering 503 with Retry-After once max_in_flight
+  requests are being received, validated or answered by this worker
+- Both run on the event loop only, so they take no locks
+"""
+
+import math
+import time
+from array import array
+
+
+class MachineBuckets:
+    """ Token buckets keyed by vending machine id """
+
+    def __init__(self, rate, burst, max_machines):
+        self.rate = rate
+        self.burst = burst
+        self.max_machines = max_machines
+        self.full_after = burst / rate
+        self._slots = {}
+        self._tokens = array("d", bytes(8 * max_machines))
+        self._updated = array("d", bytes(8 * max_machines))
+        self._free = list(range(max_machines - 1, -1, -1))
+        self._next_sweep = 0.0
+        self.admitted = 0
+        self.rejected = 0
+        self.untracked = 0
+        self.evicted = 0
+
+    def admit(self, machine_id, now=None):
+        """ 0 if an event of the machine is admitted, otherwise the seconds until it may retry """
+        if now is None:
+            now = time.monotonic()
+        slot = self._slots.get(machine_id)
+        if slot is None:
+            if not self._free and now >= self._next_sweep:
+                self._sweep(now)
+            if not self._free:
+                self.untracked += 1
+                self.admitted += 1
+                return 0.0
+            slot = self._free.pop()
+            self._slots[machine_id] = slot
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, self._tokens[slot] + (now - self._updated[slot]) * self.rate)
+        self._updated[slot] = now
+        if tokens >= 1:
+            self._tokens[slot] = tokens - 1
+            self.admitted += 1
+            return 0.0
+        self._tokens[slot] = tokens
+        self.rejected += 1
+        return (1 - tokens) / self.rate
+
+    def _sweep(self, now):
+        """ Frees the slots of machines whose buckets have refilled """
+        stale = now - self.full_after
+        idle = [machine_id for machine_id, slot in self._slots.items() if self._updated[slot] <= stale]
+        for machine_id in idle:
+            self._free.append(self._slots.pop(machine_id))
+        self.evicted += len(idle)
+        self._next_sweep = now + self.full_after
+
+    def stats(self):
+        return {"machines": len(self._slots), "admitted": self.admitted, "rejected": self.rejected,
+                "untracked": self.untracked, "evicted": self.evicted}
+
+
+def retry_after(seconds):
+    """ Retry-After header value, whole seconds rounded up """
+    return str(max(1, math.ceil(seconds)))
+
+
+class InFlightGate:
+    """ Count of requests in progress and of those turned away """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.peak = 0
+        self.rejected = 0
+
+    def stats(self):
+        return {"limit": self.limit, "in_flight": self.in_flight, "peak": self.peak, "rejected": self.rejected}
+
+
+class InFlightLimit:
+    """ ASGI middleware rejecting POST requests while the gate is at its limit """
+
+    def __init__(self, app, gate):
+        self.app = app
+        self.gate = gate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+        gate = self.gate
+        if gate.in_flight >= gate.limit:
+            gate.rejected += 1
+            await send({"type": "http.response.start", "status": 503,
+                        "headers": [(b"retry-after", b"1"), (b"content-length", b"0")]})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        gate.in_flight += 1
+        gate.peak = max(gate.peak, gate.in_flight)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            gate.in_flight -= 1
@@ -1,15 +1,23 @@
+import asyncio
+from contextlib import asynccontextmanager
 import connexion
 from connexion import NoContent
 import json
 import yaml
 import logging
-import logging.config
 import uuid
 import datetime
 import os
 import time
-import sys
-from pykafka import KafkaClient
+from collections import deque
+import uvicorn
+from pykafka.exceptions import ProducerQueueFullError
+from connector import BackgroundConnector
+from tracing import sampled, stamp
+from event_bus import bus_name, open_topic
+import log_setup
+from fast_validation import validation_metrics, validator_map
+from admission import InFlightGate, InFlightLimit, MachineBuckets, retry_after
 
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
     print("In Test Environment")
@@ -26,40 +34,178 @@ with open(app_conf_file, 'r') as f:
 # External Logging Configuration
 with open(log_conf_file, 'r') as f:
     log_config = yaml.safe_load(f.read())
-    logging.config.dictConfig(log_config)
+    log_setup.configure(log_config)
 
 logger = logging.getLogger('basicLogger')
+# Per-request lines, sampled as configured in log_conf.yaml
+event_logger = logging.getLogger('basicLogger.events')
 
 logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
 ### KAFKA CONNECTION ###
-hostname = "%s:%d" % (app_config["events"]["hostname"], app_config["events"]["port"])
-retries = app_config["events"]["retries"]
-retry_count = 0
-while retry_count < retries:
+producer = None
+
+# Fraction of events that carry stage timestamps through the pipeline (0 turns tracing off)
+trace_sample_rate = app_config["tracing"]["sample_rate"]
+
+# Events received before Kafka is reachable wait here and are sent once it connects
+pending_events = deque()
+
+# Per-machine rate limit and in-flight limit of this worker, both off when admission.enabled is false
+admission_config = app_config["admission"]
+if admission_config["enabled"]:
+    machine_buckets = MachineBuckets(admission_config["rate"], admission_config["burst"],
+                                     admission_config["max_machines"])
+    in_flight = InFlightGate(admission_config["max_in_flight"])
+else:
+    machine_buckets = None
+    in_flight = None
+
+
+def connect_kafka():
+    """ Connects this worker to Kafka. Runs on the connector thread """
+    topic = open_topic(app_config["events"])
+    # Asynchronous producer: produce() only enqueues, a background thread batches the sends
+    return topic.get_producer(
+        linger_ms=app_config["events"]["linger_ms"],
+        max_queued_messages=app_config["events"]["max_queued_messages"],
+        block_on_queue_full=False
+    )
+
+
+def on_kafka_ready(kafka_producer):
+    global producer
+    producer = kafka_producer
+    flush_pending_events()
+
+
+def flush_pending_events():
+    """ Hands buffered events to the producer. popleft is atomic, so concurrent flushes are safe """
+    flushed = 0
+    while True:
+        try:
+            msg_bytes = pending_events.popleft()
+        except IndexError:
+            break
+        try:
+            producer.produce(msg_bytes)
+        except ProducerQueueFullError:
+            pending_events.appendleft(msg_bytes)
+            logger.error(f"Kafka producer queue is full, {len(pending_events)} events still buffered")
+            break
+        flushed += 1
+    if flushed:
+        logger.info(f"Sent {flushed} events buffered while Kafka was unavailable")
+
+
+kafka = BackgroundConnector(bus_name(app_config["events"]), connect_kafka,
+                            app_config["events"]["sleep_time"],
+                            app_config["events"]["max_sleep_time"],
+                            on_ready=on_kafka_ready)
+
+
+async def retry_pending_events():
+    """ Keeps handing buffered events to the producer after its queue was full, also when no new events arrive """
+    while True:
+        await asyncio.sleep(app_config["events"]["sleep_time"])
+        if producer is not None and pending_events:
+            flush_pending_events()
+
+
+async def drain_pending_events(timeout_sec):
+    """ Flushes the buffer into the producer queue until it is empty or timeout_sec has passed """
+    deadline = time.monotonic() + timeout_sec
+    while pending_events and time.monotonic() < deadline:
+        flush_pending_events()
+        if pending_events:
+            await asyncio.sleep(0.05)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """ Per-worker startup and shutdown hooks """
+    kafka.start()
+    retry_task = asyncio.create_task(retry_pending_events())
+    yield
+    retry_task.cancel()
+    if producer is None:
+        logger.error(f"Shutting down before Kafka connected, dropping {len(pending_events)} buffered events")
+        return
+    # The server has stopped accepting requests; flush what is still buffered and queued before exiting
+    logger.info("Draining Kafka producer")
+    await drain_pending_events(app_config["server"]["graceful_timeout_sec"])
+    if pending_events:
+        logger.error(f"Dropping {len(pending_events)} buffered events the producer did not take in time")
+    await asyncio.to_thread(producer.stop)
+    logger.info("Kafka producer drained")
+
+
+def produce(msg):
+    """ Queues an event for Kafka, returning the status code for the response """
+    if "trace" in msg:
+        stamp(msg["trace"], "produced")
+    msg_bytes = json.dumps(msg).encode('utf-8')
+    # Buffered events go first, so a new event never overtakes them
+    if producer is not None and pending_events:
+        flush_pending_events()
+    if producer is None or pending_events:
+        if len(pending_events) >= app_config["events"]["buffer_size"]:
+            logger.error("Kafka is not available and the buffer is full, rejecting event")
+            return 503
+        pending_events.append(msg_bytes)
+        # Kafka may have connected (and flushed) between the check above and the append
+        if producer is not None:
+            flush_pending_events()
+        return 202
+
     try:
-        logger.debug("Attempting to connect to Kafka at %s", hostname)
-        client = KafkaClient(hosts=hostname)
-        logger.debug("Connected to Kafka at %s", hostname)
-        topic = client.topics[str.encode(app_config["events"]["topic"])]
-        producer = topic.get_sync_producer()
-        retry_count = retries
-        break
-    except Exception as e:
-        time.sleep(app_config["events"]["sleep_time"])
-        retry_count += 1
-        logger.error(f"{e}. {retries-retry_count} out of {retries} retries remaining.")
-    if retry_count == retries:
-        logger.info(f"Can't connect to Kafka. Exiting...")
-        sys.exit()
-
-def get_check():
+        producer.produce(msg_bytes)
+    except ProducerQueueFullError:
+        logger.error("Kafka producer queue is full, rejecting event")
+        return 503
+    return 201
+
+
+async def get_live():
+    return NoContent, 200
+
+
+async def get_ready():
+    if kafka.ready:
+        return NoContent, 200
+    return NoContent, 503
+
+
+async def get_check():
     return NoContent, 200
 
-def add_dispense_record(body):
+
+async def get_metrics():
+    """ Request validation and admission counts of this worker """
+    metrics = {"validation": validation_metrics.stats()}
+    if machine_buckets is not None:
+        metrics["admission"] = {"machines": machine_buckets.stats(), "in_flight": in_flight.stats()}
+    return metrics, 200
+
+
+def admit(body):
+    """ Seconds the sending machine has to wait before its next event, 0 if this one is admitted """
+    if machine_buckets is None:
+        return 0.0
+    wait = machine_buckets.admit(body["vending_machine_id"])
+    if wait:
+        event_logger.info("Rejected event from vending machine %s, over its rate", body["vending_machine_id"])
+    return wait
+
+
+async def add_dispense_record(body):
+    wait = admit(body)
+    if wait:
+        return NoContent, 429, {"Retry-After": retry_after(wait)}
+    trace = {"received": time.time_ns()} if sampled(trace_sample_rate) else None
     trace_id = str(uuid.uuid4())
-    logger.info(f"Received event add_dispense_record request with a trace id of {trace_id}")
+    event_logger.info("Received event add_dispense_record request with a trace id of %s", trace_id)
     body["trace_id"] = trace_id
 
 
@@ -68,17 +214,22 @@ def add_dispense_record(body):
         "datetime" : datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
         "payload": body
     }
-    msg_str = json.dumps(msg)
-    producer.produce(msg_str.encode('utf-8'))
+    if trace is not None:
+        msg["trace"] = trace
+    status = produce(msg)
 
-    logger.info(f"Returned event add_dispense_record response (Id: {trace_id})")
+    event_logger.info("Returned event add_dispense_record response (Id: %s)", trace_id)
 
-    return NoContent, 201
+    return NoContent, status
 
 
-def add_refill_record(body):
+async def add_refill_record(body):
+    wait = admit(body)
+    if wait:
+        return NoContent, 429, {"Retry-After": retry_after(wait)}
+    trace = {"received": time.time_ns()} if sampled(trace_sample_rate) else None
     trace_id=str(uuid.uuid4())
-    logger.info(f"Received event add_refill_record request with a trace id of {trace_id}")
+    event_logger.info("Received event add_refill_record request with a trace id of %s", trace_id)
     body["trace_id"] = trace_id
 
     msg = {
@@ -86,15 +237,29 @@ def add_refill_record(body):
         "datetime" : datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
         "payload": body
     }
-    msg_str = json.dumps(msg)
-    producer.produce(msg_str.encode('utf-8'))
+    if trace is not None:
+        msg["trace"] = trace
+    status = produce(msg)
 
-    logger.info(f"Returned event add_refill_record response (Id: {trace_id})")
+    event_logger.info("Returned event add_refill_record response (Id: %s)", trace_id)
 
-    return NoContent, 201
+    return NoContent, status
 
 
-app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("openapi.yaml", base_path="/receiver", strict_validation=True, validate_responses=True)
+app = connexion.AsyncApp(__name__, specification_dir='', lifespan=lifespan)
+# Compiled validators for the JSON bodies; the generic ones when validation.fast is off
+validators = validator_map(app_config["validation"]) if app_config["validation"]["fast"] else None
+app.add_api("openapi.yaml", base_path="/receiver", strict_validation=True, validate_responses=True,
+            validator_map=validators)
+if in_flight is not None:
+    # Outermost, so requests over the limit are answered before their bodies are read
+    app.add_middleware(InFlightLimit, gate=in_flight)
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8080)
+    if app_config["server"]["mode"] == "production":
+        # Each worker is a separate process with its own Kafka producer, created in lifespan.
+        # On SIGTERM uvicorn stops accepting connections and finishes in-flight requests first.
+        uvicorn.run("app:app", host="0.0.0.0", port=8080,
+                    workers=app_config["server"]["workers"],
+                    timeout_graceful_shutdown=app_config["server"]["graceful_timeout_sec"])
+    else:
+        app.run(host="0.0.0.0", port=8080)
@@ -0,0 +1,82 @@
+"""
+Latency of well-behaved vending machines while one machine floods POST /receiver/dispenses
+
+Normal clients send events for 10000 machines, each machine well under its rate;
+flooding clients send events for a single machine as fast as they can. Run it against
+the receiver with admission.enabled true and false in app_conf.yaml and compare:
+
+    python3 benchmark_admission.py [url] [normal clients] [flooding clients] [duration_sec]
+"""
+
+import datetime
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+import requests
+
+URL = sys.argv[1] if len(sys.argv) > 1 else "http://localhost:8080/receiver/dispenses"
+NORMAL_CLIENTS = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+FLOOD_CLIENTS = int(sys.argv[3]) if len(sys.argv) > 3 else 64
+DURATION_SEC = float(sys.argv[4]) if len(sys.argv) > 4 else 30.0
+MACHINES = 10000
+
+normal_machines = [str(uuid.uuid4()) for _ in range(MACHINES)]
+flooding_machine = str(uuid.uuid4())
+
+
+def dispense_event(machine_id):
+    return {
+        "vending_machine_id": machine_id,
+        "amount_paid": 250,
+        "payment_method": "cash",
+        "transaction_time": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        "item_id": 4033
+    }
+
+
+def client(deadline, machines, latencies, statuses):
+    session = requests.Session()
+    sent = 0
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            status = session.post(URL, json=dispense_event(machines[sent % len(machines)]), timeout=10).status_code
+        except requests.RequestException:
+            status = "error"
+        latencies.append(time.perf_counter() - start)
+        statuses[status] += 1
+        sent += 1
+
+
+def report(name, latencies, statuses, elapsed):
+    latencies.sort()
+    if not latencies:
+        print(f"{name}: no requests")
+        return
+    print(f"{name}: {len(latencies) / elapsed:.0f} req/s, "
+          f"p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms, "
+          f"statuses {dict(statuses)}")
+
+
+normal = ([], Counter())
+flood = ([], Counter())
+deadline = time.monotonic() + DURATION_SEC
+# Each normal client cycles through its own share of the machines
+threads = [threading.Thread(target=client, args=(deadline, normal_machines[i::NORMAL_CLIENTS], *normal))
+           for i in range(NORMAL_CLIENTS)]
+threads += [threading.Thread(target=client, args=(deadline, [flooding_machine], *flood))
+            for _ in range(FLOOD_CLIENTS)]
+started = time.monotonic()
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+elapsed = time.monotonic() - started
+
+print(f"{NORMAL_CLIENTS} clients for {MACHINES} machines, {FLOOD_CLIENTS} clients for one machine, {elapsed:.1f}s")
+report("normal machines", *normal, elapsed)
+report("flooding machine", *flood, elapsed)
@@ -0,0 +1,61 @@
+"""
+Throughput and latency benchmark for POST /receiver/dispenses
+
+Start the receiver in the mode under test (server.mode in app_conf.yaml),
+then run:
+
+    python3 benchmark_receiver.py [url] [concurrency] [duration_sec]
+"""
+
+import datetime
+import sys
+import threading
+import time
+import uuid
+
+import requests
+
+URL = sys.argv[1] if len(sys.argv) > 1 else "http://localhost:8080/receiver/dispenses"
+CONCURRENCY = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+DURATION_SEC = float(sys.argv[3]) if len(sys.argv) > 3 else 30.0
+
+
+def dispense_event():
+    return {
+        "vending_machine_id": str(uuid.uuid4()),
+        "amount_paid": 250,
+        "payment_method": "cash",
+        "transaction_time": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        "item_id": 4033
+    }
+
+
+def client(deadline, latencies, failures):
+    session = requests.Session()
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            response = session.post(URL, json=dispense_event(), timeout=10)
+            ok = response.status_code == 201
+        except requests.RequestException:
+            ok = False
+        latencies.append(time.perf_counter() - start)
+        if not ok:
+            failures.append(1)
+
+
+latencies, failures = [], []
+deadline = time.monotonic() + DURATION_SEC
+threads = [threading.Thread(target=client, args=(deadline, latencies, failures)) for _ in range(CONCURRENCY)]
+started = time.monotonic()
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+elapsed = time.monotonic() - started
+
+latencies.sort()
+print(f"{len(latencies)} requests in {elapsed:.1f}s with {CONCURRENCY} clients, {len(failures)} failed")
+print(f"throughput: {len(latencies) / elapsed:.0f} req/s")
+print(f"latency p50: {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+      f"p99: {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms")
@@ -0,0 +1,227 @@
+"""
+Event bus backends behind the subset of the pykafka topic API the services use
+
+- kafka: the pykafka topic on the configured broker (the default)
+- file: append-only log files in a local directory, with the same offset semantics,
+  for running the pipeline on one machine without a broker
+
+The backend is picked by the EVENT_BUS_URL environment variable, then by
+events.bus_url in app_conf.yaml, e.g. "file:///tmp/pipeline/events".
+Anything else connects to Kafka at events.hostname:events.port.
+"""
+
+import bisect
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+# Same values as pykafka.common.OffsetType
+EARLIEST = -2
+LATEST = -1
+
+# Timestamp in ms and value length in front of every record
+RECORD_HEADER = struct.Struct(">qI")
+POLL_INTERVAL_SEC = 0.01
+
+Message = namedtuple("Message", ["value", "offset", "partition_id", "timestamp"])
+OffsetResponse = namedtuple("OffsetResponse", ["offset", "err"])
+
+
+def bus_url(events_config):
+    return os.environ.get("EVENT_BUS_URL", events_config.get("bus_url", "kafka"))
+
+
+def bus_name(events_config):
+    """ Human readable location of the event bus, for logs """
+    url = bus_url(events_config)
+    if url.startswith("file://"):
+        return f"event log at {url[len('file://'):]}"
+    return f"Kafka at {events_config['hostname']}:{events_config['port']}"
+
+
+def open_topic(events_config):
+    """ Connects to the events topic on the configured backend """
+    url = bus_url(events_config)
+    if url.startswith("file://"):
+        return FileTopic(url[len("file://"):], events_config["topic"], events_config.get("partitions", 1))
+
+    from pykafka import KafkaClient
+    client = KafkaClient(hosts=f"{events_config['hostname']}:{events_config['port']}")
+    return client.topics[str.encode(events_config["topic"])]
+
+
+class FilePartition:
+    """ One partition stored as length-prefixed records in a single file """
+
+    def __init__(self, partition_id, path):
+        self.id = partition_id
+        self.path = path
+        # Append mode makes each record a single atomic write, even from several processes
+        self._write_fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._read_fd = os.open(path, os.O_RDONLY)
+        self._lock = threading.Lock()
+        self._positions = []
+        self._timestamps = []
+        self._indexed_bytes = 0
+
+    def _refresh(self):
+        """ Indexes the records appended since the last call """
+        with self._lock:
+            size = os.fstat(self._read_fd).st_size
+            position = self._indexed_bytes
+            while position + RECORD_HEADER.size <= size:
+                timestamp, length = RECORD_HEADER.unpack(os.pread(self._read_fd, RECORD_HEADER.size, position))
+                if position + RECORD_HEADER.size + length > size:
+                    break  # Record still being written
+                self._positions.append(position)
+                self._timestamps.append(timestamp)
+                position += RECORD_HEADER.size + length
+            self._indexed_bytes = position
+        return len(self._positions)
+
+    def append(self, value):
+        os.write(self._write_fd, RECORD_HEADER.pack(int(time.time() * 1000), len(value)) + value)
+
+    def latest_offset(self):
+        """ Next offset to be written """
+        return self._refresh()
+
+    def read(self, offset):
+        """ The message at offset, or None if it has not been written yet """
+        if offset >= len(self._positions) and offset >= self._refresh():
+            return None
+        position = self._positions[offset]
+        timestamp, length = RECORD_HEADER.unpack(os.pread(self._read_fd, RECORD_HEADER.size, position))
+        value = os.pread(self._read_fd, length, position + RECORD_HEADER.size)
+        return Message(value, offset, self.id, timestamp)
+
+    def fetch_offset_limit(self, offsets_before, max_offsets=1):
+        """ First offset written at or after offsets_before (ms since the epoch) """
+        self._refresh()
+        return OffsetResponse([bisect.bisect_left(self._timestamps, offsets_before)], 0)
+
+
+class FileTopic:
+    """ Topic stored as one log file per partition under directory/topic """
+
+    def __init__(self, directory, topic, num_partitions=1):
+        self.name = topic
+        self.directory = os.path.join(directory, topic)
+        os.makedirs(self.directory, exist_ok=True)
+        self.partitions = {partition_id: FilePartition(partition_id, os.path.join(self.directory, f"{partition_id}.log"))
+                           for partition_id in range(num_partitions)}
+
+    def latest_available_offsets(self):
+        return {partition_id: OffsetResponse([partition.latest_offset()], 0)
+                for partition_id, partition in self.partitions.items()}
+
+    def earliest_available_offsets(self):
+        return {partition_id: OffsetResponse([0], 0) for partition_id in self.partitions}
+
+    def get_simple_consumer(self, consumer_group=None, partitions=None, reset_offset_on_start=False,
+                            auto_offset_reset=EARLIEST, consumer_timeout_ms=-1, **_):
+        return FileConsumer(self, consumer_group, partitions, reset_offset_on_start,
+                            auto_offset_reset, consumer_timeout_ms)
+
+    def get_producer(self, **_):
+        return FileProducer(self)
+
+    get_sync_producer = get_producer
+
+
+class FileProducer:
+    """ Writes synchronously; keyed messages go to a fixed partition, the rest round robin """
+
+    def __init__(self, topic):
+        self._partitions = list(topic.partitions.values())
+        self._next = 0
+
+    def produce(self, message, partition_key=None):
+        if partition_key is not None:
+            partition = self._partitions[zlib.crc32(partition_key) % len(self._partitions)]
+        else:
+            partition = self._partitions[self._next % len(self._partitions)]
+            self._next += 1
+        partition.append(message)
+
+    def stop(self):
+        pass
+
+
+class FileConsumer:
+    """ Reads partitions in turn; committed offsets are kept per consumer group next to the log """
+
+    def __init__(self, topic, consumer_group, partitions, reset_offset_on_start, auto_offset_reset, consumer_timeout_ms):
+        self.topic = topic
+        self._partitions = partitions or list(topic.partitions.values())
+        self._timeout = consumer_timeout_ms / 1000 if consumer_timeout_ms > 0 else None
+        self._offsets_file = None
+        committed = {}
+        if consumer_group is not None:
+            group = consumer_group.decode() if isinstance(consumer_group, bytes) else consumer_group
+            self._offsets_file = os.path.join(topic.directory, f"{group}.offsets")
+            if os.path.isfile(self._offsets_file):
+                with open(self._offsets_file, "r") as offsets_file:
+                    committed = {int(partition_id): offset for partition_id, offset in json.load(offsets_file).items()}
+
+        self._turn = 0
+        self._next_offsets = {}
+        for partition in self._partitions:
+            if partition.id in committed and not reset_offset_on_start:
+                self._next_offsets[partition.id] = committed[partition.id]
+            else:
+                self._next_offsets[partition.id] = self._reset_to(partition, auto_offset_reset)
+
+    @staticmethod
+    def _reset_to(partition, offset):
+        if offset == EARLIEST:
+            return 0
+        if offset == LATEST:
+            return partition.latest_offset()
+        # Like pykafka, an explicit offset is the last one consumed
+        return offset + 1
+
+    def reset_offsets(self, partition_offsets):
+        for partition, offset in partition_offsets:
+            self._next_offsets[partition.id] = self._reset_to(partition, offset)
+
+    @property
+    def held_offsets(self):
+        """ Last offset consumed on every partition, -1 before the first """
+        return {partition_id: offset - 1 for partition_id, offset in self._next_offsets.items()}
+
+    def consume(self, block=True):
+        deadline = None if self._timeout is None else time.monotonic() + self._timeout
+        while True:
+            for _ in range(len(self._partitions)):
+                partition = self._partitions[self._turn % len(self._partitions)]
+                self._turn += 1
+                msg = partition.read(self._next_offsets[partition.id])
+                if msg is not None:
+                    self._next_offsets[partition.id] += 1
+                    return msg
+            if not block or (deadline is not None and time.monotonic() >= deadline):
+                return None
+            time.sleep(POLL_INTERVAL_SEC)
+
+    def __iter__(self):
+        while True:
+            msg = self.consume(block=True)
+            if msg is None:
+                return
+            yield msg
+
+    def commit_offsets(self):
+        if self._offsets_file is None:
+            return
+        tmp_filename = self._offsets_file + ".tmp"
+        with open(tmp_filename, "w") as offsets_file:
+            json.dump(self._next_offsets, offsets_file)
+        os.replace(tmp_filename, self._offsets_file)
+
+    def stop(self):
+        pass
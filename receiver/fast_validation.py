@@ -0,0 +1,165 @@
+"""
+Precompiled JSON body validation for connexion
+
+- Flat object schemas (and arrays of them) made of required fields and
+  string/number/integer/boolean properties are compiled once into a Python function
+  that checks a body without going through jsonschema
+- A body the compiled check accepts is valid. Anything else, and any schema the compiler
+  does not handle, goes through connexion's own validator, so invalid requests get
+  the same 400 and message as before
+- List responses longer than response_max_items are validated on a random sample of
+  response_sample_items items
+- Validation time and counts are kept per process for /metrics
+"""
+
+import random
+import threading
+import time
+
+from connexion.datastructures import MediaTypeDict
+from connexion.validators import VALIDATOR_MAP, JSONRequestBodyValidator, JSONResponseBodyValidator
+from jsonschema import Draft4Validator
+
+FORMAT_CHECKER = Draft4Validator.FORMAT_CHECKER
+
+# Same type semantics as jsonschema's draft 4 checker: booleans are not numbers
+TYPE_CHECKS = {
+    "string": lambda value: isinstance(value, str),
+    "number": lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    "integer": lambda value: isinstance(value, int) and not isinstance(value, bool),
+    "boolean": lambda value: isinstance(value, bool),
+}
+# Keywords that do not affect validation or that the compiled checks implement
+OBJECT_KEYWORDS = {"type", "properties", "required", "description", "example"}
+PROPERTY_KEYWORDS = {"type", "format", "description", "example"}
+ARRAY_KEYWORDS = {"type", "items", "description", "example"}
+
+
+def compile_schema(schema):
+    """ A function telling whether a body is valid, or None if the schema needs the generic validator """
+    if schema.get("type") == "array" and not set(schema) - ARRAY_KEYWORDS and "items" in schema:
+        is_valid_item = compile_schema(schema["items"])
+        if is_valid_item is None:
+            return None
+        return lambda body: type(body) is list and all(is_valid_item(item) for item in body)
+
+    if schema.get("type") != "object" or set(schema) - OBJECT_KEYWORDS:
+        return None
+    checks = []
+    for name, prop in schema.get("properties", {}).items():
+        if set(prop) - PROPERTY_KEYWORDS or prop.get("type") not in TYPE_CHECKS:
+            return None
+        checks.append((name, TYPE_CHECKS[prop["type"]], prop.get("format")))
+    required = tuple(schema.get("required", ()))
+
+    def is_valid(body):
+        if type(body) is not dict:
+            return False
+        for name in required:
+            if name not in body:
+                return False
+        for name, check, fmt in checks:
+            if name in body:
+                value = body[name]
+                if not check(value) or (fmt is not None and not FORMAT_CHECKER.conforms(value, fmt)):
+                    return False
+        return True
+
+    return is_valid
+
+
+class CompiledSchemas:
+    """ Compiled checks by schema; connexion creates validators per request but reuses the schema objects """
+
+    def __init__(self):
+        self._compiled = {}
+        self._lock = threading.Lock()
+
+    def get(self, schema):
+        entry = self._compiled.get(id(schema))
+        if entry is None:
+            with self._lock:
+                # The schema is kept with its check so its id cannot be reused by another object
+                entry = self._compiled[id(schema)] = (schema, compile_schema(schema))
+        return entry[1]
+
+
+class ValidationMetrics:
+    """ Validation counts and time, for requests and responses """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._kinds = {kind: {"validated": 0, "compiled": 0, "generic": 0, "invalid": 0, "sampled": 0,
+                              "total_ms": 0.0} for kind in ("request", "response")}
+
+    def record(self, kind, seconds, compiled, valid, sampled=False):
+        with self._lock:
+            counts = self._kinds[kind]
+            counts["validated"] += 1
+            counts["compiled" if compiled else "generic"] += 1
+            counts["invalid"] += not valid
+            counts["sampled"] += sampled
+            counts["total_ms"] += seconds * 1000
+
+    def stats(self):
+        with self._lock:
+            return {kind: {**counts, "mean_us": counts["total_ms"] * 1000 / counts["validated"]
+                           if counts["validated"] else 0.0}
+                    for kind, counts in self._kinds.items()}
+
+
+compiled_schemas = CompiledSchemas()
+validation_metrics = ValidationMetrics()
+
+
+class FastJSONRequestBodyValidator(JSONRequestBodyValidator):
+    """ Request bodies checked by the compiled schema first """
+
+    def _validate(self, body):
+        started = time.perf_counter()
+        is_valid = compiled_schemas.get(self._schema)
+        if is_valid is not None and is_valid(body):
+            validation_metrics.record("request", time.perf_counter() - started, True, True)
+            return None
+        try:
+            result = super()._validate(body)
+        except Exception:
+            validation_metrics.record("request", time.perf_counter() - started, False, False)
+            raise
+        validation_metrics.record("request", time.perf_counter() - started, False, True)
+        return result
+
+
+class FastJSONResponseBodyValidator(JSONResponseBodyValidator):
+    """ Response bodies checked by the compiled schema first, long lists on a sample """
+
+    max_items = 100
+    sample_items = 20
+
+    def _validate(self, body):
+        started = time.perf_counter()
+        sampled = isinstance(body, list) and len(body) > self.max_items
+        if sampled:
+            body = random.sample(body, self.sample_items)
+        is_valid = compiled_schemas.get(self._schema)
+        if is_valid is not None and is_valid(body):
+            validation_metrics.record("response", time.perf_counter() - started, True, True, sampled)
+            return None
+        try:
+            result = super()._validate(body)
+        except Exception:
+            validation_metrics.record("response", time.perf_counter() - started, False, False, sampled)
+            raise
+        validation_metrics.record("response", time.perf_counter() - started, False, True, sampled)
+        return result
+
+
+def validator_map(validation_config):
+    """ connexion validator_map using the compiled validators for JSON bodies """
+    FastJSONResponseBodyValidator.max_items = validation_config["response_max_items"]
+    FastJSONResponseBodyValidator.sample_items = validation_config["response_sample_items"]
+    body = MediaTypeDict(VALIDATOR_MAP["body"])
+    body["*/*json"] = FastJSONRequestBodyValidator
+    response = MediaTypeDict(VALIDATOR_MAP["response"])
+    response["*/*json"] = FastJSONResponseBodyValidator
+    return {"body": body, "response": response}
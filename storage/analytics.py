@@ -0,0 +1,221 @@
+"""
+Analytical queries over Parquet exports of the dispenses and refills tables
+
+- export() copies the rows added since the last run into new zstd Parquet files, one per
+  batch, named by the first and last id they hold; the highest exported id is the
+  high-water mark, so nothing is tracked outside the files themselves
+- Rows newer than settle_sec are left for the next run, so a transaction that is still
+  committing a lower id is not skipped past
+- Once a table has more than compact_files small files they are merged into one
+- query() runs one group-by/filter/aggregate over a table's files with DuckDB; only
+  whitelisted columns and functions are accepted and values are bound as parameters,
+  so no SQL comes from the request
+"""
+
+import datetime
+import decimal
+import logging
+import os
+import re
+import threading
+import time
+
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import select
+
+from dispenses import DispenseItem
+from refills import RefillItem
+
+logger = logging.getLogger('basicLogger')
+
+FILE_PATTERN = re.compile(r"^(\d+)-(\d+)\.parquet$")
+
+# Per table: the model, the event time column and the columns that can be grouped on, filtered on and aggregated
+TABLES = {
+    "dispenses": {"model": DispenseItem,
+                  "time": "transaction_time",
+                  "group": ("vending_machine_id", "payment_method", "item_id"),
+                  "numeric": ("amount_paid",)},
+    "refills": {"model": RefillItem,
+                "time": "refill_time",
+                "group": ("vending_machine_id", "staff_name", "item_id"),
+                "numeric": ("item_quantity",)},
+}
+AGGREGATES = {"count": "count({})", "count_distinct": "count(DISTINCT {})",
+              "sum": "sum({})", "avg": "avg({})", "min": "min({})", "max": "max({})"}
+TIME_BUCKETS = ("hour", "day", "week", "month")
+
+
+def _json_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return value
+
+
+class AnalyticsStore:
+    """ Parquet exports of the event tables and DuckDB queries over them """
+
+    def __init__(self, analytics_config):
+        self.export_dir = analytics_config["export_dir"]
+        self.batch_rows = analytics_config["batch_rows"]
+        self.settle_sec = analytics_config["settle_sec"]
+        self.compact_files = analytics_config["compact_files"]
+        self.max_rows = analytics_config["max_rows"]
+        self._db = duckdb.connect(config={"threads": analytics_config["threads"],
+                                          "memory_limit": analytics_config["memory_limit"]})
+        # Held while files are listed and read, and while compaction swaps files
+        self._files_lock = threading.Lock()
+        self.exported = {table: 0 for table in TABLES}
+        self.last_export = None
+
+    def _table_dir(self, table):
+        return os.path.join(self.export_dir, table)
+
+    def _files(self, table):
+        """ (first id, last id, path) of every exported file of a table, in id order """
+        directory = self._table_dir(table)
+        if not os.path.isdir(directory):
+            return []
+        files = []
+        for name in os.listdir(directory):
+            match = FILE_PATTERN.match(name)
+            if match:
+                files.append((int(match.group(1)), int(match.group(2)), os.path.join(directory, name)))
+        return sorted(files)
+
+    def high_water(self, table):
+        """ Highest id exported from a table, 0 before the first export """
+        files = self._files(table)
+        return max(last for _, last, _ in files) if files else 0
+
+    def _write(self, table, first, last, arrow_table):
+        filename = os.path.join(self._table_dir(table), f"{first:012d}-{last:012d}.parquet")
+        pq.write_table(arrow_table, filename + ".tmp", compression="zstd")
+        os.replace(filename + ".tmp", filename)
+        return filename
+
+    def export(self, engine):
+        """ Exports the rows added to every table since the last export; returns rows exported per table """
+        settled = datetime.datetime.now() - datetime.timedelta(seconds=self.settle_sec)
+        exported = {}
+        for table, spec in TABLES.items():
+            os.makedirs(self._table_dir(table), exist_ok=True)
+            rows_table = spec["model"].__table__
+            mark = self.high_water(table)
+            exported[table] = 0
+            with engine.connect() as conn:
+                while True:
+                    # Range scan on the primary key from the high-water mark
+                    result = conn.execute(select(rows_table)
+                                          .where(rows_table.c.id > mark, rows_table.c.date_created < settled)
+                                          .order_by(rows_table.c.id).limit(self.batch_rows))
+                    columns = list(result.keys())
+                    rows = result.fetchall()
+                    if not rows:
+                        break
+                    arrays = {column: [row[i] for row in rows] for i, column in enumerate(columns)}
+                    self._write(table, rows[0].id, rows[-1].id, pa.table(arrays))
+                    mark = rows[-1].id
+                    exported[table] += len(rows)
+                    if len(rows) < self.batch_rows:
+                        break
+            self.exported[table] += exported[table]
+            self._compact(table)
+        self.last_export = datetime.datetime.now()
+        return exported
+
+    def _compact(self, table):
+        """ Merges the small files of a table into one once there are more than compact_files of them """
+        small = [(first, last, path) for first, last, path in self._files(table)
+                 if pq.read_metadata(path).num_rows < self.batch_rows]
+        if len(small) <= self.compact_files:
+            return
+        merged = pa.concat_tables([pq.read_table(path) for _, _, path in small])
+        with self._files_lock:
+            self._write(table, small[0][0], small[-1][1], merged)
+            for _, _, path in small:
+                os.remove(path)
+        logger.info(f"Compacted {len(small)} files of {table} into one of {merged.num_rows} rows")
+
+    def query(self, table, group_by=(), aggregates=("count",), start=None, end=None, filters=None, limit=None):
+        """
+        Groups the rows of a table between start and end (datetimes on the event time) that match
+        filters ({column: value}) and computes the aggregates ("count" or "function:column").
+        Raises ValueError for anything outside the whitelist.
+        """
+        if table not in TABLES:
+            raise ValueError(f"Unknown table {table}")
+        if not aggregates:
+            raise ValueError("At least one aggregate is needed")
+        spec = TABLES[table]
+        time_column = spec["time"]
+
+        selects = []
+        groups = []
+        for column in group_by:
+            if column in TIME_BUCKETS:
+                selects.append(f"date_trunc('{column}', {time_column}) AS {column}")
+            elif column in spec["group"]:
+                selects.append(column)
+            else:
+                raise ValueError(f"Cannot group {table} by {column}")
+            groups.append(column)
+
+        names = []
+        for aggregate in aggregates:
+            function, _, column = aggregate.partition(":")
+            if function not in AGGREGATES:
+                raise ValueError(f"Unknown aggregate function {function}")
+            if function == "count" and not column:
+                selects.append("count(*) AS count")
+                names.append("count")
+                continue
+            allowed = spec["numeric"] if function in ("sum", "avg") else spec["group"] + spec["numeric"] + (time_column,)
+            if column not in allowed:
+                raise ValueError(f"Cannot compute {function} of {table}.{column}")
+            selects.append(f"{AGGREGATES[function].format(column)} AS {function}_{column}")
+            names.append(f"{function}_{column}")
+
+        conditions = []
+        parameters = []
+        if start is not None:
+            conditions.append(f"{time_column} >= ?")
+            parameters.append(start)
+        if end is not None:
+            conditions.append(f"{time_column} < ?")
+            parameters.append(end)
+        for column, value in (filters or {}).items():
+            if column not in spec["group"]:
+                raise ValueError(f"Cannot filter {table} on {column}")
+            conditions.append(f"{column} = ?")
+            parameters.append(value)
+
+        limit = min(limit or self.max_rows, self.max_rows)
+        started = time.perf_counter()
+        with self._files_lock:
+            files = [path for _, _, path in self._files(table)]
+            if not files:
+                return {"columns": groups + names, "rows": [], "files": 0, "elapsed_ms": 0.0}
+            paths = ", ".join("'" + path.replace("'", "''") + "'" for path in files)
+            sql = (f"SELECT {', '.join(selects)} FROM read_parquet([{paths}])"
+                   + (f" WHERE {' AND '.join(conditions)}" if conditions else "")
+                   + (f" GROUP BY {', '.join(groups)}" if groups else "")
+                   + f" ORDER BY {names[0]} DESC LIMIT {int(limit)}")
+            cursor = self._db.cursor()
+            try:
+                rows = cursor.execute(sql, parameters).fetchall()
+            finally:
+                cursor.close()
+        return {"columns": groups + names,
+                "rows": [[_json_value(value) for value in row] for row in rows],
+                "files": len(files),
+                "elapsed_ms": (time.perf_counter() - started) * 1000}
+
+    def stats(self):
+        return {table: {"high_water_id": self.high_water(table), "files": len(self._files(table)),
+                        "exported_rows": self.exported[table]}
+                for table in TABLES}
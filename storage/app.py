@@ -1,21 +1,30 @@
 import connexion
 from connexion import NoContent
-from sqlalchemy import create_engine, inspect
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import InterfaceError, OperationalError, SQLAlchemyError
 from sqlalchemy.orm import sessionmaker
 from base import Base
 from dispenses import DispenseItem
 from refills import RefillItem
+from partitions import maintain_partitions
+from connector import BackgroundConnector
+from tracing import TraceRecorder, stamp
+from event_bus import bus_name, open_topic
+import log_setup
+from profiler import SamplingProfiler
+from batching import AdaptiveBatcher, ConsumerLag
+from dead_letter import DeadLetterQueue
+from fast_validation import validation_metrics, validator_map
+from analytics import AnalyticsStore
 from threading import Thread
-from pykafka import KafkaClient
 from pykafka.common import OffsetType
+from apscheduler.schedulers.background import BackgroundScheduler
 import json
 import datetime
+import time
 import logging
-import logging.config
 import yaml
 import os
-import time
-import sys
 
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
     print("In Test Environment")
@@ -32,47 +41,88 @@ with open(app_conf_file, 'r') as f:
 # External Logging Configuration
 with open(log_conf_file, 'r') as f:
     log_config = yaml.safe_load(f.read())
-    logging.config.dictConfig(log_config)
+    log_setup.configure(log_config)
 
 logger = logging.getLogger('basicLogger')
+# Per-event lines, sampled as configured in log_conf.yaml
+event_logger = logging.getLogger('basicLogger.events')
 
 logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
 ### DB CONNECTION ###
-DB_ENGINE = create_engine(
-    f'mysql+pymysql://{app_config["datastore"]["user"]}:{app_config["datastore"]["password"]}@{app_config["datastore"]["hostname"]}:{app_config["datastore"]["port"]}/{app_config["datastore"]["db"]}',
-    pool_recycle=-1,
-    pool_size=0,
-    pool_pre_ping=True
-)
+# DATASTORE_URL or datastore.url (e.g. sqlite:////tmp/events.db for local runs) replaces the MySQL settings
+db_url = os.environ.get("DATASTORE_URL", app_config["datastore"].get(
+    "url",
+    f'mysql+pymysql://{app_config["datastore"]["user"]}:{app_config["datastore"]["password"]}@{app_config["datastore"]["hostname"]}:{app_config["datastore"]["port"]}/{app_config["datastore"]["db"]}'))
+if db_url.startswith("sqlite"):
+    # The consumer thread and the request threads share the SQLite connections
+    DB_ENGINE = create_engine(db_url, connect_args={"check_same_thread": False})
+else:
+    DB_ENGINE = create_engine(
+        db_url,
+        pool_recycle=-1,
+        pool_size=0,
+        pool_pre_ping=True
+    )
 Base.metadata.bind = DB_ENGINE
 DB_SESSION = sessionmaker(bind=DB_ENGINE)
-logger.info(f'Connecting to DB {app_config["datastore"]["hostname"]}. Port: {app_config["datastore"]["port"]}')
+if DB_ENGINE.dialect.name == "sqlite":
+    # MySQL tables are created by create_tables_mysql.py with their partitioning
+    Base.metadata.create_all(DB_ENGINE)
+logger.info(f'Connecting to DB {DB_ENGINE.url.render_as_string(hide_password=True)}')
 
 ### KAFKA CONNECTION ###
-hostname = "%s:%d" % (app_config["events"]["hostname"], app_config["events"]["port"])
-retries = app_config["events"]["retries"]
-retry_count = 0
-while retry_count < retries:
+
+def connect_kafka():
+    """ Connects the event consumer. Runs on the connector thread """
+    topic = open_topic(app_config["events"])
+    return topic.get_simple_consumer(
+        consumer_group=b'event_group',
+        reset_offset_on_start=False,
+        auto_offset_reset=OffsetType.LATEST
+    )
+
+
+kafka = BackgroundConnector(bus_name(app_config["events"]), connect_kafka,
+                            app_config["events"]["sleep_time"],
+                            app_config["events"]["max_sleep_time"])
+
+
+traces = TraceRecorder(app_config["tracing"]["max_traces"])
+
+profiler = SamplingProfiler(app_config["profiler"]["max_seconds"])
+
+# Bigger batches while the consumer is behind, smaller once it has caught up
+batcher = AdaptiveBatcher.from_config(app_config["batching"])
+consumer_lag = ConsumerLag(app_config["batching"]["lag_interval_sec"])
+
+# Malformed events are set aside here instead of stopping the consumer thread
+dead_letters = DeadLetterQueue(app_config["dead_letter"]["filename"])
+consumer_counters = {"stored": 0, "retries": 0, "trace_errors": 0}
+
+# Parquet copies of the tables for analytical queries, refreshed by the scheduler
+analytics = AnalyticsStore(app_config["analytics"])
+
+# Errors worth retrying: the database is unreachable rather than rejecting the row
+TRANSIENT_DB_ERRORS = (OperationalError, InterfaceError)
+
+
+def get_live():
+    return NoContent, 200
+
+
+def get_ready():
+    """ Ready once the consumer is connected and the database answers """
+    if not kafka.ready:
+        return NoContent, 503
     try:
-        logger.debug("Attempting to connect to Kafka at %s", hostname)
-        client = KafkaClient(hosts=hostname)
-        logger.debug("Connected to Kafka at %s", hostname)
-        topic = client.topics[str.encode(app_config["events"]["topic"])]
-        consumer = topic.get_simple_consumer(
-            consumer_group=b'event_group',
-            reset_offset_on_start=False,
-            auto_offset_reset=OffsetType.LATEST
-        )
-        break
+        with DB_ENGINE.connect() as conn:
+            conn.execute(text("SELECT 1"))
     except Exception as e:
-        time.sleep(app_config["events"]["sleep_time"])
-        retry_count += 1
-        logger.error(f"{e}. {retries-retry_count} out of {retries} retries remaining.")
-    if retry_count == retries:
-        logger.info(f"Can't connect to Kafka. Exiting...")
-        sys.exit()
+        logger.error(f"Readiness check could not reach the database: {e}")
+        return NoContent, 503
+    return NoContent, 200
 
 
 def get_event_stats():
@@ -84,23 +134,47 @@ def get_event_stats():
     session.close()
 
     return {'num_dispense': num_dispense,
-            'num_refill': num_refill}, 200
+            'num_refill': num_refill,
+            'consumer': consumer_stats()}, 200
+
+
+def consumer_stats():
+    """ Lag and current batching of the event consumer """
+    return {'lag': consumer_lag.total,
+            'partitions': {str(partition_id): lag for partition_id, lag in consumer_lag.partitions.items()},
+            **batcher.stats(),
+            **consumer_counters,
+            **dead_letters.stats()}
+
+
+def dispense_item(data):
+    """ Row for a dispense event payload """
+    return DispenseItem(data['vending_machine_id'],
+                        data['amount_paid'],
+                        data['payment_method'],
+                        datetime.datetime.strptime(data['transaction_time'], "%Y-%m-%dT%H:%M:%S.%fZ"),
+                        data['item_id'],
+                        data['trace_id'])
+
+
+def refill_item(data):
+    """ Row for a refill event payload """
+    return RefillItem(data['vending_machine_id'],
+                      data['staff_name'],
+                      datetime.datetime.strptime(data['refill_time'], "%Y-%m-%dT%H:%M:%S.%fZ"),
+                      data['item_id'],
+                      data['item_quantity'],
+                      data['trace_id'])
 
 
 def add_dispense_record(body):
     """ Receives a dispense record """
     data=body
     session = DB_SESSION()
-    dr = DispenseItem(data['vending_machine_id'],
-                       data['amount_paid'],
-                       data['payment_method'],
-                       datetime.datetime.strptime(data['transaction_time'], "%Y-%m-%dT%H:%M:%S.%fZ"),
-                       data['item_id'],
-                       data['trace_id'])
-    session.add(dr)
+    session.add(dispense_item(data))
     session.commit()
     session.close()
-    logger.debug(f"Stored event add_dispense_record request with a trace id of {data['trace_id']}")
+    event_logger.debug("Stored event add_dispense_record request with a trace id of %s", data['trace_id'])
 
     return NoContent, 201
 
@@ -110,16 +184,10 @@ def add_refill_record(body):
     """ Receives a refill record """
     session = DB_SESSION()
     data=body
-    rr = RefillItem(data['vending_machine_id'],
-                       data['staff_name'],
-                       datetime.datetime.strptime(data['refill_time'], "%Y-%m-%dT%H:%M:%S.%fZ"),
-                       data['item_id'],
-                       data['item_quantity'],
-                       data['trace_id'])
-    session.add(rr)
+    session.add(refill_item(data))
     session.commit()
     session.close()
-    logger.debug(f"Stored event add_refill_record request with a trace id of {data['trace_id']}")
+    event_logger.debug("Stored event add_refill_record request with a trace id of %s", data['trace_id'])
 
     return NoContent, 201
 
@@ -163,6 +231,7 @@ def get_dispense_record(start_timestamp, end_timestamp):
     end_timestamp_datetime = datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%S")
 
     logger.debug(f"get_dispense_record: Received timestamps between '{start_timestamp_datetime}' and '{end_timestamp_datetime}'")
+    # Plain range predicates on date_created let MySQL prune to the partitions covering the range
     results = session.query(DispenseItem).filter(end_timestamp_datetime > DispenseItem.date_created).filter(DispenseItem.date_created >= start_timestamp_datetime)
     results_list = []
     for reading in results:
@@ -172,26 +241,233 @@ def get_dispense_record(start_timestamp, end_timestamp):
 
     return results_list, 200
 
+def decode_message(msg):
+    """ Row, trace and trace_id of an event message; raises ValueError, KeyError or TypeError if malformed """
+    event = json.loads(msg.value)
+    payload = event["payload"]
+    if event["type"] == "dispense":
+        row = dispense_item(payload)
+    elif event["type"] == "refill":
+        row = refill_item(payload)
+    else:
+        raise ValueError(f"Unknown event type {event['type']!r}")
+    event_logger.debug("Message: %s", event)
+    return row, event.get("trace"), payload["trace_id"]
+
+
+def write_rows(rows):
+    """ Commits rows in one transaction, retrying a few times if the database is unreachable """
+    for attempt in range(app_config["dead_letter"]["max_retries"] + 1):
+        session = DB_SESSION()
+        try:
+            session.add_all(rows)
+            session.commit()
+            return
+        except TRANSIENT_DB_ERRORS:
+            session.rollback()
+            if attempt == app_config["dead_letter"]["max_retries"]:
+                raise
+            consumer_counters["retries"] += 1
+            time.sleep(app_config["dead_letter"]["retry_backoff_ms"] * 2 ** attempt / 1000)
+        finally:
+            session.close()
+
+
+def decode_messages(messages):
+    """ Rows of a batch of event messages, dead-lettering the malformed ones """
+    decoded = []
+    for msg in messages:
+        try:
+            row, trace, trace_id = decode_message(msg)
+            if trace is not None:
+                stamp(trace, "consumed")
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Dead-lettering message at offset {msg.offset}: {e}")
+            dead_letters.put(msg, e)
+            continue
+        decoded.append((msg, row, trace, trace_id))
+    return decoded
+
+
+def record_stored(decoded):
+    """ Counts and traces committed rows. Never raises: the rows are stored whatever happens here """
+    consumer_counters["stored"] += len(decoded)
+    for msg, _, trace, trace_id in decoded:
+        if trace is None:
+            continue
+        try:
+            stamp(trace, "persisted")
+            traces.record(trace_id, trace)
+        except Exception as e:
+            consumer_counters["trace_errors"] += 1
+            logger.error(f"Could not record the trace of the message at offset {msg.offset}: {e}")
+
+
+def store_rows(decoded):
+    """
+    Stores decoded messages, dead-lettering the rows the database rejects.
+    Takes items off the front of decoded as they are done, so a call interrupted by
+    a connection error can be repeated without storing anything twice.
+    """
+    try:
+        write_rows([row for _, row, _, _ in decoded])
+    except TRANSIENT_DB_ERRORS:
+        raise
+    except SQLAlchemyError:
+        # A single bad row fails the whole transaction; store the rows one by one to find it
+        while decoded:
+            msg = decoded[0][0]
+            try:
+                write_rows([decoded[0][1]])
+                record_stored(decoded[:1])
+            except TRANSIENT_DB_ERRORS:
+                raise
+            except SQLAlchemyError as e:
+                logger.error(f"Dead-lettering message at offset {msg.offset}: {e}")
+                dead_letters.put(msg, e)
+            decoded.pop(0)
+        return
+    record_stored(decoded)
+    decoded.clear()
+
+
 def process_messages():
-    """ Process event messages """
-    for msg in consumer:
-        msg_str = msg.value.decode('utf-8')
-        msg = json.loads(msg_str)
-        logger.info("Message: %s" % msg)
-        payload = msg["payload"]
-        logger.info(f"Consumer received msg of type {msg['type']}.")
+    """ Process event messages in batches sized by the consumer lag """
+    consumer = kafka.wait()
+    while True:
+        try:
+            lag = consumer_lag.update(consumer)
+        except Exception as e:
+            # Batching goes on with the previous partition heads until the next refresh
+            logger.error(f"Could not refresh the partition heads: {e}")
+            lag = consumer_lag.total
+        if batcher.update(lag):
+            logger.info(f"Consumer lag is {lag}, batch size now {batcher.size} with {batcher.linger_ms} ms linger")
+        try:
+            messages = batcher.collect(consumer)
+        except Exception as e:
+            logger.error(f"Could not read events from Kafka, retrying in {app_config['events']['sleep_time']}s: {e}")
+            time.sleep(app_config["events"]["sleep_time"])
+            continue
+        if not messages:
+            continue
+        try:
+            decoded = decode_messages(messages)
+            while decoded:
+                try:
+                    store_rows(decoded)
+                except TRANSIENT_DB_ERRORS as e:
+                    # Nothing is lost while the database is down: hold the batch and its offsets until it is back
+                    logger.error(f"Database unavailable, retrying {len(decoded)} events: {e}")
+                    time.sleep(app_config["events"]["sleep_time"])
+        except Exception as e:
+            logger.exception(f"Dead-lettering a batch of {len(messages)} events after an unexpected error")
+            for msg in messages:
+                dead_letters.put(msg, e)
+        event_logger.info("Processed a batch of %d events", len(messages))
+        try:
+            consumer.commit_offsets()
+        except Exception as e:
+            # The held offsets stay ahead and go out with the next commit
+            logger.error(f"Could not commit offsets, retrying after the next batch: {e}")
+
+
+def get_trace(trace_id):
+    """ Gets the stage timestamps of a sampled event """
+    trace = traces.lookup(trace_id)
+    if trace is None:
+        return {"message": f"No trace recorded for {trace_id}"}, 404
+    return trace, 200
+
+
+def get_trace_summary():
+    """ Gets latency percentiles of every pipeline hop """
+    return traces.summary(), 200
+
+
+def get_profile(seconds=10, interval_ms=10):
+    """ Samples every thread, including the consumer and scheduler threads, as collapsed stacks """
+    if not app_config["profiler"]["enabled"]:
+        return {"message": "Profiling is disabled"}, 404
+    result = profiler.capture(seconds, interval_ms)
+    if result is None:
+        return {"message": "A profile is already being captured"}, 409
+    stacks, samples = result
+    logger.info(f"Captured a profile of {samples} samples")
+    return stacks, 200, {"Content-Type": "text/plain"}
+
+
+def get_metrics():
+    """ Gets the request and response validation counts and time of this process """
+    return {"validation": validation_metrics.stats()}, 200
+
+
+def get_analytics(table, aggregate, group_by=None, start_timestamp=None, end_timestamp=None,
+                  vending_machine_id=None, payment_method=None, staff_name=None, item_id=None, limit=None):
+    """ Runs a group-by/aggregate query over the Parquet export of a table """
+    try:
+        start = datetime.datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%S") if start_timestamp else None
+        end = datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%S") if end_timestamp else None
+    except ValueError:
+        return {"message": "Timestamps must be formatted as YYYY-MM-DDTHH:MM:SS"}, 400
+    filters = {column: value for column, value in (("vending_machine_id", vending_machine_id),
+                                                   ("payment_method", payment_method),
+                                                   ("staff_name", staff_name),
+                                                   ("item_id", item_id)) if value is not None}
+    try:
+        result = analytics.query(table, group_by or [], aggregate, start, end, filters, limit)
+    except ValueError as e:
+        return {"message": str(e)}, 400
+    logger.info(f"Analytics query on {table} returned {len(result['rows'])} rows in {result['elapsed_ms']:.0f} ms")
+    return {**result, "high_water_id": analytics.high_water(table)}, 200
+
+
+def get_analytics_status():
+    """ Gets the export progress of every table """
+    return {"tables": analytics.stats(),
+            "last_export": analytics.last_export.strftime("%Y-%m-%dT%H:%M:%S") if analytics.last_export else None}, 200
+
+
+def run_analytics_export():
+    """ Called periodically """
+    try:
+        exported = analytics.export(DB_ENGINE)
+    except Exception as e:
+        logger.error(f"Analytics export failed: {e}")
+        return
+    logger.info(f"Exported new rows for analytics: {exported}")
+
+
+def run_partition_maintenance():
+    """ Called periodically """
+    logger.info("Start Partition Maintenance")
+    try:
+        maintain_partitions(DB_ENGINE, app_config["partitioning"])
+    except Exception as e:
+        logger.error(f"Partition maintenance failed: {e}")
+    logger.info("Ended Partition Maintenance")
+
+
+def init_scheduler():
+    sched = BackgroundScheduler(daemon=True)
+    if DB_ENGINE.dialect.name == "mysql":
+        # First run at startup, so today's and the upcoming partitions exist before the first period ends
+        sched.add_job(run_partition_maintenance, 'interval', seconds=app_config['partitioning']['period_sec'],
+                      next_run_time=datetime.datetime.now())
+    sched.add_job(run_analytics_export, 'interval', seconds=app_config['analytics']['period_sec'])
 
-        if msg["type"] == "dispense":
-            add_dispense_record(payload)
-        elif msg["type"] == "refill":
-            add_refill_record(payload)
-        consumer.commit_offsets()
+    sched.start()
 
 
 app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("openapi.yml", base_path="/storage", strict_validation=True, validate_responses=True)
+# Compiled validators for the JSON bodies; the generic ones when validation.fast is off
+validators = validator_map(app_config["validation"]) if app_config["validation"]["fast"] else None
+app.add_api("openapi.yml", base_path="/storage", strict_validation=True, validate_responses=True,
+            validator_map=validators)
 if __name__ == "__main__":
+    kafka.start()
     t1 = Thread(target=process_messages)
     t1.setDaemon(True)
     t1.start()
+    init_scheduler()
     app.run(host="0.0.0.0", port=8090)
@@ -0,0 +1,95 @@
+"""
+Consumer lag tracking and lag-driven batching
+
+- ConsumerLag compares the head of every partition with the consumer's position;
+  the heads are fetched from the broker every interval_sec, the position is read locally every call;
+  a failed fetch raises and keeps the previous heads until the next interval
+- AdaptiveBatcher doubles the batch size and linger while the lag is more than twice the batch,
+  for throughput, and halves them once the lag drops under half a batch, for latency
+"""
+
+import time
+
+POLL_INTERVAL_SEC = 0.001
+
+
+class ConsumerLag:
+    """ Messages between the consumer's position and the head of each partition """
+
+    def __init__(self, interval_sec):
+        self.interval_sec = interval_sec
+        self.heads = {}
+        self.partitions = {}
+        self._next_refresh = 0
+
+    def update(self, consumer):
+        """ Refreshes the lag of a consumer and returns the total over all partitions """
+        now = time.monotonic()
+        if now >= self._next_refresh:
+            # Set first, so a failed fetch keeps the previous heads and is not retried until the next interval
+            self._next_refresh = now + self.interval_sec
+            self.heads = {partition_id: response.offset[0]
+                          for partition_id, response in consumer.topic.latest_available_offsets().items()}
+        # held_offsets are the last offsets consumed, -1 before the first one
+        held = consumer.held_offsets
+        self.partitions = {partition_id: max(head - held.get(partition_id, -1) - 1, 0)
+                           for partition_id, head in self.heads.items()}
+        return self.total
+
+    @property
+    def total(self):
+        return sum(self.partitions.values())
+
+
+class AdaptiveBatcher:
+    """ Batch size and linger between configured bounds; fixed at the lower bounds when not adaptive """
+
+    def __init__(self, min_size, max_size, min_linger_ms, max_linger_ms, adaptive=True):
+        self.min_size, self.max_size = min_size, max_size
+        self.min_linger_ms, self.max_linger_ms = min_linger_ms, max_linger_ms
+        self.adaptive = adaptive
+        self.size = min_size
+        self.linger_ms = min_linger_ms
+
+    @classmethod
+    def from_config(cls, batching_config):
+        return cls(batching_config["min_size"], batching_config["max_size"],
+                   batching_config["min_linger_ms"], batching_config["max_linger_ms"],
+                   batching_config["adaptive"])
+
+    def update(self, lag):
+        """ Resizes for the current lag; returns True when the size changed """
+        if not self.adaptive:
+            return False
+        size = self.size
+        if lag > 2 * self.size:
+            self.size = min(self.size * 2, self.max_size)
+            self.linger_ms = min(self.linger_ms * 2, self.max_linger_ms)
+        elif lag < self.size // 2:
+            self.size = max(self.size // 2, self.min_size)
+            self.linger_ms = max(self.linger_ms // 2, self.min_linger_ms)
+        return self.size != size
+
+    def collect(self, consumer):
+        """ Up to size messages, waiting at most linger_ms after the first one for the rest """
+        msg = consumer.consume(block=True)
+        if msg is None:
+            return []
+        batch = [msg]
+        deadline = time.monotonic() + self.linger_ms / 1000
+        while len(batch) < self.size:
+            try:
+                msg = consumer.consume(block=False)
+            except Exception:
+                # The messages already consumed are returned rather than lost; the error recurs on the next call
+                break
+            if msg is not None:
+                batch.append(msg)
+            elif time.monotonic() >= deadline:
+                break
+            else:
+                time.sleep(POLL_INTERVAL_SEC)
+        return batch
+
+    def stats(self):
+        return {"batch_size": self.size, "linger_ms": self.linger_ms, "adaptive": self.adaptive}
@@ -0,0 +1,93 @@
+"""
+Benchmark of typical analytics group-by queries over Parquet exports
+
+Writes synthetic dispenses (10000 machines, 50 items, 30 days) straight into Parquet
+files laid out like the analytics export, in a temporary directory, then times
+AnalyticsStore.query for a few dashboard-style questions.
+
+    python3 benchmark_analytics.py [rows] [rows per file]
+"""
+
+import datetime
+import os
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import yaml
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000_000
+ROWS_PER_FILE = int(sys.argv[2]) if len(sys.argv) > 2 else 5_000_000
+MACHINES = 10000
+DAYS = 30
+QUERY_RUNS = 3
+
+if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
+    APP_CONF_FILE = "/config/app_conf.yaml"
+else:
+    APP_CONF_FILE = "app_conf.yaml"
+
+with open(APP_CONF_FILE, 'r', encoding="utf-8") as app_file:
+    APP_CONFIG = yaml.safe_load(app_file.read())
+
+from analytics import AnalyticsStore  # noqa: E402
+
+now = datetime.datetime.now().replace(microsecond=0)
+machine_ids = pa.array([str(uuid.UUID(int=index)) for index in range(MACHINES)])
+payment_methods = pa.array(["cash", "card", "mobile"])
+
+
+def dispenses(first_id, count, rng):
+    """ count synthetic dispense rows with ids from first_id """
+    ids = np.arange(first_id, first_id + count, dtype=np.int64)
+    created = np.datetime64(now - datetime.timedelta(days=DAYS), "us") + \
+        rng.integers(0, DAYS * 86400 * 10**6, count).astype("timedelta64[us]")
+    return pa.table({
+        "id": ids,
+        "vending_machine_id": machine_ids.take(rng.integers(0, MACHINES, count)),
+        "amount_paid": rng.integers(100, 500, count),
+        "payment_method": payment_methods.take(rng.integers(0, 3, count)),
+        "transaction_time": pa.array(created),
+        "item_id": rng.integers(1000, 1050, count),
+        "date_created": pa.array(created),
+        "trace_id": pc.cast(pa.array(ids), pa.string()),
+    })
+
+
+store = AnalyticsStore({**APP_CONFIG["analytics"], "export_dir": tempfile.mkdtemp()})
+os.makedirs(store._table_dir("dispenses"))
+rng = np.random.default_rng(0)
+started = time.monotonic()
+for first_id in range(1, ROWS + 1, ROWS_PER_FILE):
+    count = min(ROWS_PER_FILE, ROWS + 1 - first_id)
+    store._write("dispenses", first_id, first_id + count - 1, dispenses(first_id, count, rng))
+size = sum(os.path.getsize(path) for _, _, path in store._files("dispenses"))
+print(f"wrote {ROWS} rows in {len(store._files('dispenses'))} files ({size / 2**20:.0f} MB) "
+      f"in {time.monotonic() - started:.1f}s")
+
+week_ago = now - datetime.timedelta(days=7)
+QUERIES = {
+    "revenue per payment method per machine, last week":
+        dict(group_by=["payment_method", "vending_machine_id"], aggregates=["sum:amount_paid"], start=week_ago),
+    "dispenses and revenue per day":
+        dict(group_by=["day"], aggregates=["count", "sum:amount_paid"]),
+    "top items by dispenses":
+        dict(group_by=["item_id"], aggregates=["count", "avg:amount_paid"], limit=10),
+    "one machine per day, last week":
+        dict(group_by=["day"], aggregates=["count", "sum:amount_paid"], start=week_ago,
+             filters={"vending_machine_id": str(uuid.UUID(int=42))}),
+    "distinct machines per payment method":
+        dict(group_by=["payment_method"], aggregates=["count_distinct:vending_machine_id"]),
+}
+
+for name, query in QUERIES.items():
+    timings = []
+    for _ in range(QUERY_RUNS):
+        result = store.query("dispenses", **query)
+        timings.append(result["elapsed_ms"])
+    print(f"{name:55} {statistics.median(timings):8.0f} ms  ({len(result['rows'])} rows)")
@@ -0,0 +1,84 @@
+"""
+Burst catch-up benchmark for the storage consumer, fixed vs adaptive batching
+
+Runs storage's consumer loop in this process against a file-backed event log
+and a SQLite database in a temporary directory, then for each batching mode:
+- injects a burst of events and reports how long the consumer takes to catch up
+- sends single events at a low rate and reports how long each takes to be stored
+
+    python3 benchmark_burst.py [burst size] [trickle events]
+"""
+
+import datetime
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import uuid
+from threading import Thread
+
+BURST = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+TRICKLE = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+directory = tempfile.mkdtemp()
+os.environ["EVENT_BUS_URL"] = f"file://{os.path.join(directory, 'bus')}"
+os.environ["DATASTORE_URL"] = f"sqlite:///{os.path.join(directory, 'events.db')}"
+
+import app as storage  # noqa: E402 (the backends are picked from the environment at import)
+from batching import AdaptiveBatcher  # noqa: E402
+from event_bus import open_topic  # noqa: E402
+
+logging.getLogger("basicLogger").setLevel(logging.WARNING)
+
+
+def event(index):
+    now = datetime.datetime.now()
+    payload = {"vending_machine_id": str(uuid.UUID(int=index % 1000)), "item_id": 1000 + index % 50,
+               "trace_id": str(uuid.uuid4())}
+    if index % 2:
+        payload.update(staff_name="Benchmark", refill_time=now.strftime("%Y-%m-%dT%H:%M:%S.%fZ"), item_quantity=5)
+        msg_type = "refill"
+    else:
+        payload.update(amount_paid=250, payment_method="cash", transaction_time=now.strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
+        msg_type = "dispense"
+    return json.dumps({"type": msg_type, "datetime": now.strftime("%Y-%m-%dT%H:%M:%S"), "payload": payload}).encode()
+
+
+def consumed_up_to(consumer, offset):
+    while consumer.held_offsets[0] < offset:
+        time.sleep(0.001)
+
+
+topic = open_topic(storage.app_config["events"])
+producer = topic.get_producer()
+storage.kafka.start()
+consumer = storage.kafka.wait()
+Thread(target=storage.process_messages, daemon=True).start()
+
+for adaptive in (False, True):
+    storage.batcher = AdaptiveBatcher.from_config({**storage.app_config["batching"], "adaptive": adaptive})
+    mode = "adaptive" if adaptive else "fixed"
+
+    start = time.monotonic()
+    for index in range(BURST):
+        producer.produce(event(index))
+    injected = time.monotonic() - start
+    consumed_up_to(consumer, topic.latest_available_offsets()[0].offset[0] - 1)
+    elapsed = time.monotonic() - start
+    print(f"{mode:>8}: burst of {BURST} injected in {injected:.1f}s, caught up after {elapsed:.1f}s "
+          f"({BURST / elapsed:.0f} events/s), peak batch size {storage.batcher.size}")
+
+    # Let the batcher shrink back before measuring latency
+    time.sleep(2 * storage.app_config["batching"]["lag_interval_sec"])
+    latencies = []
+    for index in range(TRICKLE):
+        start = time.monotonic()
+        producer.produce(event(index))
+        consumed_up_to(consumer, topic.latest_available_offsets()[0].offset[0] - 1)
+        latencies.append((time.monotonic() - start) * 1000)
+        time.sleep(0.05)
+    latencies.sort()
+    print(f"{mode:>8}: trickle latency p50 {latencies[len(latencies) // 2]:.1f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)]:.1f} ms, batch size {storage.batcher.size}")
@@ -0,0 +1,95 @@
+"""
+Consumer throughput benchmark with logging enabled
+
+Runs storage's consumer loop in this process against a file-backed event log and
+a SQLite database in a temporary directory, and reports how many events per second
+it stores from a burst under each logging setup:
+- off: basicLogger at WARNING
+- sync: log_conf.yaml handlers writing on the consumer thread, every event line kept
+- queued: handlers on a listener thread, every event line kept
+- sampled: handlers on a listener thread and per-event lines sampled (log_conf.yaml as shipped)
+
+Log lines go to a file in the temporary directory and to /dev/null instead of the console.
+
+    python3 benchmark_logging.py [burst size]
+"""
+
+import copy
+import datetime
+import json
+import logging
+import logging.config
+import os
+import sys
+import tempfile
+import time
+import uuid
+from threading import Thread
+
+import yaml
+
+BURST = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+directory = tempfile.mkdtemp()
+os.environ["EVENT_BUS_URL"] = f"file://{os.path.join(directory, 'bus')}"
+os.environ["DATASTORE_URL"] = f"sqlite:///{os.path.join(directory, 'events.db')}"
+
+import app as storage  # noqa: E402 (the backends are picked from the environment at import)
+import log_setup  # noqa: E402
+from event_bus import open_topic  # noqa: E402
+
+with open(storage.log_conf_file, 'r') as f:
+    LOG_CONFIG = yaml.safe_load(f.read())
+LOG_CONFIG["handlers"]["file"]["filename"] = os.path.join(directory, "app.log")
+devnull = open(os.devnull, "w")
+
+
+def event(index):
+    now = datetime.datetime.now()
+    payload = {"vending_machine_id": str(uuid.UUID(int=index % 1000)), "item_id": 1000 + index % 50,
+               "trace_id": str(uuid.uuid4())}
+    if index % 2:
+        payload.update(staff_name="Benchmark", refill_time=now.strftime("%Y-%m-%dT%H:%M:%S.%fZ"), item_quantity=5)
+        msg_type = "refill"
+    else:
+        payload.update(amount_paid=250, payment_method="cash", transaction_time=now.strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
+        msg_type = "dispense"
+    return json.dumps({"type": msg_type, "datetime": now.strftime("%Y-%m-%dT%H:%M:%S"), "payload": payload}).encode()
+
+
+def consumed_up_to(consumer, offset):
+    while consumer.held_offsets[0] < offset:
+        time.sleep(0.001)
+
+
+def apply_logging(mode):
+    log_setup.stop()
+    config = copy.deepcopy(LOG_CONFIG)
+    config["handlers"]["console"]["stream"] = devnull
+    if mode in ("sync", "queued", "off"):
+        del config["loggers"]["basicLogger.events"]["filters"]
+    if mode in ("sync", "off"):
+        logging.config.dictConfig(config)
+    else:
+        log_setup.configure(config)
+    if mode == "off":
+        logging.getLogger("basicLogger").setLevel(logging.WARNING)
+
+
+topic = open_topic(storage.app_config["events"])
+producer = topic.get_producer()
+storage.kafka.start()
+consumer = storage.kafka.wait()
+Thread(target=storage.process_messages, daemon=True).start()
+
+for mode in ("off", "sync", "queued", "sampled"):
+    apply_logging(mode)
+    start = time.monotonic()
+    for index in range(BURST):
+        producer.produce(event(index))
+    consumed_up_to(consumer, topic.latest_available_offsets()[0].offset[0] - 1)
+    elapsed = time.monotonic() - start
+    print(f"{mode:>8}: {BURST} events stored in {elapsed:.1f}s ({BURST / elapsed:.0f} events/s)")
+    # Let the batcher shrink back so every mode starts from the same batch size
+    time.sleep(2 * storage.app_config["batching"]["lag_interval_sec"])
+log_setup.stop()
@@ -0,0 +1,65 @@
+"""
+Response validation benchmark for GET /dispenses, generic connexion validators vs compiled schemas
+
+Serves the storage API twice in this process, once with connexion's own validators and
+once with the validator_map from fast_validation (compiled schemas, long lists validated
+on a sample), over a SQLite database in a temporary directory holding the given number
+of dispenses. Reports requests per second for a range query returning all of them.
+
+    python3 benchmark_validation.py [rows] [requests]
+"""
+
+import datetime
+import logging
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+import connexion
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+REQUESTS = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+directory = tempfile.mkdtemp()
+os.environ["EVENT_BUS_URL"] = f"file://{os.path.join(directory, 'bus')}"
+os.environ["DATASTORE_URL"] = f"sqlite:///{os.path.join(directory, 'events.db')}"
+
+import app as storage  # noqa: E402 (the backends are picked from the environment at import)
+from fast_validation import validation_metrics, validator_map  # noqa: E402
+
+logging.getLogger("basicLogger").setLevel(logging.WARNING)
+
+
+def build_app(validators):
+    app = connexion.FlaskApp("app", specification_dir="")
+    app.add_api("openapi.yml", base_path="/storage", strict_validation=True, validate_responses=True,
+                validator_map=validators)
+    return app
+
+
+def run(name, app):
+    end = (datetime.datetime.now() + datetime.timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%S")
+    query = {"start_timestamp": "2000-01-01T00:00:00", "end_timestamp": end}
+    with app.test_client() as client:
+        started = time.perf_counter()
+        for _ in range(REQUESTS):
+            response = client.get("/storage/dispenses", params=query)
+            assert response.status_code == 200 and len(response.json()) == ROWS
+        elapsed = time.perf_counter() - started
+    print(f"{name:>8}: {REQUESTS / elapsed:.1f} req/s for {ROWS} dispenses per response")
+
+
+now = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+session = storage.DB_SESSION()
+session.add_all(storage.dispense_item({"vending_machine_id": str(uuid.uuid4()), "amount_paid": 250,
+                                       "payment_method": "cash", "transaction_time": now,
+                                       "item_id": 1000 + index % 50, "trace_id": str(uuid.uuid4())})
+                for index in range(ROWS))
+session.commit()
+session.close()
+
+run("generic", build_app(None))
+run("compiled", build_app(validator_map(storage.app_config["validation"])))
+print(validation_metrics.stats()["response"])
@@ -3,6 +3,7 @@ import yaml
 import logging
 import os
 import logging.config
+from partitions import partition_clause
 
 # Environment-based configuration file paths
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
@@ -29,7 +30,8 @@ db_conn = mysql.connector.connect(host=APP_CONFIG["datastore"]["hostname"], user
 
 logger.info(f'Connecting to DB {APP_CONFIG["datastore"]["hostname"]}. Port: {APP_CONFIG["datastore"]["port"]}')
 
-logger.debug(f'Created table "dispenses"')
+# The partitioning column has to be part of every unique key, so date_created joins the primary key
+PARTITION_CLAUSE = partition_clause(APP_CONFIG["partitioning"]["interval"], APP_CONFIG["partitioning"]["premake"])
 
 db_cursor = db_conn.cursor()
 db_cursor.execute('''
@@ -42,8 +44,10 @@ db_cursor.execute('''
            item_id INTEGER NOT NULL,
            date_created DATETIME NOT NULL,
            trace_id VARCHAR(250) NOT NULL,
-           CONSTRAINT dispenses_pk PRIMARY KEY (id))
-          ''')
+           CONSTRAINT dispenses_pk PRIMARY KEY (id, date_created))
+          ''' + PARTITION_CLAUSE)
+
+logger.debug(f'Created table "dispenses"')
 
 db_cursor.execute('''
           CREATE TABLE refills
@@ -55,8 +59,8 @@ db_cursor.execute('''
            item_quantity INTEGER NOT NULL,
            date_created DATETIME NOT NULL,
            trace_id VARCHAR(250) NOT NULL,
-           CONSTRAINT refills_pk PRIMARY KEY (id))
-          ''')
+           CONSTRAINT refills_pk PRIMARY KEY (id, date_created))
+          ''' + PARTITION_CLAUSE)
 
 logger.debug(f'Created table "refills"')
 
@@ -9,14 +9,15 @@ class DispenseItem(Base):
 
     __tablename__ = "dispenses"
 
+    # id alone identifies a row; SQLite only auto-increments a single integer primary key
     id = Column(Integer, primary_key=True, autoincrement=True)
-    vending_machine_id = Column(String(250), primary_key=True)
+    vending_machine_id = Column(String(250), nullable=False)
     amount_paid = Column(Integer, nullable=False)
     payment_method = Column(String(100), nullable=False)
     transaction_time = Column(DateTime, nullable=False)
     item_id = Column(Integer, nullable=False)
     date_created = Column(DateTime, nullable=False)
-    trace_id = Column(String(250), primary_key=True)
+    trace_id = Column(String(250), nullable=False)
 
     def __init__(self, vending_machine_id, amount_paid, payment_method, transaction_time, item_id, trace_id):
         """ Initializes a dispense record """
@@ -0,0 +1,90 @@
+"""
+Logging setup that keeps formatting and writes off the request and consumer threads
+
+- configure() applies log_conf.yaml, then puts the handlers of every configured logger
+  behind a queue: the logging thread only merges the message and queues the record,
+  a listener thread formats it and writes it to the console and file
+- SamplingFilter caps per-event log lines. Attached to a logger in log_conf.yaml with the
+  "()" factory key, it passes up to rate records per second (bursts up to burst) and
+  one in sample_every beyond that. Warnings and errors always pass
+"""
+
+import atexit
+import logging
+import logging.config
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+_listeners = []
+
+
+class LocalQueueHandler(QueueHandler):
+    """ Queues records for a listener in this process, leaving the formatting to the listener """
+
+    def prepare(self, record):
+        # Merge the arguments now so later changes to them do not show in the log;
+        # timestamps and tracebacks are formatted on the listener thread
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """ Token bucket of rate records per second, then one record in sample_every """
+
+    def __init__(self, rate=10, burst=100, sample_every=100):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample_every = sample_every
+        self.passed = 0
+        self.dropped = 0
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._over = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                keep = True
+            else:
+                self._over += 1
+                keep = bool(self.sample_every) and self._over % self.sample_every == 0
+            if keep:
+                self.passed += 1
+            else:
+                self.dropped += 1
+            return keep
+
+
+def configure(log_config):
+    """ dictConfig, with the handlers of each configured logger moved to a listener thread """
+    logging.config.dictConfig(log_config)
+    names = list(log_config.get("loggers", {})) + ([""] if "root" in log_config else [])
+    for name in names:
+        logger = logging.getLogger(name)
+        if not logger.handlers:
+            continue
+        records = queue.SimpleQueue()
+        listener = QueueListener(records, *logger.handlers, respect_handler_level=True)
+        logger.handlers = [LocalQueueHandler(records)]
+        listener.start()
+        _listeners.append(listener)
+
+
+def stop():
+    """ Writes out the queued records and stops the listener threads """
+    while _listeners:
+        _listeners.pop().stop()
+
+
+atexit.register(stop)
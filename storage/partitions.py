@@ -0,0 +1,170 @@
+"""
+Range partition maintenance for the dispenses and refills tables
+
+- Tables are partitioned by RANGE (TO_DAYS(date_created)), daily or monthly
+- Future partitions are split off the catch-all pmax partition ahead of time
+- Expired partitions are exported to compressed Parquet files and dropped
+"""
+
+import datetime
+import logging
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import text
+
+logger = logging.getLogger('basicLogger')
+
+PARTITIONED_TABLES = ["dispenses", "refills"]
+MAX_PARTITION = "pmax"
+
+
+def partition_start(day, interval):
+    """ Returns the first day of the partition that contains the given day """
+    if interval == "monthly":
+        return day.replace(day=1)
+    return day
+
+
+def next_partition_start(start, interval):
+    """ Returns the first day of the partition after the one starting at start """
+    if interval == "monthly":
+        if start.month == 12:
+            return start.replace(year=start.year + 1, month=1, day=1)
+        return start.replace(month=start.month + 1, day=1)
+    return start + datetime.timedelta(days=1)
+
+
+def partition_name(start, interval):
+    """ Partition names encode the first day they hold, e.g. p20241001 or p202410 """
+    if interval == "monthly":
+        return start.strftime("p%Y%m")
+    return start.strftime("p%Y%m%d")
+
+
+def partition_definition(start, interval):
+    """ SQL definition of the partition holding rows from start up to the next partition """
+    upper = next_partition_start(start, interval)
+    return f"PARTITION {partition_name(start, interval)} VALUES LESS THAN (TO_DAYS('{upper.isoformat()}'))"
+
+
+def partition_clause(interval, premake, today=None):
+    """ PARTITION BY clause for CREATE TABLE, covering today and the next premake partitions """
+    start = partition_start(today or datetime.date.today(), interval)
+    definitions = []
+    for _ in range(premake + 1):
+        definitions.append(partition_definition(start, interval))
+        start = next_partition_start(start, interval)
+    definitions.append(f"PARTITION {MAX_PARTITION} VALUES LESS THAN MAXVALUE")
+    return "PARTITION BY RANGE (TO_DAYS(date_created)) (\n           " + ",\n           ".join(definitions) + ")"
+
+
+def get_partitions(conn, table):
+    """ Returns the names of the bounded partitions of a table, oldest first """
+    rows = conn.execute(text(
+        "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND PARTITION_NAME IS NOT NULL "
+        "ORDER BY PARTITION_ORDINAL_POSITION"), {"table": table})
+    return [row[0] for row in rows if row[0] != MAX_PARTITION]
+
+
+def parse_partition_name(name, interval):
+    """ Inverse of partition_name """
+    if interval == "monthly":
+        return datetime.datetime.strptime(name, "p%Y%m").date()
+    return datetime.datetime.strptime(name, "p%Y%m%d").date()
+
+
+def create_future_partitions(conn, table, existing, interval, premake, today):
+    """ Splits pmax so that partitions exist up to premake intervals past today """
+    target = partition_start(today, interval)
+    for _ in range(premake):
+        target = next_partition_start(target, interval)
+
+    if existing:
+        start = next_partition_start(parse_partition_name(existing[-1], interval), interval)
+    else:
+        start = partition_start(today, interval)
+
+    definitions = []
+    while start <= target:
+        definitions.append(partition_definition(start, interval))
+        start = next_partition_start(start, interval)
+
+    if not definitions:
+        return 0
+
+    definitions.append(f"PARTITION {MAX_PARTITION} VALUES LESS THAN MAXVALUE")
+    conn.execute(text(f"ALTER TABLE {table} REORGANIZE PARTITION {MAX_PARTITION} INTO ({', '.join(definitions)})"))
+    logger.info(f"Created {len(definitions) - 1} future partitions on table {table}")
+    return len(definitions) - 1
+
+
+def archive_partition(conn, table, name, archive_dir, batch_rows):
+    """ Exports the rows of one partition to a zstd compressed Parquet file, batch_rows rows at a time """
+    # A server-side cursor, so only one batch of the partition is held in memory
+    result = conn.execute(text(f"SELECT * FROM {table} PARTITION ({name})"),
+                          execution_options={"stream_results": True})
+    columns = list(result.keys())
+
+    os.makedirs(os.path.join(archive_dir, table), exist_ok=True)
+    filename = os.path.join(archive_dir, table, f"{name}.parquet")
+    archived = 0
+    writer = None
+    rows = result.fetchmany(batch_rows)
+    try:
+        while True:
+            batch = pa.table({column: [row[i] for row in rows] for i, column in enumerate(columns)},
+                             schema=writer.schema if writer is not None else None)
+            if writer is None:
+                writer = pq.ParquetWriter(filename + ".tmp", batch.schema, compression="zstd")
+            writer.write_table(batch)
+            archived += len(rows)
+            rows = result.fetchmany(batch_rows)
+            if not rows:
+                break
+    finally:
+        result.close()
+        if writer is not None:
+            writer.close()
+    os.replace(filename + ".tmp", filename)
+
+    logger.info(f"Archived {archived} rows from {table} partition {name} to {filename}")
+    return filename
+
+
+def expire_partitions(conn, table, existing, interval, retention_days, archive_dir, archive_batch_rows, today):
+    """ Archives (when archive_dir is set) and drops partitions older than the retention period """
+    cutoff = today - datetime.timedelta(days=retention_days)
+    expired = [name for name in existing
+               if next_partition_start(parse_partition_name(name, interval), interval) <= cutoff]
+
+    for name in expired:
+        if archive_dir:
+            archive_partition(conn, table, name, archive_dir, archive_batch_rows)
+        conn.execute(text(f"ALTER TABLE {table} DROP PARTITION {name}"))
+        logger.info(f"Dropped expired partition {name} from table {table}")
+
+    return len(expired)
+
+
+def maintain_partitions(engine, partition_config, today=None):
+    """ Creates upcoming partitions and retires expired ones on every partitioned table """
+    today = today or datetime.date.today()
+    interval = partition_config["interval"]
+
+    with engine.connect() as conn:
+        for table in PARTITIONED_TABLES:
+            existing = get_partitions(conn, table)
+            if not existing:
+                logger.warning(f"Table {table} is not partitioned. Skipping partition maintenance.")
+                continue
+            expire_partitions(conn, table, existing, interval,
+                              partition_config["retention_days"],
+                              partition_config.get("archive_dir"),
+                              partition_config["archive_batch_rows"],
+                              today)
+            create_future_partitions(conn, table, get_partitions(conn, table), interval,
+                                     partition_config["premake"], today)
+        conn.commit()
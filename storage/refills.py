@@ -9,14 +9,15 @@ class RefillItem(Base):
 
     __tablename__ = "refills"
 
+    # id alone identifies a row; SQLite only auto-increments a single integer primary key
     id = Column(Integer, primary_key=True, autoincrement=True)
-    vending_machine_id = Column(String(250), primary_key=True)
+    vending_machine_id = Column(String(250), nullable=False)
     staff_name = Column(String(250), nullable=False)
     refill_time = Column(DateTime, nullable=False)
     item_id = Column(Integer, nullable=False)
     item_quantity = Column(Integer, nullable=False)
     date_created = Column(DateTime, nullable=False)
-    trace_id = Column(String(250), primary_key=True)
+    trace_id = Column(String(250), nullable=False)
 
     def __init__(self, vending_machine_id, staff_name, refill_time, item_id, item_quantity, trace_id):
         """ Initializes a refill record"""